@@ -1,70 +1,117 @@
 from flask import Flask
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
 
-from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
+import os
 
 from annotator_app.extensions import cors, db, security, mail, migrate, oauth
 from annotator_app.database import user_datastore
+from annotator_app import user_cache, cache, replicas, storage, encoding, compression, metrics, querytracker, tracing, profiler
 
-app = Flask(__name__,
-        instance_relative_config=True,
-        static_url_path='/ignorethis' # Need to set this so we can handle /<path>.
-)
-app.config.from_pyfile('config.py')
-cors.init_app(app, supports_credentials=True)
-db.init_app(app)
-security.init_app(app,user_datastore)
-mail.init_app(app)
-migrate.init_app(app,db)
-oauth.init_app(app)
-app.app_context().push()
-
-oauth.register(
-    name='github',
-    access_token_url='https://github.com/login/oauth/access_token',
-    access_token_params=None,
-    authorize_url='https://github.com/login/oauth/authorize',
-    authorize_params=None,
-    api_base_url='https://api.github.com/',
-    client_kwargs={},
-)
-
-from annotator_app.resources.auth import auth_bp
-from annotator_app.resources.users import blueprint as user_bp
-from annotator_app.resources.documents import blueprint as doc_bp
-from annotator_app.resources.annotations import blueprint as ann_bp
-from annotator_app.resources.notes import blueprint as note_bp
-from annotator_app.resources.tags import blueprint as tag_bp
-
-app.register_blueprint(auth_bp, url_prefix='/api/auth')
-app.register_blueprint(user_bp, url_prefix='/api/data')
-app.register_blueprint(doc_bp, url_prefix='/api/data')
-app.register_blueprint(ann_bp, url_prefix='/api/data')
-app.register_blueprint(note_bp, url_prefix='/api/data')
-app.register_blueprint(tag_bp, url_prefix='/api/data')
-
-# Below for dev purposes only
-import os
-from flask import Response, send_from_directory
-from functools import wraps
-
-def debug_only(f):
-    @wraps(f)
-    def wrapped(**kwargs):
-        if not app.debug:
-            abort(404)
-        return f(**kwargs)
-    return wrapped
-
-def root_dir():
-    return os.path.abspath('../web/build')
-
-@debug_only
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-@app.route('/<string:path>')
-def send_file(path):
-    print(os.path.join(root_dir(), path))
-    if not os.path.isfile(os.path.join(root_dir(), path)):
-        path = 'index.html'
-    return send_from_directory(root_dir(), path)
+def create_app(config=None):
+    """ Create and configure the app.
+
+    `config` is a dictionary of settings that override those in the instance's `config.py`.
+    No database connection is made until the first query, so the app can be created in a
+    parent process before forking workers (e.g. uWSGI without `lazy-apps`).
+    """
+    app = Flask(__name__,
+            instance_relative_config=True,
+            static_url_path='/ignorethis' # Need to set this so we can handle /<path>.
+    )
+    app.config.from_pyfile('config.py')
+    if config is not None:
+        app.config.update(config)
+    if 'RESPONSE_ENCODER' in app.config:
+        encoding.set_encoder(app.config['RESPONSE_ENCODER'])
+
+    cors.init_app(app, supports_credentials=True)
+    db.init_app(app)
+    replicas.init_app(app)
+    security.init_app(app,user_datastore)
+    user_cache.init_app(app)
+    cache.init_app(app)
+    storage.init_app(app)
+    mail.init_app(app)
+    migrate.init_app(app,db)
+    oauth.init_app(app)
+    compression.init_app(app) # First, so that it runs after the other `after_request` functions
+    metrics.init_app(app)
+    tracing.init_app(app)
+    profiler.init_app(app)
+    querytracker.init_app(app)
+
+    oauth.register(
+        name='github',
+        access_token_url='https://github.com/login/oauth/access_token',
+        access_token_params=None,
+        authorize_url='https://github.com/login/oauth/authorize',
+        authorize_params=None,
+        api_base_url='https://api.github.com/',
+        client_kwargs={},
+    )
+
+    from annotator_app.resources.auth import auth_bp
+    from annotator_app.resources.users import blueprint as user_bp
+    from annotator_app.resources.documents import blueprint as doc_bp
+    from annotator_app.resources.annotations import blueprint as ann_bp
+    from annotator_app.resources.notes import blueprint as note_bp
+    from annotator_app.resources.tags import blueprint as tag_bp
+    from annotator_app.resources.export import blueprint as export_bp
+    from annotator_app.resources.changes import blueprint as changes_bp
+    from annotator_app.resources.shared import blueprint as shared_bp, init_app as init_shared
+
+    app.register_blueprint(auth_bp, url_prefix='/api/auth')
+    app.register_blueprint(user_bp, url_prefix='/api/data')
+    app.register_blueprint(doc_bp, url_prefix='/api/data')
+    app.register_blueprint(ann_bp, url_prefix='/api/data')
+    app.register_blueprint(note_bp, url_prefix='/api/data')
+    app.register_blueprint(tag_bp, url_prefix='/api/data')
+    app.register_blueprint(export_bp, url_prefix='/api/data')
+    app.register_blueprint(changes_bp, url_prefix='/api/data')
+    app.register_blueprint(shared_bp, url_prefix='/api/shared')
+    init_shared(app)
+
+    if app.debug:
+        _register_frontend(app)
+
+    return app
+
+##################################################
+# Fork safety
+##################################################
+
+# Connections are tagged with the process that opened them. A connection
+# inherited through a fork is discarded on checkout, without being closed, since
+# closing it would also end the parent's session on the database server.
+
+@event.listens_for(Pool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+                'Connection belongs to process %d, not %d' % (connection_record.info['pid'], pid))
+
+##################################################
+# Dev only
+##################################################
+
+def _register_frontend(app):
+    """ Serve the web app's build, for running without nginx. """
+    from flask import send_from_directory
+
+    def root_dir():
+        return os.path.abspath('../web/build')
+
+    @app.route('/', defaults={'path': ''})
+    @app.route('/<path:path>')
+    @app.route('/<string:path>')
+    def send_file(path):
+        if not os.path.isfile(os.path.join(root_dir(), path)):
+            path = 'index.html'
+        return send_from_directory(root_dir(), path)
@@ -0,0 +1,197 @@
+""" PDFs with a user's annotations and notes drawn on them.
+
+Rect annotations are outlined, highlights are drawn as translucent strokes
+along their path and points are marked on the page, and notes are added as PDF
+text annotations next to them. Rendering runs on a pool of
+`ANNOTATED_PDF_WORKERS` background threads. Results are kept in the app's
+storage (see `annotator_app.storage`) under the hash of the original PDF and a
+revision computed from the annotations, so a file is only rendered again when
+the PDF or one of its annotations changes.
+"""
+from flask import current_app as app
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+
+from annotator_app.extensions import db
+from annotator_app.database import Annotation, Note
+
+RECT_COLOUR = (0.95, 0.6, 0.0)
+POINT_COLOUR = (0.85, 0.1, 0.1)
+POINT_SIZE = 6
+# As drawn by the web client: a 1em wide yellow stroke at 30% opacity, multiplied with the page
+HIGHLIGHT_COLOUR = (1.0, 1.0, 0.0)
+HIGHLIGHT_OPACITY = 0.3
+HIGHLIGHT_WIDTH = 16
+HIGHLIGHT_STATE = '/AnnotatorHighlight' # Name of the graphics state in the page's resources
+
+_lock = threading.RLock()
+_executor = None
+_jobs = {} # File name -> Future
+
+def get_annotations(user_id, doc_id):
+    """ The data drawn on the PDF for each of a document's annotations, ordered by ID. """
+    rows = db.session.query(Annotation.id, Annotation.page, Annotation.type, Annotation.position, Note.body) \
+            .outerjoin(Note, Note.id == Annotation.note_id) \
+            .filter(Annotation.user_id == user_id) \
+            .filter(Annotation.doc_id == doc_id) \
+            .filter(Annotation.deleted_at.is_(None)) \
+            .order_by(Annotation.id) \
+            .all()
+    return [{'id': r[0], 'page': r[1], 'type': r[2], 'position': r[3], 'note': r[4]} for r in rows]
+
+def annotation_revision(annotations):
+    """ Digest of everything in `annotations` that affects the rendered PDF. """
+    data = json.dumps(annotations, sort_keys=True, separators=(',',':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+KEY_PREFIX = 'annotated/'
+
+def cache_key(content_hash, revision):
+    return '%s%s-%s.pdf' % (KEY_PREFIX, content_hash, revision)
+
+##################################################
+# Rendering
+##################################################
+
+def _stream(writer, data):
+    from PyPDF2.generic import DecodedStreamObject
+    stream = DecodedStreamObject()
+    stream.setData(data.encode('latin-1'))
+    return writer._addObject(stream)
+
+def _add_graphics_state(page, name, state):
+    """ Add `state` to the page's resources under `name`, for use with the `gs` operator. """
+    from PyPDF2.generic import DictionaryObject, NameObject
+    resources = page['/Resources'].getObject() if '/Resources' in page else DictionaryObject()
+    states = resources['/ExtGState'].getObject() if '/ExtGState' in resources else DictionaryObject()
+    states[NameObject(name)] = state
+    resources[NameObject('/ExtGState')] = states
+    page[NameObject('/Resources')] = resources
+
+def _annotate_page(writer, page, annotations):
+    from PyPDF2.generic import (ArrayObject, DictionaryObject, FloatObject, NameObject, NumberObject,
+            TextStringObject)
+    # Annotation positions are in points from the top left corner of the rendered (cropped) page
+    box = page.cropBox
+    left = float(box.getLowerLeft_x())
+    top = float(box.getUpperRight_y())
+
+    drawing = []
+    notes = []
+    for ann in annotations:
+        position = ann['position'] or {}
+        if ann['type'] == 'rect' and 'box' in position:
+            t,r,b,l = position['box']
+            drawing.append('%f %f %f RG 1.5 w %f %f %f %f re S' % (
+                RECT_COLOUR+(left+l, top-b, r-l, b-t)))
+            anchor = (left+l, top-t)
+        elif ann['type'] == 'highlight' and position.get('points'):
+            path = ['%f %f m' % (left+position['points'][0][0], top-position['points'][0][1])]
+            path += ['%f %f l' % (left+x, top-y) for x,y in position['points'][1:]]
+            drawing.append('q %s gs %f %f %f RG %d w 1 J 1 j %s S Q' % (
+                (HIGHLIGHT_STATE,)+HIGHLIGHT_COLOUR+(HIGHLIGHT_WIDTH, ' '.join(path))))
+            x,y = position['points'][0]
+            anchor = (left+x, top-y)
+        elif 'coords' in position:
+            x,y = position['coords']
+            drawing.append('%f %f %f rg %f %f %d %d re f' % (
+                POINT_COLOUR+(left+x-POINT_SIZE/2, top-y-POINT_SIZE/2, POINT_SIZE, POINT_SIZE)))
+            anchor = (left+x, top-y)
+        else:
+            continue
+        if ann['note']:
+            notes.append((anchor, ann['note']))
+
+    if any(ann['type'] == 'highlight' for ann in annotations):
+        _add_graphics_state(page, HIGHLIGHT_STATE, DictionaryObject({
+            NameObject('/Type'): NameObject('/ExtGState'),
+            NameObject('/CA'): FloatObject(HIGHLIGHT_OPACITY),
+            NameObject('/BM'): NameObject('/Multiply'),
+        }))
+
+    # Wrap the existing content so that its graphics state does not leak into the drawing
+    contents = page.raw_get('/Contents') if '/Contents' in page else ArrayObject()
+    if isinstance(contents.getObject(), ArrayObject): # Possibly an indirect reference to the array of streams
+        contents = contents.getObject()
+    else:
+        contents = [contents]
+    page[NameObject('/Contents')] = ArrayObject(
+            [_stream(writer, 'q\n')] + list(contents) + [_stream(writer, 'Q\nq\n%s\nQ\n' % '\n'.join(drawing))])
+
+    annots = ArrayObject(page['/Annots']) if '/Annots' in page else ArrayObject()
+    for (x,y), body in notes:
+        annots.append(writer._addObject(DictionaryObject({
+            NameObject('/Type'): NameObject('/Annot'),
+            NameObject('/Subtype'): NameObject('/Text'),
+            NameObject('/Rect'): ArrayObject([FloatObject(x), FloatObject(y-20), FloatObject(x+20), FloatObject(y)]),
+            NameObject('/Contents'): TextStringObject(body),
+            NameObject('/Name'): NameObject('/Comment'),
+            NameObject('/F'): NumberObject(4), # Print
+        })))
+    if len(annots) > 0:
+        page[NameObject('/Annots')] = annots
+
+def render(pdf_file_name, store, key, annotations):
+    """ Store a copy of a PDF with `annotations` (as returned by `get_annotations`) drawn on it under `key`. """
+    from PyPDF2 import PdfFileReader, PdfFileWriter # Only imported by the processes that render
+    by_page = defaultdict(list)
+    for ann in annotations:
+        by_page[ann['page']].append(ann)
+
+    with open(pdf_file_name, 'rb') as f:
+        reader = PdfFileReader(f, strict=False)
+        writer = PdfFileWriter()
+        for i in range(reader.getNumPages()):
+            page = reader.getPage(i)
+            if i+1 in by_page:
+                _annotate_page(writer, page, by_page[i+1])
+            writer.addPage(page)
+
+        tmp_file_name = store.temp_file_name()
+        try:
+            with open(tmp_file_name, 'wb') as out:
+                writer.write(out)
+        except Exception:
+            os.remove(tmp_file_name)
+            raise
+    store.put_file(key, tmp_file_name)
+
+##################################################
+# Background rendering
+##################################################
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config.get('ANNOTATED_PDF_WORKERS', 2))
+    return _executor
+
+def _forget(key, future):
+    if future.exception() is None:
+        with _lock:
+            _jobs.pop(key, None)
+
+def request_render(pdf_file_name, store, key, annotations):
+    """ Start rendering in the background unless it is already done or in progress.
+
+    Returns None if the output is stored, or the job's Future otherwise.
+    A failed job is returned once, with its exception, then forgotten so that it can be retried.
+    """
+    if store.exists(key):
+        return None
+    with _lock:
+        future = _jobs.get(key)
+        if future is None:
+            future = _get_executor().submit(render, pdf_file_name, store, key, annotations)
+            _jobs[key] = future
+            future.add_done_callback(lambda f: _forget(key, f))
+        elif future.done():
+            del _jobs[key]
+            if future.exception() is None:
+                return None
+    return future
@@ -0,0 +1,354 @@
+""" Two-tier cache shared by the worker processes.
+
+Each process keeps the `CACHE_LOCAL_SIZE` most recently used entries in memory,
+in front of a tier that all processes share, chosen with `CACHE_BACKEND`:
+
+- `file`: one file per entry in `CACHE_DIRECTORY` (by default in `/dev/shm`,
+  which is in memory), pruned to `CACHE_FILE_MAX_ENTRIES` entries. The directory
+  must belong to the app's user, and is only accessible by it.
+- `redis`: a Redis server (or anything speaking its protocol) at
+  `CACHE_REDIS_URL`. Requires the `redis` package.
+- `local`: no shared tier. Only correct with a single process.
+
+Entries that depend on a user's data are keyed with the user's version
+(`user_key`), which is replaced after every commit that writes one of their
+documents, annotations, notes or tags. Entries of older versions are never read
+again and are evicted in time. The version is always read from the shared tier,
+so a write in one process is seen by all of them. Requests reading from a
+replica don't cache entries of a version younger than the replicas may lag.
+
+Hits of each tier, misses and evictions are counted in the metrics
+(`cache_requests_total`, `cache_evictions_total`).
+"""
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+from stat import S_ISDIR
+import tempfile
+import threading
+import time
+
+from annotator_app import metrics, replicas
+
+VERSIONED_TABLES = {'documents', 'annotations', 'notes', 'tags'}
+
+_missing = object()
+
+##################################################
+# Tiers
+##################################################
+
+class LocalCache(object):
+    """ In-process LRU cache. """
+    name = 'local'
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expiry time or None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _missing
+            if entry[0] is not None and entry[0] <= time.time():
+                del self._entries[key]
+                return _missing
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (time.time()+ttl if ttl is not None else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted > 0:
+            metrics.inc('cache_evictions_total', evicted, tier=self.name)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class FileCache(object):
+    """ Entries pickled into files in a directory, readable by every process on the host. """
+    name = 'file'
+    PRUNE_EVERY = 100 # Writes between checks of the number of files
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._writes = 0
+        # Entries are unpickled, so nobody else may be able to write them. /dev/shm is writable by every user.
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        stat = os.lstat(directory)
+        if not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid():
+            raise RuntimeError('Cache directory %s is not a directory owned by this user' % directory)
+        os.chmod(directory, 0o700)
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        file_name = self._file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                expiry, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _missing
+        if expiry is not None and expiry <= time.time():
+            return _missing
+        try:
+            os.utime(file_name) # Recently used files are pruned last
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, ttl=None):
+        file_name = self._file_name(key)
+        fd, tmp_file_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time()+ttl if ttl is not None else None, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_name, file_name)
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._file_name(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def prune(self):
+        """ Remove the least recently used files beyond `max_entries`. """
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+        if len(files) <= self.max_entries:
+            return
+        files.sort()
+        evicted = 0
+        for _, path in files[:len(files)-self.max_entries]:
+            try:
+                os.remove(path)
+                evicted += 1
+            except OSError:
+                pass
+        metrics.inc('cache_evictions_total', evicted, tier=self.name)
+
+class RedisCache(object):
+    name = 'redis'
+    def __init__(self, url, prefix):
+        import redis # Optional dependency
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix+key)
+        if data is None:
+            return _missing
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix+key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                ex=int(ttl) if ttl is not None else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix+key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix+'*'):
+            self.client.delete(key)
+
+class Cache(object):
+    def __init__(self, local, shared, default_ttl):
+        self.local = local
+        self.shared = shared
+        self.default_ttl = default_ttl
+
+    def get(self, name, key, local=True):
+        """ Value of `key`, or `_missing`. `name` is the kind of entry, for the statistics. """
+        if local:
+            value = self.local.get(key)
+            if value is not _missing:
+                metrics.inc('cache_requests_total', cache=name, result='local_hit')
+                return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                current_app.logger.warning('Cache read failed: %s', e)
+                value = _missing
+            if value is not _missing:
+                metrics.inc('cache_requests_total', cache=name, result='shared_hit')
+                if local:
+                    self.local.set(key, value, self.default_ttl)
+                return value
+        metrics.inc('cache_requests_total', cache=name, result='miss')
+        return _missing
+
+    def set(self, key, value, ttl=None, local=True):
+        if ttl is None:
+            ttl = self.default_ttl
+        if local:
+            self.local.set(key, value, ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl)
+            except Exception as e:
+                current_app.logger.warning('Cache write failed: %s', e)
+
+    def get_version(self, key):
+        """ Version token stored under `key`, created if there is none. Not kept in the local tier.
+        Returns None if the shared tier is unavailable. """
+        tier = self.shared if self.shared is not None else self.local
+        try:
+            version = tier.get(key)
+            if version is _missing:
+                version = self.new_version(key)
+        except Exception as e:
+            current_app.logger.warning('Cache read failed: %s', e)
+            return None
+        return version
+
+    def new_version(self, key):
+        # Random rather than incremented, so that a version that was evicted is never reused.
+        # The creation time tells whether the replicas may not have the writes yet.
+        version = '%s.%d' % (os.urandom(6).hex(), time.time())
+        tier = self.shared if self.shared is not None else self.local
+        tier.set(key, version, None)
+        return version
+
+##################################################
+# API
+##################################################
+
+def _cache():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('cache')
+
+def get_or_set(name, key, compute, ttl=None, local=True):
+    """ Cached value of `key`, or the result of `compute()`, which is then cached.
+
+    `local=False` keeps the entry out of the in-process tier, for large values.
+    """
+    cache = _cache()
+    if cache is None or key is None:
+        return compute()
+    value = cache.get(name, key, local)
+    if value is _missing:
+        value = compute()
+        cache.set(key, value, ttl, local)
+    return value
+
+def user_key(user_id, *parts):
+    """ Key of an entry that depends on the user's data, or None if it cannot be cached. """
+    cache = _cache()
+    if cache is None:
+        return None
+    version = cache.get_version('version:user:%d' % user_id)
+    if version is None:
+        return None
+    # Data read from a replica shortly after a write may predate it, and must not be cached under the new version
+    if replicas.reading_from_replica() and time.time()-int(version.partition('.')[2] or 0) < replicas.max_staleness():
+        return None
+    return ':'.join(['user', str(user_id), version] + [str(p) for p in parts])
+
+def get_version(name):
+    """ Version token of `name`, which all processes see if there is a shared tier, or None without a cache. """
+    cache = _cache()
+    if cache is None:
+        return None
+    return cache.get_version('version:%s' % name)
+
+def new_version(name):
+    """ Change the version of `name`, so that what each process derived from it is known to be outdated. """
+    cache = _cache()
+    if cache is None:
+        return
+    try:
+        cache.new_version('version:%s' % name)
+    except Exception as e:
+        current_app.logger.error('Unable to change the version of %s: %s', name, e)
+
+def clear():
+    """ Remove every entry, e.g. after the database was recreated. """
+    cache = _cache()
+    if cache is not None:
+        cache.local.clear()
+        if cache.shared is not None:
+            cache.shared.clear()
+
+def invalidate_user(user_id):
+    """ Make the entries that depend on the user's data unreachable. """
+    cache = _cache()
+    if cache is None:
+        return
+    try:
+        cache.new_version('version:user:%d' % user_id)
+    except Exception as e:
+        current_app.logger.error('Unable to invalidate cached entries of user %d: %s', user_id, e)
+
+##################################################
+# Invalidation on writes
+##################################################
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    users = session.info.setdefault('cache_invalidated_users', set())
+    for entity in list(session.new)+list(session.dirty)+list(session.deleted):
+        if getattr(entity, '__tablename__', None) in VERSIONED_TABLES and entity.user_id is not None:
+            users.add(entity.user_id)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for user_id in session.info.pop('cache_invalidated_users', ()):
+        invalidate_user(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('cache_invalidated_users', None)
+
+def init_app(app):
+    config = app.config
+    if not config.get('CACHE_ENABLED', True):
+        return
+    backend = config.get('CACHE_BACKEND', 'file')
+    # Apps using different databases must not share entries
+    database = hashlib.sha1(config['SQLALCHEMY_DATABASE_URI'].encode('utf-8')).hexdigest()[:8]
+    if backend == 'file':
+        default_directory = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                'annotator-cache-%s' % database)
+        shared = FileCache(config.get('CACHE_DIRECTORY', default_directory),
+                config.get('CACHE_FILE_MAX_ENTRIES', 10000))
+    elif backend == 'redis':
+        shared = RedisCache(config['CACHE_REDIS_URL'], config.get('CACHE_KEY_PREFIX', 'annotator:%s:' % database))
+    elif backend == 'local':
+        shared = None
+    else:
+        raise ValueError('Unknown CACHE_BACKEND: %s' % backend)
+    local = LocalCache(config.get('CACHE_LOCAL_SIZE', 1000))
+    app.extensions['cache'] = Cache(local, shared, config.get('CACHE_DEFAULT_TTL', 3600))
@@ -0,0 +1,117 @@
+""" Compression of JSON responses, negotiated with the client's `Accept-Encoding`.
+
+Brotli is used when the client accepts it and the `brotli` package is
+installed, otherwise gzip. Responses smaller than `COMPRESSION_MIN_SIZE` bytes
+are sent as they are. Streamed responses (e.g. the NDJSON export) are
+compressed chunk by chunk, and each chunk is flushed so that the client
+receives it without waiting for the rest of the stream.
+"""
+from flask import request, current_app
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from annotator_app import metrics, tracing
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def negotiate(accept_encoding, encodings=None):
+    """ The encoding in `encodings` (in order of preference) that the `Accept-Encoding` header gives the highest weight to.
+    Returns None if none of them are acceptable. """
+    if encodings is None:
+        encodings = available_encodings()
+    weights = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        weight = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name != '':
+            weights[name] = weight
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def _levels():
+    return {
+        'gzip': current_app.config.get('COMPRESSION_GZIP_LEVEL', 1),
+        'br': current_app.config.get('COMPRESSION_BROTLI_QUALITY', 4),
+    }
+
+def compress(data, encoding, level):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: gzip header
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'br':
+        return brotli.compress(data, quality=level)
+    raise ValueError('Unknown encoding: %s' % encoding)
+
+def compress_stream(chunks, encoding, level):
+    """ Compress an iterable of chunks, flushing after each one. """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    else:
+        compressor = brotli.Compressor(quality=level)
+        process = lambda chunk: compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if len(chunk) > 0:
+                yield process(chunk)
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+def _after_request(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough:
+        return response
+    if 'Content-Encoding' in response.headers or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+    level = _levels()[encoding]
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESSION_MIN_SIZE', 1024):
+        return response
+    with tracing.span('compress', encoding=encoding, size=len(data)):
+        compressed = compress(data, encoding, level)
+    metrics.inc('compression_input_bytes_total', len(data), encoding=encoding)
+    metrics.inc('compression_output_bytes_total', len(compressed), encoding=encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app):
+    if app.config.get('COMPRESSION_ENABLED', True):
+        app.after_request(_after_request)
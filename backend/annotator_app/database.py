@@ -3,7 +3,8 @@ from flask_security import current_user
 import sqlalchemy
 from sqlalchemy import create_engine, ForeignKey
 from sqlalchemy.sql import func
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker, validates
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy, association_proxy
 
@@ -19,46 +20,115 @@ import os
 
 from annotator_app.extensions import db
 
+JSONType = db.JSON().with_variant(JSONB(), 'postgresql')
+
 class ModelMixin(object):
+    # Columns to leave out of `to_dict`, and functions to apply to column values when serializing.
+    # The serializer is generated from these by `compile_serializer`.
+    __serialize_exclude__ = ()
+    __serialize_converters__ = {}
+    __serializer__ = staticmethod(lambda obj: {})
+    # Fields that cannot be set through `update`, and functions to apply to incoming values.
+    # The write schema is generated from these by `compile_write_schema`.
+    __write_exclude__ = ('id', 'user_id')
+    __write_converters__ = {}
+    __write_schema__ = {}
+    # Keys that `update` skips without setting, e.g. fields computed by `to_dict` that clients send back.
+    __write_ignore__ = ()
     def to_dict(self):
-        return {}
+        return self.__serializer__(self)
     def update(self, data):
+        """ Update the entity with values from a dictionary.
+        Excluded and ignored fields are skipped. Raises ValueError for any other key that isn't a writable field. """
+        schema = self.__write_schema__
         for k,v in data.items():
-            if v is None:
-                self.__setattr__(k,v)
-                continue
-
-            cls = self.__class__
-            try:
-                attr = cls.__getattribute__(cls,k)
-            except AttributeError:
-                print('Invalid attribute %s' % k)
-                continue
-
-            if type(attr) is AssociationProxy:
-                self.__setattr__(k,v)
-                continue
-
-            prop = attr.property
-            prop_type = type(prop.columns[0].type)
-            if prop_type is Date:
-                val = datetime.datetime.fromisoformat(v).date()
-            elif prop_type is DateTime:
-                val = datetime.datetime.fromisoformat(v)
-            else:
-                val = v
-            self.__setattr__(k,val)
+            setter = schema.get(k)
+            if setter is not None:
+                setter(self, v)
+            elif k not in self.__write_exclude__ and k not in self.__write_ignore__:
+                raise ValueError('Unknown field: %s' % k)
 
 def date_to_str(d):
     if d is None:
         return None
-    return d.strftime('%Y-%m-%d')
+    return d.isoformat()
 
 def datetime_to_str(d):
     if d is None:
         return None
+    if d.tzinfo is None:
+        return d.isoformat()+'+00:00'
     return d.replace(tzinfo=datetime.timezone.utc).isoformat()
 
+COLUMN_TYPE_CONVERTERS = {
+    Date: date_to_str,
+    DateTime: datetime_to_str,
+}
+
+def compile_serializer(model):
+    """ Generate a function that converts an instance of `model` into a dictionary of its columns.
+
+    The function is built once from the table's column metadata, so serializing
+    a row is a single dictionary literal rather than a series of lookups.
+    """
+    namespace = {}
+    items = []
+    for column in model.__table__.columns:
+        if column.key in model.__serialize_exclude__:
+            continue
+        converter = model.__serialize_converters__.get(column.key)
+        if converter is None:
+            converter = COLUMN_TYPE_CONVERTERS.get(type(column.type))
+        if converter is None:
+            items.append('%r: obj.%s' % (column.key, column.key))
+        else:
+            namespace['convert_%s' % column.key] = converter
+            items.append('%r: convert_%s(obj.%s)' % (column.key, column.key, column.key))
+    source = 'def serialize(obj):\n    return {%s}\n' % ', '.join(items)
+    exec(compile(source, '<serializer %s>' % model.__name__, 'exec'), namespace)
+    return namespace['serialize']
+
+def str_to_date(s):
+    return datetime.datetime.fromisoformat(s).date()
+
+def str_to_datetime(s):
+    return datetime.datetime.fromisoformat(s)
+
+WRITE_TYPE_CONVERTERS = {
+    Integer: int,
+    Float: float,
+    Date: str_to_date,
+    DateTime: str_to_datetime,
+}
+
+def make_setter(key, converter=None):
+    if converter is None:
+        def setter(obj, value):
+            setattr(obj, key, value)
+    else:
+        def setter(obj, value):
+            setattr(obj, key, None if value is None else converter(value))
+    return setter
+
+def compile_write_schema(model):
+    """ Map each writable field of `model` to a function that converts and sets an incoming value.
+
+    Writable fields are the table's columns and the model's association proxies.
+    """
+    schema = {}
+    for column in model.__table__.columns:
+        if column.key in model.__write_exclude__:
+            continue
+        converter = model.__write_converters__.get(column.key)
+        if converter is None:
+            converter = WRITE_TYPE_CONVERTERS.get(type(column.type))
+        schema[column.key] = make_setter(column.key, converter)
+    for cls in model.__mro__:
+        for k,v in vars(cls).items():
+            if type(v) is AssociationProxy and k not in model.__write_exclude__:
+                schema[k] = make_setter(k)
+    return schema
+
 roles_users = db.Table('roles_users',
         db.Column('user_id', db.Integer(), db.ForeignKey('users.id')),
         db.Column('role_id', db.Integer(), db.ForeignKey('roles.id')))
@@ -92,6 +162,23 @@ class EmailConfirmationCode(db.Model, ModelMixin):
     created_at = db.Column(db.DateTime(), server_default=func.now())
     user = db.relationship('User')
 
+class EmailOutbox(db.Model, ModelMixin):
+    """ Emails waiting to be delivered by `annotator_app.outbox`. """
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        db.Index('ix_email_outbox_pending', 'sent_at', 'next_attempt_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    sender = Column(String)
+    recipient = Column(String)
+    subject = Column(String)
+    body = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+    created_at = Column(DateTime, server_default=func.now())
+    next_attempt_at = Column(DateTime, server_default=func.now())
+    sent_at = Column(DateTime)
+
 class Document(db.Model, ModelMixin):
     __tablename__ = 'documents'
     id = Column(Integer, primary_key=True)
@@ -119,32 +206,54 @@ class Document(db.Model, ModelMixin):
             creator=lambda tag_id: db.session.query(Tag).filter_by(user_id=current_user.id,id=tag_id).first()
     )
 
+    __serialize_exclude__ = ('hash', 'created_at')
+
     def to_dict(self):
-        return {
-                'id': self.id,
-                'user_id': self.user_id,
-                'url': self.url,
-                'title': self.title,
-                'author': self.author,
-                'bibtex': self.bibtex,
-                'read': self.read,
-                'note_id': self.note_id,
-                'deleted_at': date_to_str(self.deleted_at),
-                'last_modified_at': datetime_to_str(self.last_modified_at),
-                'last_accessed_at': datetime_to_str(self.last_accessed_at),
-                'tag_names': list(self.tag_names),
-                'tag_ids': list(self.tag_ids),
-        }
+        output = self.__serializer__(self)
+        tags = self.tags
+        output['tag_names'] = [t.name for t in tags]
+        output['tag_ids'] = [t.id for t in tags]
+        return output
+
+def position_to_bbox(position):
+    """ Bounding box (left, top, right, bottom) of an annotation's position. Points have a zero-sized box.
+    Raises ValueError if the position is malformed. """
+    if position is None:
+        return None, None, None, None
+    if not isinstance(position, dict):
+        raise ValueError('Invalid position: expected an object')
+    try:
+        if 'box' in position:
+            top, right, bottom, left = [float(v) for v in position['box']]
+            return left, top, right, bottom
+        if 'coords' in position:
+            x, y = [float(v) for v in position['coords']]
+            return x, y, x, y
+        if position.get('points'):
+            xs = [float(p[0]) for p in position['points']]
+            ys = [float(p[1]) for p in position['points']]
+            return min(xs), min(ys), max(xs), max(ys)
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise ValueError('Invalid position: %s' % json.dumps(position)[:100])
+    return None, None, None, None
 
 class Annotation(db.Model, ModelMixin):
     __tablename__ = 'annotations'
+    __table_args__ = (
+        db.Index('ix_annotations_doc_id_page', 'doc_id', 'page'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     doc_id = Column(Integer, ForeignKey('documents.id'))
     note_id = Column(Integer, ForeignKey('notes.id',name='fkey_note_id'))
-    page = Column(String)
+    page = Column(Integer)
     type = Column(String)
-    position = Column(String) # Coordinate for points, bounding box for rect. Format: json string.
+    position = Column(JSONType) # Coordinate for points ({'coords': [x,y]}), bounding box for rect ({'box': [top,right,bottom,left]}), path for highlights ({'points': [[x,y],...]}).
+    # Bounding box of `position`, kept in sync by `validate_position`. Used for region queries.
+    bbox_left = Column(Float)
+    bbox_top = Column(Float)
+    bbox_right = Column(Float)
+    bbox_bottom = Column(Float)
     deleted_at = Column(Date)
     #important = Column(Boolean) # If True, then this annotation marks something important
     #do_not_understand = Column(Boolean) # If True, then this annotation marks something the reader does not understand.
@@ -152,22 +261,13 @@ class Annotation(db.Model, ModelMixin):
     document = db.relationship("Document")
     note = db.relationship('Note')
 
-    def update(self,data):
-        super().update(data)
-        if 'position' in data:
-            self.position = json.dumps(data['position'])
+    __serialize_exclude__ = ('bbox_left', 'bbox_top', 'bbox_right', 'bbox_bottom')
+    __write_exclude__ = ('id', 'user_id', 'bbox_left', 'bbox_top', 'bbox_right', 'bbox_bottom')
 
-    def to_dict(self):
-        return {
-                'id': self.id,
-                'user_id': self.user_id,
-                'note_id': self.note_id,
-                'doc_id': self.doc_id,
-                'page': self.page,
-                'type': self.type,
-                'position': json.loads(self.position),
-                'deleted_at': self.deleted_at.strftime('%Y-%m-%d') if self.deleted_at is not None else None
-        }
+    @validates('position')
+    def validate_position(self, key, position):
+        self.bbox_left, self.bbox_top, self.bbox_right, self.bbox_bottom = position_to_bbox(position)
+        return position
 
 documents_tags = db.Table('documents_tags',
         db.Column('document_id', db.Integer(), db.ForeignKey('documents.id')),
@@ -200,14 +300,6 @@ class Tag(db.Model, ModelMixin):
         if tag is not None:
             raise ValueError('Tag name "%s" is already in use. Choose another name.' % self.name)
 
-    def to_dict(self):
-        return {
-                'id': self.id,
-                'user_id': self.user_id,
-                'name': self.name,
-                'description': self.description,
-                'deleted_at': self.deleted_at.strftime('%Y-%m-%d') if self.deleted_at is not None else None
-        }
 
 class DocumentAccessCode(db.Model, ModelMixin):
     __tablename__ = 'document_access_codes'
@@ -219,12 +311,6 @@ class DocumentAccessCode(db.Model, ModelMixin):
     code = Column(String)
     created_at = db.Column(DateTime, server_default=func.now())
 
-    def update(self,data):
-        pass
-
-    def to_dict(self):
-        pass
-
 class Note(db.Model, ModelMixin):
     __tablename__ = 'notes'
     id = Column(Integer, primary_key=True)
@@ -243,8 +329,14 @@ class Note(db.Model, ModelMixin):
             creator=lambda name: db.session.query(Tag).filter_by(user_id=current_user.id,name=name).first()
     )
 
-    def to_dict(self):
-        annotations = self.annotations.all()
+    __serialize_exclude__ = ('created_at',)
+    # Computed by `to_dict`. `annotation_id` and `document_id` are also used when creating a note, to attach it.
+    __write_ignore__ = ('document_id', 'annotation_id', 'orphaned')
+
+    def to_dict(self, annotations=None):
+        """ `annotations` can be given as a list of the note's annotations, with their documents loaded, to avoid querying for them. """
+        if annotations is None:
+            annotations = self.annotations.all()
         doc_id = None
         ann_id = None
         if len(annotations) > 0 and annotations[0].deleted_at is None:
@@ -252,19 +344,16 @@ class Note(db.Model, ModelMixin):
             doc = annotations[0].document
             if doc.deleted_at is None:
                 doc_id = doc.id
-        return {
-                'id': self.id,
-                'user_id': self.user_id,
-                'body': self.body,
-                'parser': self.parser,
-                'deleted_at': date_to_str(self.deleted_at),
-                'last_modified_at': datetime_to_str(self.last_modified_at),
-                'last_accessed_at': datetime_to_str(self.last_accessed_at),
-                'tag_names': list(self.tag_names),
-                'document_id': doc_id,
-                'annotation_id': ann_id,
-                'orphaned': len(annotations) > 0 and annotations[0].deleted_at is not None
-        }
+        output = self.__serializer__(self)
+        output['tag_names'] = [t.name for t in self.tags]
+        output['document_id'] = doc_id
+        output['annotation_id'] = ann_id
+        output['orphaned'] = len(annotations) > 0 and annotations[0].deleted_at is not None
+        return output
+
+for model in [Document, Annotation, Tag, Note, DocumentAccessCode]:
+    model.__serializer__ = staticmethod(compile_serializer(model))
+    model.__write_schema__ = compile_write_schema(model)
 
 # Setup Flask-Security
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
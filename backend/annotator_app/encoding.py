@@ -0,0 +1,48 @@
+from flask import make_response
+
+import json
+
+from annotator_app import tracing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+def _orjson_dumps(data):
+    # Entity dictionaries are keyed by integer IDs
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+ENCODERS = {
+    'json': (_json_dumps, json.loads),
+}
+if orjson is not None:
+    ENCODERS['orjson'] = (_orjson_dumps, orjson.loads)
+
+dumps, loads = ENCODERS['orjson' if orjson is not None else 'json']
+
+def set_encoder(name):
+    """ Choose the JSON library used for responses. See `ENCODERS` for the available options. """
+    global dumps, loads
+    dumps, loads = ENCODERS[name]
+
+def encode(data):
+    with tracing.span('encode_json'):
+        return dumps(data)
+
+def json_response(body, code=200, headers=None):
+    """ Response with an already encoded JSON body. """
+    resp = make_response(body, code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = 'application/json'
+    return resp
+
+def output_json(data, code, headers=None):
+    """ Replacement for flask_restful's JSON representation. """
+    return json_response(encode(data), code, headers)
+
+def init_api(api):
+    api.representations['application/json'] = output_json
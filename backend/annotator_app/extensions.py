@@ -1,12 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
 from flask_cors import CORS
 from flask_security import Security
 from flask_mail import Mail
 from flask_migrate import Migrate
 from authlib.integrations.flask_client import OAuth
 
+from annotator_app.replicas import RoutingSession
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Sends the queries of read-only requests to a replica (see `annotator_app.replicas`). """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
 cors = CORS()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 security = Security()
 mail = Mail()
 migrate = Migrate()
@@ -0,0 +1,343 @@
+""" Bulk import of documents from BibTeX or CSV files.
+
+Documents are inserted in batches of `IMPORT_BATCH_SIZE` rows, then their
+details are looked up and their PDFs downloaded by a pool of `IMPORT_WORKERS`
+threads while the rest of the file is being inserted. Entries whose URL is
+already in the user's library, or earlier in the same file, are skipped.
+
+`import_documents` yields progress reports as it goes, so that callers can
+pass them on to the user.
+"""
+from flask import current_app as app
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import datetime
+import io
+import os
+import re
+
+from annotator_app.extensions import db
+from annotator_app import cache, storage, thumbnails
+from annotator_app.database import Document, Tag, documents_tags
+
+class ImportFileError(ValueError):
+    pass
+
+##################################################
+# Parsing
+##################################################
+
+def _read_braced(text, i):
+    """ Value of a brace-delimited BibTeX field starting at text[i] == '{'. Returns (value, index after the value). """
+    depth = 0
+    start = i+1
+    while i < len(text):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i], i+1
+        i += 1
+    raise ImportFileError('Unbalanced braces in BibTeX entry')
+
+def _read_quoted(text, i):
+    depth = 0
+    i += 1
+    start = i
+    while i < len(text):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+        elif text[i] == '"' and depth == 0:
+            return text[start:i], i+1
+        i += 1
+    raise ImportFileError('Unterminated string in BibTeX entry')
+
+def _read_parenthesized(text, i):
+    """ Contents of parentheses starting at text[i] == '('. Returns (contents, index after them). """
+    depth = 0
+    start = i+1
+    while i < len(text):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return text[start:i], i+1
+        i += 1
+    raise ImportFileError('Unbalanced parentheses in BibTeX entry')
+
+_entry_start = re.compile(r'@\s*(\w+)\s*[{(]')
+_field_name = re.compile(r'\s*,?\s*([\w\-:.]+)\s*=\s*')
+_bare_value_end = re.compile(r'[,})#]')
+_concatenation = re.compile(r'\s*#\s*')
+
+def _clean(value):
+    """ Strip the braces used for capitalization and collapse whitespace. """
+    return ' '.join(value.replace('{','').replace('}','').split())
+
+def _read_value(text, i, strings, position):
+    """ Value of a field starting at text[i], with the parts joined by `#` concatenated.
+    Bare words are replaced by the `@string` of that name, if any. Returns (value, index after the value). """
+    parts = []
+    while True:
+        if i >= len(text):
+            raise ImportFileError('Unexpected end of BibTeX entry at position %d' % position)
+        if text[i] == '{':
+            value, i = _read_braced(text, i)
+        elif text[i] == '"':
+            value, i = _read_quoted(text, i)
+        else:
+            end = _bare_value_end.search(text, i)
+            if end is None:
+                raise ImportFileError('Invalid BibTeX entry at position %d' % position)
+            value, i = text[i:end.start()].strip(), end.start()
+            if len(value) == 0:
+                raise ImportFileError('Missing value in BibTeX entry at position %d' % position)
+            value = strings.get(value.lower(), value)
+        parts.append(value)
+        concatenation = _concatenation.match(text, i)
+        if concatenation is None:
+            return ''.join(parts), i
+        i = concatenation.end()
+
+def _read_fields(text, i, strings, position):
+    """ Fields of an entry, from after its key to its closing delimiter. Returns (fields, index after the entry). """
+    fields = {}
+    while True:
+        field = _field_name.match(text, i)
+        if field is None:
+            break
+        value, i = _read_value(text, field.end(), strings, position)
+        fields[field.group(1).lower()] = value
+    end = re.compile(r'\s*,?\s*[})]').match(text, i)
+    if end is None:
+        raise ImportFileError('Invalid BibTeX entry at position %d' % position)
+    return fields, end.end()
+
+def parse_bibtex(text):
+    """ Parse the entries of a BibTeX file into dictionaries of lower-case field names.
+    Each entry also has its `type`, `key`, and the entry's original text as `bibtex`.
+    `@string` abbreviations and `#` concatenation are expanded. """
+    entries = []
+    strings = {}
+    pos = 0
+    while True:
+        match = _entry_start.search(text, pos)
+        if match is None:
+            break
+        entry_type = match.group(1).lower()
+        if entry_type in ('comment', 'preamble'):
+            if text[match.end()-1] == '(':
+                _, pos = _read_parenthesized(text, match.end()-1)
+            else:
+                _, pos = _read_braced(text, match.end()-1)
+            continue
+        if entry_type == 'string':
+            fields, pos = _read_fields(text, match.end(), strings, match.start())
+            strings.update(fields)
+            continue
+        i = match.end()
+        key_end = text.find(',', i)
+        if key_end == -1:
+            raise ImportFileError('Invalid BibTeX entry at position %d' % match.start())
+        entry = {'type': entry_type, 'key': text[i:key_end].strip()}
+        fields, pos = _read_fields(text, key_end, strings, match.start())
+        for name, value in fields.items():
+            entry[name] = _clean(value)
+        entry['bibtex'] = text[match.start():pos].strip()
+        entries.append(entry)
+    return entries
+
+def bibtex_entry_to_document(entry):
+    """ Document fields for a parsed BibTeX entry, or None if the entry has no URL. """
+    url = entry.get('url')
+    if url is None and entry.get('archiveprefix', '').lower() == 'arxiv' and 'eprint' in entry:
+        url = 'https://arxiv.org/pdf/%s' % entry['eprint']
+    if url is None and 'doi' in entry:
+        url = 'https://doi.org/%s' % entry['doi']
+    if url is None:
+        return None
+    return {
+        'url': url,
+        'title': entry.get('title'),
+        'author': entry.get('author'),
+        'bibtex': entry['bibtex'],
+        'tag_names': [t.strip() for t in re.split(r'[,;]', entry.get('keywords', '')) if len(t.strip()) > 0],
+    }
+
+def parse_csv(text):
+    """ Parse a CSV file with a header row.
+    The `url` column is required. `title`, `author`, `bibtex` and `tags` (separated by `;`) are optional. """
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames is None or 'url' not in [f.strip().lower() for f in reader.fieldnames]:
+        raise ImportFileError('CSV file must have a "url" column')
+    documents = []
+    for row in reader:
+        # Fields beyond the header are listed under the key None, and ignored
+        row = {k.strip().lower(): (v or '').strip() for k,v in row.items() if k is not None}
+        if len(row['url']) == 0:
+            documents.append(None)
+            continue
+        documents.append({
+            'url': row['url'],
+            'title': row.get('title') or None,
+            'author': row.get('author') or None,
+            'bibtex': row.get('bibtex') or None,
+            'tag_names': [t.strip() for t in row.get('tags', '').split(';') if len(t.strip()) > 0],
+        })
+    return documents
+
+def parse_file(text, file_format):
+    """ Documents in a `bibtex` or `csv` file. Entries without a URL are None. """
+    if file_format == 'bibtex':
+        return [bibtex_entry_to_document(e) for e in parse_bibtex(text)]
+    elif file_format == 'csv':
+        return parse_csv(text)
+    raise ImportFileError('Unknown import format: %s' % file_format)
+
+def guess_format(file_name):
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return {'.bib': 'bibtex', '.bibtex': 'bibtex', '.csv': 'csv'}.get(extension)
+
+##################################################
+# Import
+##################################################
+
+def _enrich(url, store, key, max_bytes, elsevier_api_key, prefetch_pdf):
+    """ Runs in a worker thread. Look up the document's details and download its PDF. """
+    from annotator_app.resources.documents import fetch_document_details, download_pdf, get_file_hash
+    result = {'details': {}, 'overwrite': set(), 'error': None, 'hash': None}
+    try:
+        result['details'], result['overwrite'] = fetch_document_details(url)
+        if prefetch_pdf and not store.exists(key):
+            output = download_pdf(url, store, key, max_bytes, elsevier_api_key)
+            result['error'] = output.get('error')
+            if 'error' not in output:
+                result['file_name'] = store.local_path(key)
+                result['hash'] = get_file_hash(result['file_name'])
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def _get_tag_ids(user_id, names):
+    """ IDs of the user's tags with the given names, creating the ones that do not exist yet. """
+    tag_ids = {}
+    if len(names) == 0:
+        return tag_ids
+    tags = db.session.query(Tag.id, Tag.name) \
+            .filter_by(user_id=user_id) \
+            .filter(Tag.name.in_(names)) \
+            .all()
+    tag_ids = {name: tag_id for tag_id, name in tags}
+    missing = [{'user_id': user_id, 'name': name} for name in names if name not in tag_ids]
+    if len(missing) > 0:
+        db.session.bulk_insert_mappings(Tag, missing, return_defaults=True)
+        tag_ids.update({t['name']: t['id'] for t in missing})
+    return tag_ids
+
+def import_documents(user_id, documents):
+    """ Add the documents produced by `parse_file` to a user's library.
+
+    Yields a progress dictionary after each batch is inserted and each document is enriched,
+    and a final one with `done` set.
+    """
+    batch_size = app.config.get('IMPORT_BATCH_SIZE', 200)
+    workers = app.config.get('IMPORT_WORKERS', 4)
+    prefetch_pdfs = app.config.get('IMPORT_PREFETCH_PDFS', True)
+    max_bytes = 1024*1024*5 # 5MB
+    elsevier_api_key = app.config.get('ELSEVIER_API_KEY')
+    store = storage.get_storage()
+
+    progress = {
+        'total': len(documents),
+        'imported': 0,
+        'skipped': 0,
+        'enriched': 0,
+        'errors': [],
+        'done': False,
+    }
+
+    # Skip entries without a URL or whose URL is already in the library
+    existing_urls = set(url for (url,) in db.session.query(Document.url)
+            .filter_by(user_id=user_id)
+            .filter_by(deleted_at=None))
+    new_documents = []
+    for i,doc in enumerate(documents):
+        if doc is None:
+            progress['skipped'] += 1
+            progress['errors'].append({'entry': i, 'error': 'No URL'})
+        elif doc['url'] in existing_urls:
+            progress['skipped'] += 1
+        else:
+            existing_urls.add(doc['url'])
+            new_documents.append(doc)
+    yield dict(progress)
+
+    tag_ids = _get_tag_ids(user_id, sorted(set(n for doc in new_documents for n in doc['tag_names'])))
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(new_documents), batch_size):
+            batch = new_documents[start:start+batch_size]
+            now = datetime.datetime.utcnow()
+            rows = [{
+                'user_id': user_id,
+                'url': doc['url'],
+                'title': doc['title'],
+                'author': doc['author'],
+                'bibtex': doc['bibtex'],
+                'read': False,
+                'created_at': now,
+                'last_modified_at': now,
+            } for doc in batch]
+            db.session.execute(Document.__table__.insert(), rows)
+            # Executemany does not return the new IDs, so look them up by URL, which are unique within the import
+            ids = dict(db.session.query(Document.url, Document.id)
+                    .filter_by(user_id=user_id)
+                    .filter_by(created_at=now)
+                    .filter(Document.url.in_([doc['url'] for doc in batch])))
+            tag_rows = [{'document_id': ids[doc['url']], 'tag_id': tag_ids[name]}
+                    for doc in batch for name in doc['tag_names']]
+            if len(tag_rows) > 0:
+                db.session.execute(documents_tags.insert(), tag_rows)
+            db.session.commit()
+            cache.invalidate_user(user_id) # Bulk inserts are not seen by the session's events
+            progress['imported'] += len(batch)
+
+            for doc in batch:
+                doc_id = ids[doc['url']]
+                future = executor.submit(_enrich, doc['url'], store, storage.pdf_key(doc_id), max_bytes,
+                        elsevier_api_key, prefetch_pdfs)
+                pending[future] = (doc_id, doc)
+            yield dict(progress)
+
+        # Apply the details as they come in, a batch at a time
+        updates = []
+        for future in as_completed(pending):
+            doc_id, doc = pending[future]
+            result = future.result()
+            progress['enriched'] += 1
+            if result['error'] is not None:
+                progress['errors'].append({'url': doc['url'], 'error': result['error']})
+            update = {k: v for k,v in result['details'].items()
+                    if k in result['overwrite'] or doc.get(k) is None}
+            if result['hash'] is not None:
+                update['hash'] = result['hash']
+                thumbnails.request_thumbnail(result['file_name'], store, result['hash'])
+            if len(update) > 0:
+                update['id'] = doc_id
+                updates.append(update)
+            if len(updates) >= batch_size or progress['enriched'] == len(pending):
+                if len(updates) > 0:
+                    db.session.bulk_update_mappings(Document, updates)
+                    db.session.commit()
+                    cache.invalidate_user(user_id)
+                    updates = []
+                yield dict(progress)
+
+    progress['done'] = True
+    yield progress
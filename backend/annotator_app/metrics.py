@@ -0,0 +1,214 @@
+""" Request metrics exposed in the Prometheus text format.
+
+Each worker process keeps its own counters and histograms. If
+`METRICS_DIRECTORY` is set, workers periodically write a snapshot to a file
+in that directory, and `/metrics` adds up the snapshots of every worker.
+Snapshots of processes that are no longer running are removed then, so the
+totals drop when a worker is replaced, like the counters of any restarted
+process.
+"""
+from flask import g, request, has_request_context, current_app, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from collections import defaultdict
+from contextlib import contextmanager
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# name -> (type, help text)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled, by route, method and status code.'),
+    'http_request_duration_seconds': ('histogram', 'Time spent handling requests, by route and method.'),
+    'db_queries_total': ('counter', 'Database queries executed, by route.'),
+    'db_query_duration_seconds_total': ('counter', 'Time spent executing database queries, by route.'),
+    'outbound_request_duration_seconds': ('histogram', 'Time spent on HTTP requests to other servers, by host.'),
+    'render_duration_seconds': ('histogram', 'Time spent rendering PDF pages, by kind.'),
+    'compression_input_bytes_total': ('counter', 'Size of response bodies before compression, by encoding.'),
+    'compression_output_bytes_total': ('counter', 'Size of response bodies after compression, by encoding.'),
+    'cache_requests_total': ('counter', 'Cache lookups, by kind of entry and result (local_hit, shared_hit or miss).'),
+    'cache_evictions_total': ('counter', 'Cache entries evicted to stay within the size limit, by tier.'),
+    'db_read_routing_total': ('counter', 'Read-only requests, by database used (replica or primary) and reason.'),
+}
+
+_lock = threading.Lock()
+# name -> labels (tuple of (key,value) pairs) -> value.
+# Histogram values are lists of bucket counts followed by the count and sum.
+_values = defaultdict(dict)
+_last_flush = 0
+_snapshot_file_name = re.compile(r'^metrics-(\d+)\.json$')
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = _labels(labels)
+    with _lock:
+        _values[name][key] = _values[name].get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = _labels(labels)
+    with _lock:
+        hist = _values[name].get(key)
+        if hist is None:
+            hist = [0]*(len(BUCKETS)+2)
+            _values[name][key] = hist
+        for i,b in enumerate(BUCKETS):
+            if value <= b:
+                hist[i] += 1
+        hist[-2] += 1
+        hist[-1] += value
+
+@contextmanager
+def timed(name, **labels):
+    """ Record the time spent in a block in the histogram `name`. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter()-start, **labels)
+
+##################################################
+# Collection
+##################################################
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter()-conn.info['metrics_query_start'].pop()
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_time += duration
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_db_queries = 0
+    g.metrics_db_time = 0
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    duration = time.perf_counter()-g.metrics_start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    method = request.method
+    inc('http_requests_total', route=route, method=method, status=str(response.status_code))
+    observe('http_request_duration_seconds', duration, route=route, method=method)
+    inc('db_queries_total', g.metrics_db_queries, route=route)
+    inc('db_query_duration_seconds_total', g.metrics_db_time, route=route)
+    _maybe_flush()
+    return response
+
+##################################################
+# Aggregation across processes
+##################################################
+
+def _snapshot():
+    with _lock:
+        return {name: [[list(k),v] for k,v in values.items()] for name,values in _values.items()}
+
+def flush():
+    """ Write this process' metrics to `METRICS_DIRECTORY`. """
+    global _last_flush
+    directory = current_app.config.get('METRICS_DIRECTORY')
+    if directory is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    file_name = os.path.join(directory, 'metrics-%d.json' % os.getpid())
+    tmp_file_name = file_name+'.tmp'
+    with open(tmp_file_name, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(tmp_file_name, file_name)
+    _last_flush = time.monotonic()
+
+def _maybe_flush():
+    if time.monotonic()-_last_flush >= current_app.config.get('METRICS_FLUSH_INTERVAL', 5):
+        flush()
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Running as another user
+    return True
+
+def _remove_stale_snapshot(file_name):
+    """ Remove the snapshot if the process that wrote it has exited. Returns True if it was removed. """
+    match = _snapshot_file_name.match(os.path.basename(file_name))
+    if match is None or _is_running(int(match.group(1))):
+        return False
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+    return True
+
+def collect():
+    """ Combine the metrics of all processes. """
+    directory = current_app.config.get('METRICS_DIRECTORY')
+    if directory is None:
+        snapshots = [_snapshot()]
+    else:
+        flush()
+        snapshots = []
+        for file_name in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            if _remove_stale_snapshot(file_name):
+                continue
+            try:
+                with open(file_name) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue # File was removed or is being replaced
+    total = defaultdict(dict)
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            for labels, value in values:
+                key = tuple(tuple(l) for l in labels)
+                if key not in total[name]:
+                    total[name][key] = value
+                elif type(value) is list:
+                    total[name][key] = [a+b for a,b in zip(total[name][key], value)]
+                else:
+                    total[name][key] += value
+    return total
+
+def _format_labels(labels, extra=()):
+    labels = list(labels)+list(extra)
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"')) for k,v in labels)
+
+def render():
+    lines = []
+    for name, values in sorted(collect().items()):
+        metric_type, help_text = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in sorted(values.items()):
+            if metric_type == 'histogram':
+                for b,count in zip(BUCKETS, value):
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', b)]), count))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', '+Inf')]), value[-2]))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), value[-2]))
+                lines.append('%s_sum%s %f' % (name, _format_labels(labels), value[-1]))
+            else:
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    return '\n'.join(lines)+'\n'
+
+def metrics_endpoint():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -0,0 +1,149 @@
+""" Change notifications pushed to a user's open sessions.
+
+Endpoints call `entities_changed` before committing. When the session
+commits, an event ({'type', 'id', 'action', 'revision'}) is published for
+each entity. Events that are never committed are dropped.
+
+Each process delivers events to its own subscribers (the open
+`/api/data/changes` streams). With `NOTIFICATIONS_BROKER = 'postgres'`
+(the default on PostgreSQL) events are sent with NOTIFY in the committing
+transaction, and a thread in each process LISTENs for them, so that every
+worker sees every event. With `'local'` they are only delivered within the
+process that made the change.
+"""
+from flask import current_app as app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from collections import defaultdict, deque
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+CHANNEL = 'annotator_changes'
+MAX_PAYLOAD_EVENTS = 50 # NOTIFY payloads are limited to 8000 bytes
+
+_lock = threading.Lock()
+_subscribers = defaultdict(set) # User ID -> set of Queue
+_recent = deque(maxlen=1000) # (user ID, event), for clients that reconnect
+_listener_pid = None
+_last_revision = 0
+
+def _next_revision():
+    """ Microsecond timestamp, increasing within the process. """
+    global _last_revision
+    with _lock:
+        _last_revision = max(_last_revision+1, time.time_ns()//1000)
+        return _last_revision
+
+def entities_changed(session, user_id, entities, action):
+    """ Publish a change event for each entity when `session` commits. """
+    pending = session.info.setdefault('pending_notifications', [])
+    for entity in entities:
+        pending.append((user_id, {
+            'type': entity.__tablename__,
+            'id': entity.id,
+            'action': action,
+        }))
+
+def _broker():
+    default = 'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres') else 'local'
+    return app.config.get('NOTIFICATIONS_BROKER', default)
+
+##################################################
+# Publishing
+##################################################
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    pending = session.info.get('pending_notifications')
+    if not pending:
+        return
+    for _,e in pending:
+        e['revision'] = _next_revision()
+    if _broker() != 'postgres':
+        return
+    # Sent with the transaction, so listeners only see committed changes
+    for i in range(0, len(pending), MAX_PAYLOAD_EVENTS):
+        payload = json.dumps([[user_id, e] for user_id,e in pending[i:i+MAX_PAYLOAD_EVENTS]], separators=(',',':'))
+        session.execute('SELECT pg_notify(:channel, :payload)', {'channel': CHANNEL, 'payload': payload})
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop('pending_notifications', None)
+    if pending and _broker() != 'postgres':
+        for user_id, e in pending:
+            _deliver(user_id, e)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('pending_notifications', None)
+
+def _deliver(user_id, e):
+    with _lock:
+        _recent.append((user_id, e))
+        subscribers = list(_subscribers.get(user_id, ()))
+    for q in subscribers:
+        q.put(e)
+
+##################################################
+# Subscribing
+##################################################
+
+def subscribe(user_id):
+    """ Queue that receives the user's events until `unsubscribe` is called. """
+    if _broker() == 'postgres':
+        _start_listener(app._get_current_object())
+    q = queue.Queue()
+    with _lock:
+        _subscribers[user_id].add(q)
+    return q
+
+def unsubscribe(user_id, q):
+    with _lock:
+        _subscribers[user_id].discard(q)
+        if len(_subscribers[user_id]) == 0:
+            del _subscribers[user_id]
+
+def recent_events(user_id, since):
+    """ The user's events that this process has seen with a revision after `since`. """
+    with _lock:
+        return [e for u,e in _recent if u == user_id and e['revision'] > since]
+
+def _start_listener(app):
+    """ Start the LISTEN thread of this process. Started lazily, so that each forked worker has its own. """
+    global _listener_pid
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    thread = threading.Thread(target=_listen, args=(app,), daemon=True)
+    thread.start()
+
+def _listen(app):
+    with app.app_context():
+        engine = app.extensions['sqlalchemy'].db.engine
+    while True:
+        try:
+            connection = engine.raw_connection()
+            try:
+                connection.detach() # Not returned to the pool
+                pg = connection.connection
+                pg.set_isolation_level(0) # Autocommit
+                pg.cursor().execute('LISTEN %s' % CHANNEL)
+                while True:
+                    if select.select([pg], [], [], 30) == ([], [], []):
+                        continue
+                    pg.poll()
+                    while pg.notifies:
+                        notify = pg.notifies.pop(0)
+                        for user_id, e in json.loads(notify.payload):
+                            _deliver(user_id, e)
+            finally:
+                connection.close()
+        except Exception:
+            app.logger.exception('Change notification listener failed. Reconnecting.')
+            time.sleep(5)
@@ -0,0 +1,115 @@
+from flask import current_app
+from flask_mail import Message
+
+import datetime
+import threading
+import time
+
+from annotator_app.extensions import db, mail
+from annotator_app.database import EmailOutbox
+
+_sender_thread = None
+_sender_lock = threading.Lock()
+_wake_event = threading.Event()
+
+def queue_email(recipient, subject, body, sender=None):
+    """ Add an email to the outbox. The email is only sent once the current
+    transaction is committed. """
+    if sender is None:
+        sender = current_app.config['MAIL_USERNAME']
+    entry = EmailOutbox(
+            sender=sender,
+            recipient=recipient,
+            subject=subject,
+            body=body,
+            attempts=0,
+            next_attempt_at=datetime.datetime.utcnow()
+    )
+    db.session.add(entry)
+    return entry
+
+def deliver_pending(batch_size=None):
+    """ Send a batch of queued emails over a single SMTP connection.
+
+    Returns the number of emails that were sent successfully.
+    """
+    config = current_app.config
+    if batch_size is None:
+        batch_size = config.get('OUTBOX_BATCH_SIZE', 50)
+    max_attempts = config.get('OUTBOX_MAX_ATTEMPTS', 5)
+    retry_delay = config.get('OUTBOX_RETRY_DELAY', 60)
+
+    now = datetime.datetime.utcnow()
+    # Lock the rows so that senders in other processes skip over them
+    entries = db.session.query(EmailOutbox) \
+            .filter(EmailOutbox.sent_at.is_(None)) \
+            .filter(EmailOutbox.attempts < max_attempts) \
+            .filter(EmailOutbox.next_attempt_at <= now) \
+            .order_by(EmailOutbox.id) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+    if len(entries) == 0:
+        db.session.commit()
+        return 0
+
+    sent = 0
+    try:
+        with mail.connect() as conn:
+            for entry in entries:
+                msg = Message(entry.subject,
+                        sender=entry.sender,
+                        recipients=[entry.recipient],
+                        body=entry.body)
+                try:
+                    conn.send(msg)
+                except Exception as e:
+                    _record_failure(entry, e, retry_delay)
+                    continue
+                entry.sent_at = datetime.datetime.utcnow()
+                sent += 1
+    except Exception as e: # Unable to connect to the mail server
+        for entry in entries:
+            if entry.sent_at is None:
+                _record_failure(entry, e, retry_delay)
+
+    db.session.commit()
+    return sent
+
+def _record_failure(entry, error, retry_delay):
+    entry.attempts += 1
+    entry.last_error = str(error)[:1000]
+    # Exponential backoff
+    delay = retry_delay * 2**(entry.attempts-1)
+    entry.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+def run_sender(app, stop_event=None):
+    """ Deliver queued emails until `stop_event` is set. Sleeps between batches
+    unless woken up by `wake()`. """
+    interval = app.config.get('OUTBOX_POLL_INTERVAL', 30)
+    while stop_event is None or not stop_event.is_set():
+        _wake_event.clear()
+        with app.app_context():
+            try:
+                # Keep going while there are full batches to send
+                while deliver_pending() >= app.config.get('OUTBOX_BATCH_SIZE', 50):
+                    pass
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception('Error delivering emails: %s', e)
+            finally:
+                db.session.remove()
+        _wake_event.wait(interval)
+
+def wake():
+    """ Notify the background sender that new emails were queued, starting it if
+    it isn't running in this process yet. """
+    global _sender_thread
+    with _sender_lock:
+        if _sender_thread is None or not _sender_thread.is_alive():
+            app = current_app._get_current_object()
+            _sender_thread = threading.Thread(
+                    target=run_sender, args=(app,),
+                    name='email-outbox', daemon=True)
+            _sender_thread.start()
+    _wake_event.set()
@@ -0,0 +1,126 @@
+""" Profiling of individual requests, on demand.
+
+A user with the `PROFILER_ROLE` role can profile a request by sending it with
+the `X-Profile` header or the `_profile` query parameter set to:
+
+- `cprofile`: deterministic profile with `cProfile`, saved as a `.prof` file
+  (open with `pstats`, snakeviz, etc.).
+- `sample`: the request's thread is sampled every `PROFILER_INTERVAL` seconds,
+  and the stacks are saved in the collapsed format (`.folded`) read by
+  flamegraph.pl and speedscope.
+
+The response has an `X-Profile-URL` header linking to the file, which only
+users with the role can download. Only the `PROFILER_MAX_FILES` newest files
+are kept.
+"""
+from flask import g, request, current_app, send_from_directory, abort, url_for
+from flask_security import current_user
+
+from collections import Counter
+import cProfile
+import datetime
+import glob
+import os
+import re
+import sys
+import threading
+
+from annotator_app import tracing
+
+MODES = {'cprofile': '.prof', 'sample': '.folded'}
+
+_file_name_format = re.compile(r'^[\w\-]+\.(prof|folded)$')
+
+def _directory():
+    return current_app.config.get('PROFILER_DIRECTORY', os.path.join(current_app.instance_path, 'profiles'))
+
+def _is_allowed():
+    return current_user.is_authenticated and current_user.has_role(current_app.config.get('PROFILER_ROLE', 'admin'))
+
+class Sampler(object):
+    """ Records the stack of a thread at regular intervals. """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+def _before_request():
+    mode = request.headers.get('X-Profile') or request.args.get('_profile')
+    if mode is None or mode not in MODES or not _is_allowed():
+        return
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # Another profiler is active in this thread
+            return
+    else:
+        profiler = Sampler(threading.get_ident(), current_app.config.get('PROFILER_INTERVAL', 0.005))
+        profiler.start()
+    g.profiler = (mode, profiler)
+
+def _after_request(response):
+    if 'profiler' not in g:
+        return response
+    mode, profiler = g.pop('profiler')
+    if mode == 'cprofile':
+        profiler.disable()
+        save = profiler.dump_stats
+    else:
+        profiler.stop()
+        save = profiler.save
+
+    directory = _directory()
+    os.makedirs(directory, exist_ok=True)
+    name = '%s-%s%s' % (datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'),
+            tracing.request_id() or os.urandom(8).hex(), MODES[mode])
+    save(os.path.join(directory, name))
+    _remove_old_files(directory)
+    response.headers['X-Profile-URL'] = url_for('profile', name=name, _external=True)
+    return response
+
+def _remove_old_files(directory):
+    files = sorted(glob.glob(os.path.join(directory, '*.prof'))+glob.glob(os.path.join(directory, '*.folded')),
+            key=os.path.getmtime)
+    for file_name in files[:-current_app.config.get('PROFILER_MAX_FILES', 100)]:
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
+
+def profile_endpoint(name):
+    if not _is_allowed() or _file_name_format.match(name) is None:
+        abort(404)
+    return send_from_directory(_directory(), name, as_attachment=True)
+
+def init_app(app):
+    if not app.config.get('PROFILER_ENABLED', True):
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/api/profiles/<name>', 'profile', profile_endpoint)
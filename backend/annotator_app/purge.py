@@ -0,0 +1,238 @@
+""" Hard-deletion of soft-deleted entities.
+
+Deleting a document, annotation, note or tag only sets its `deleted_at`, so that
+it can be restored. Once it has been deleted for more than
+`PURGE_RETENTION_DAYS` days, `purge_deleted` removes the row, the rows that
+refer to it in the join tables, and the files cached for it. Rows are deleted
+in batches of `PURGE_BATCH_SIZE`, each in its own transaction, so that the
+tables are never locked for long. Cached files that no longer belong to any
+document are removed as well.
+"""
+from flask import current_app
+
+import datetime
+import re
+import time
+
+from annotator_app.extensions import db
+from annotator_app.database import Annotation, Document, DocumentAccessCode, Note, Tag, \
+        annotations_tags, documents_tags, notes_tags
+from annotator_app import annotated_pdf, cache, storage, thumbnails
+
+_pdf_key_format = re.compile(r'^(\d+)\.pdf$')
+_annotated_key_format = re.compile(r'^%s([0-9a-f]+)-[0-9a-f]+\.pdf$' % annotated_pdf.KEY_PREFIX)
+_thumbnail_key_format = re.compile(r'^%s([0-9a-f]+)\.webp$' % thumbnails.KEY_PREFIX)
+
+def _new_report():
+    return {
+        'documents': 0,
+        'annotations': 0,
+        'notes': 0,
+        'tags': 0,
+        'join_rows': 0,
+        'files': 0,
+        'bytes': 0,
+    }
+
+def _remove_file(store, key, report):
+    size = store.delete(key)
+    if size is None:
+        return
+    report['files'] += 1
+    report['bytes'] += size
+
+def _delete_where_in(table, column, ids):
+    return db.session.execute(table.delete().where(column.in_(ids))).rowcount
+
+def _expired_ids(model, cutoff, batch_size):
+    rows = db.session.query(model.id) \
+            .filter(model.deleted_at < cutoff) \
+            .order_by(model.id) \
+            .limit(batch_size) \
+            .all()
+    return [r[0] for r in rows]
+
+##################################################
+# Rows
+##################################################
+
+def _purge_annotations(ids, report):
+    report['join_rows'] += _delete_where_in(annotations_tags, annotations_tags.c.annotation_id, ids)
+    report['annotations'] += db.session.query(Annotation) \
+            .filter(Annotation.id.in_(ids)) \
+            .delete(synchronize_session=False)
+
+def _purge_documents(ids, report):
+    """ Also removes the documents' annotations, and the notes of both, which cannot be reached without them. """
+    annotations = db.session.query(Annotation.id, Annotation.note_id).filter(Annotation.doc_id.in_(ids)).all()
+    note_ids = {note_id for _, note_id in annotations if note_id is not None}
+    note_ids |= {r[0] for r in db.session.query(Document.note_id) \
+            .filter(Document.id.in_(ids)) \
+            .filter(Document.note_id.isnot(None)) \
+            .all()}
+    if len(annotations) > 0:
+        _purge_annotations([annotation_id for annotation_id, _ in annotations], report)
+    report['join_rows'] += _delete_where_in(documents_tags, documents_tags.c.document_id, ids)
+    report['join_rows'] += db.session.query(DocumentAccessCode) \
+            .filter(DocumentAccessCode.document_id.in_(ids)) \
+            .delete(synchronize_session=False)
+    hashes = {r[0] for r in db.session.query(Document.hash).filter(Document.id.in_(ids)).all()}
+    report['documents'] += db.session.query(Document) \
+            .filter(Document.id.in_(ids)) \
+            .delete(synchronize_session=False)
+    if len(note_ids) > 0:
+        # Keep the notes that are still linked from documents or annotations that remain
+        for model in [Document, Annotation]:
+            note_ids -= {r[0] for r in db.session.query(model.note_id).filter(model.note_id.in_(note_ids)).all()}
+    if len(note_ids) > 0:
+        _purge_notes(sorted(note_ids), report)
+    return hashes
+
+def _purge_notes(ids, report):
+    """ Documents and annotations that still link to the notes are unlinked from them. """
+    for model in [Document, Annotation]:
+        db.session.query(model) \
+                .filter(model.note_id.in_(ids)) \
+                .update({model.note_id: None}, synchronize_session=False)
+    report['join_rows'] += _delete_where_in(notes_tags, notes_tags.c.note_id, ids)
+    report['notes'] += db.session.query(Note) \
+            .filter(Note.id.in_(ids)) \
+            .delete(synchronize_session=False)
+
+def _purge_tags(ids, report):
+    for table, column in [(documents_tags, documents_tags.c.tag_id),
+            (annotations_tags, annotations_tags.c.tag_id),
+            (notes_tags, notes_tags.c.tag_id)]:
+        report['join_rows'] += _delete_where_in(table, column, ids)
+    report['tags'] += db.session.query(Tag) \
+            .filter(Tag.id.in_(ids)) \
+            .delete(synchronize_session=False)
+
+##################################################
+# Files
+##################################################
+
+def _unused_hashes(hashes):
+    hashes = [h for h in hashes if h is not None]
+    if len(hashes) == 0:
+        return set()
+    used = {r[0] for r in db.session.query(Document.hash).filter(Document.hash.in_(hashes)).all()}
+    return set(hashes) - used
+
+def _remove_rendered_files(store, hashes, report):
+    """ Remove the annotated PDFs and thumbnails rendered from PDFs with the given hashes. """
+    if len(hashes) == 0:
+        return
+    for prefix, key_format in [(annotated_pdf.KEY_PREFIX, _annotated_key_format),
+            (thumbnails.KEY_PREFIX, _thumbnail_key_format)]:
+        for key, _ in list(store.list(prefix)):
+            match = key_format.match(key)
+            if match is not None and match.group(1) in hashes:
+                _remove_file(store, key, report)
+
+def remove_orphaned_files(report, batch_size):
+    """ Remove stored PDFs of documents that do not exist, and files rendered from content that no document has. """
+    store = storage.get_storage()
+    files = {}
+    hashes = set()
+    # PDFs are at the top level, and rendered files each under their prefix
+    for key, _ in list(store.list('', recursive=False)):
+        match = _pdf_key_format.match(key)
+        if match is not None:
+            files[int(match.group(1))] = key
+    for prefix, key_format in [(annotated_pdf.KEY_PREFIX, _annotated_key_format),
+            (thumbnails.KEY_PREFIX, _thumbnail_key_format)]:
+        for key, _ in list(store.list(prefix)):
+            match = key_format.match(key)
+            if match is not None:
+                hashes.add(match.group(1))
+
+    ids = sorted(files.keys())
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i+batch_size]
+        existing = {r[0] for r in db.session.query(Document.id).filter(Document.id.in_(batch)).all()}
+        for document_id in batch:
+            if document_id not in existing:
+                _remove_file(store, files[document_id], report)
+
+    hashes = sorted(hashes)
+    unused = set()
+    for i in range(0, len(hashes), batch_size):
+        unused |= _unused_hashes(hashes[i:i+batch_size])
+    _remove_rendered_files(store, unused, report)
+    db.session.commit()
+
+##################################################
+# Purge
+##################################################
+
+def purge_deleted(retention_days=None, batch_size=None):
+    """ Hard-delete the entities that were soft-deleted more than `retention_days` days ago.
+
+    Returns a report of the number of rows deleted from each table, and of the number and total size of the files removed.
+    """
+    config = current_app.config
+    if retention_days is None:
+        retention_days = config.get('PURGE_RETENTION_DAYS', 30)
+    if batch_size is None:
+        batch_size = config.get('PURGE_BATCH_SIZE', 500)
+    cutoff = datetime.date.today() - datetime.timedelta(days=retention_days)
+    store = storage.get_storage()
+    report = _new_report()
+    start = time.perf_counter()
+
+    # Documents first, since purging them also purges their annotations
+    for model, purge in [(Document, _purge_documents), (Annotation, _purge_annotations),
+            (Note, _purge_notes), (Tag, _purge_tags)]:
+        while True:
+            ids = _expired_ids(model, cutoff, batch_size)
+            if len(ids) == 0:
+                break
+            users = {r[0] for r in db.session.query(model.user_id).filter(model.id.in_(ids)).distinct()}
+            try:
+                hashes = purge(ids, report)
+                unused = _unused_hashes(hashes) if model is Document else set()
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            # Deleted with queries, which the session's events do not see
+            for user_id in users:
+                cache.invalidate_user(user_id)
+            # Files are only removed once the rows are gone, so a failed batch leaves nothing missing
+            if model is Document:
+                for document_id in ids:
+                    _remove_file(store, storage.pdf_key(document_id), report)
+                _remove_rendered_files(store, unused, report)
+            if len(ids) < batch_size:
+                break
+
+    remove_orphaned_files(report, batch_size)
+    report['seconds'] = time.perf_counter()-start
+    return report
+
+def compact():
+    """ Return the space freed by the purge to the database (PostgreSQL: `VACUUM ANALYZE`, SQLite: `VACUUM`). """
+    tables = [Document.__tablename__, Annotation.__tablename__, Note.__tablename__, Tag.__tablename__,
+            documents_tags.name, annotations_tags.name, notes_tags.name]
+    engine = db.get_engine()
+    # VACUUM cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if engine.dialect.name == 'postgresql':
+            for table in tables:
+                conn.execute('VACUUM ANALYZE %s' % table)
+        elif engine.dialect.name == 'sqlite':
+            conn.execute('VACUUM')
+
+def run_purge(app):
+    """ Purge once and log the report. """
+    with app.app_context():
+        try:
+            report = purge_deleted()
+            if app.config.get('PURGE_COMPACT', False):
+                compact()
+        finally:
+            db.session.remove()
+    app.logger.info('Purged %(documents)d documents, %(annotations)d annotations, %(notes)d notes, %(tags)d tags '
+            'and %(join_rows)d linked rows, and removed %(files)d files (%(bytes)d bytes) in %(seconds).1fs' % report)
+    return report
@@ -0,0 +1,77 @@
+""" Detection of repeated queries (N+1 query patterns) within a request.
+
+Statements are grouped by their normalized SQL. When a statement shape runs
+more than `QUERY_TRACKER_THRESHOLD` times in one request, a warning listing the
+call sites is logged at the end of the request, or, if `QUERY_TRACKER_RAISE`
+is set, `RepeatedQueryError` is raised where the offending query is made.
+
+Enabled by `QUERY_TRACKER_ENABLED`, which defaults to the app's debug mode.
+"""
+from flask import g, request, has_request_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from collections import Counter
+import os
+import re
+import traceback
+
+class RepeatedQueryError(Exception):
+    pass
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_IGNORED_FILES = {os.path.abspath(__file__), os.path.join(_PACKAGE_DIR, 'metrics.py')}
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list = re.compile(r'\bIN \((?:[^()]*)\)', re.IGNORECASE)
+_whitespace = re.compile(r'\s+')
+
+def normalize(statement):
+    """ Reduce a statement to its shape, so that queries that only differ in their parameters compare equal. """
+    statement = _string_literal.sub('?', statement)
+    statement = _number_literal.sub('?', statement)
+    statement = _in_list.sub('IN (...)', statement)
+    return _whitespace.sub(' ', statement).strip()
+
+def _call_site(limit=3):
+    """ The innermost frames of the stack that are in this package. """
+    frames = [f for f in traceback.extract_stack()
+            if f.filename.startswith(_PACKAGE_DIR) and f.filename not in _IGNORED_FILES]
+    return tuple('%s:%d in %s' % (os.path.relpath(f.filename, _PACKAGE_DIR), f.lineno, f.name)
+            for f in frames[-limit:])
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or 'query_tracker' not in g:
+        return
+    shape = normalize(statement)
+    counts, call_sites = g.query_tracker
+    counts[shape] += 1
+    call_sites.setdefault(shape, Counter())[_call_site()] += 1
+    threshold = current_app.config.get('QUERY_TRACKER_THRESHOLD', 5)
+    if counts[shape] > threshold and current_app.config.get('QUERY_TRACKER_RAISE', False):
+        raise RepeatedQueryError('Query executed %d times in %s %s: %s' % (
+            counts[shape], request.method, request.path, shape))
+
+def _before_request():
+    if current_app.config.get('QUERY_TRACKER_ENABLED', current_app.debug):
+        g.query_tracker = (Counter(), {})
+
+def _after_request(response):
+    if 'query_tracker' not in g:
+        return response
+    counts, call_sites = g.query_tracker
+    threshold = current_app.config.get('QUERY_TRACKER_THRESHOLD', 5)
+    for shape, count in counts.items():
+        if count <= threshold:
+            continue
+        sites = '\n'.join('    %dx %s' % (n, ' <- '.join(reversed(site)) or '<outside annotator_app>')
+                for site, n in call_sites[shape].most_common())
+        current_app.logger.warning('Repeated query: executed %d times in %s %s\n  %s\n  Call sites:\n%s',
+                count, request.method, request.path, shape, sites)
+    return response
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,172 @@
+""" Routing of read-only requests to read replicas.
+
+With `SQLALCHEMY_REPLICA_URIS` set, the endpoints decorated with `read_only`
+send their queries to one of the replicas. Everything else goes to the
+primary (`SQLALCHEMY_DATABASE_URI`), as do the queries of a request made after
+it has flushed a write.
+
+A request that commits a write sets `_primary_until` in the session cookie,
+so that the same client's reads go to the primary for the next
+`REPLICA_STICKY_SECONDS` seconds and see its own writes.
+
+Each process checks a replica at most every `REPLICA_CHECK_INTERVAL` seconds,
+giving up on connecting after `REPLICA_CONNECT_TIMEOUT` seconds, since the
+check delays the request that makes it.
+A replica that cannot be reached, or whose replication lags more than
+`REPLICA_MAX_LAG` seconds, is skipped until its next check. If a query on a
+replica fails, the replica is skipped and the request is handled again on the
+primary.
+"""
+from flask import g, session, current_app, has_request_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session
+
+import functools
+import random
+import threading
+import time
+
+from annotator_app import metrics
+
+class RoutingSession(SignallingSession):
+    """ Session that uses the replica chosen for the current request, if any. """
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.info.get('wrote') and has_request_context():
+            engine = g.get('db_replica')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.get('wrote') and has_request_context():
+        g.db_wrote = True
+
+def _replication_lag(conn):
+    """ Seconds the replica is behind its primary. """
+    if conn.dialect.name == 'postgresql':
+        return conn.execute('''
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END''').scalar()
+    conn.execute('SELECT 1')
+    return 0
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = 0
+        self.lag = 0
+
+def _engine_options(app, uri):
+    """ Options of the primary's engine, with a timeout for connecting to the replica at `uri`. """
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    if make_url(uri).get_backend_name() in ('postgresql', 'mysql'):
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args.setdefault('connect_timeout', app.config.get('REPLICA_CONNECT_TIMEOUT', 2))
+        options['connect_args'] = connect_args
+    return options
+
+class ReplicaPool(object):
+    def __init__(self, app, uris):
+        self.replicas = [Replica(create_engine(uri, **_engine_options(app, uri))) for uri in uris]
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', 5)
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 5)
+        self.logger = app.logger
+        self._lock = threading.Lock()
+
+    def _check(self, replica):
+        try:
+            with replica.engine.connect() as conn:
+                replica.lag = float(_replication_lag(conn))
+            healthy = replica.lag <= self.max_lag
+            if not healthy:
+                self.logger.warning('Replica %s lags by %.1fs', replica.engine.url, replica.lag)
+        except exc.DBAPIError as e:
+            self.logger.warning('Replica %s is unavailable: %s', replica.engine.url, e)
+            healthy = False
+        replica.healthy = healthy
+
+    def choose(self):
+        """ Engine of a random healthy replica, or None. """
+        now = time.monotonic()
+        for replica in self.replicas:
+            with self._lock:
+                due = now-replica.checked_at >= self.check_interval
+                if due:
+                    replica.checked_at = now
+            if due:
+                self._check(replica)
+        healthy = [r for r in self.replicas if r.healthy]
+        if len(healthy) == 0:
+            return None
+        return random.choice(healthy).engine
+
+    def mark_down(self, engine):
+        for replica in self.replicas:
+            if replica.engine is engine:
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+
+def _choose_replica():
+    pool = current_app.extensions.get('replicas')
+    if pool is None:
+        return None
+    if session.get('_primary_until', 0) > time.time():
+        metrics.inc('db_read_routing_total', target='primary', reason='sticky')
+        return None
+    engine = pool.choose()
+    if engine is None:
+        metrics.inc('db_read_routing_total', target='primary', reason='no_replica')
+    else:
+        metrics.inc('db_read_routing_total', target='replica', reason='read_only')
+    return engine
+
+def read_only(f):
+    """ Decorator for endpoint methods that only read, so that their queries can go to a replica. """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if 'db_replica' in g: # Already routed, e.g. by an overridden method calling `super()`
+            return f(*args, **kwargs)
+        g.db_replica = _choose_replica()
+        if g.db_replica is None:
+            return f(*args, **kwargs)
+        try:
+            return f(*args, **kwargs)
+        except (exc.OperationalError, exc.InterfaceError) as e:
+            engine = g.db_replica
+            current_app.logger.warning('Query on replica %s failed, retrying on the primary: %s', engine.url, e)
+            current_app.extensions['replicas'].mark_down(engine)
+            metrics.inc('db_read_routing_total', target='primary', reason='replica_failed')
+            current_app.extensions['sqlalchemy'].db.session.rollback()
+            g.db_replica = None
+            return f(*args, **kwargs)
+    return wrapper
+
+def reading_from_replica():
+    """ Whether the current request's reads go to a replica. """
+    return has_request_context() and g.get('db_replica') is not None
+
+def max_staleness():
+    """ Upper bound on how far behind the primary a replica in use can be, in seconds. """
+    return current_app.config.get('REPLICA_MAX_LAG', 5) + current_app.config.get('REPLICA_CHECK_INTERVAL', 5)
+
+def _after_request(response):
+    if g.get('db_wrote') and not current_app.session_interface.is_null_session(session):
+        session['_primary_until'] = time.time() + current_app.config.get('REPLICA_STICKY_SECONDS', 10)
+    return response
+
+def init_app(app):
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+    if not uris:
+        return
+    app.extensions['replicas'] = ReplicaPool(app, uris)
+    app.after_request(_after_request)
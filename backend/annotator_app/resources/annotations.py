@@ -1,41 +1,108 @@
-from flask import Blueprint, send_file, make_response
+from flask import Blueprint, send_file, make_response, request
+from flask import current_app as app
 from flask_restful import Api, Resource
 from flask_security import current_user
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import func
 
-from pdf2image import convert_from_path
 import datetime
 import json
 from io import BytesIO
 
 from annotator_app.extensions import db
-from annotator_app.database import Annotation, Document
-from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint
-from annotator_app.resources.documents import fetch_pdf
+from annotator_app import cache, encoding, metrics, tracing
+from annotator_app.replicas import read_only
+from annotator_app.database import Annotation, Document, Note
+from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint, entities_to_dict, annotations_by_note
+from annotator_app.resources.documents import fetch_pdf, get_document_hash
 
 blueprint = Blueprint('annotations', __name__)
 api = Api(blueprint)
+encoding.init_api(api)
 
 def to_object(data):
     entity = Annotation(**data)
     entity.user_id = current_user.id
-    entity.position = json.dumps(data['position'])
     return entity
 
 def update_object(entity,data):
-    for k in ['doc_id','page','type','blob','parser']:
+    for k in ['doc_id','page','type','position']:
         if k in data:
             entity.__setattr__(k,data[k])
-    if 'position' in data:
-        entity.position = json.dumps(data['position'])
     if 'deleted_at' in data and data['deleted_at'] is not None:
         entity.deleted_at = datetime.datetime.strptime(data['deleted_at'], "%Y-%m-%d").date()
     return entity
 
+def parse_page_range(pages):
+    """ Parse a page range of the form "10-14" or "10" into a (first, last) tuple. """
+    first, _, last = pages.partition('-')
+    first = int(first)
+    last = int(last) if last else first
+    if first > last:
+        raise ValueError('Invalid page range: %s' % pages)
+    return first, last
+
 class AnnotationList(ListEndpoint):
     class Meta:
         model = Annotation
+        filterable_params = ['doc_id']
         to_object = to_object
         update_object = update_object
+    @read_only
+    def get(self):
+        """ If a `pages` query parameter is given (e.g. `?doc_id=1&pages=10-14`),
+        return only the annotations on those pages of the document, along with their notes. """
+        pages = request.args.get('pages')
+        if pages is None:
+            return super().get()
+        try:
+            doc_id = int(request.args['doc_id'])
+            first_page, last_page = parse_page_range(pages)
+        except (KeyError, ValueError):
+            return {
+                'error': 'A doc_id and a page range of the form "first-last" are required.'
+            }, 400
+
+        annotations = db.session.query(Annotation) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(doc_id=doc_id) \
+                .filter_by(deleted_at=None) \
+                .filter(Annotation.page.between(first_page, last_page)) \
+                .all()
+        output = entities_to_dict(annotations)
+        # Notes with their tags, and the annotations they are attached to, in as few queries as in `document_entities`
+        note_ids = [a.note_id for a in annotations if a.note_id is not None]
+        if len(note_ids) > 0:
+            notes = db.session.query(Note) \
+                    .options(joinedload(Note.tags)) \
+                    .filter_by(user_id=current_user.id) \
+                    .filter(Note.id.in_(note_ids)) \
+                    .all()
+            note_annotations = annotations_by_note(note_ids)
+            for note in notes:
+                output['notes'][note.id] = note.to_dict(annotations=note_annotations[note.id])
+        return {
+            'entities': output
+        }, 200
+
+class AnnotationPageCountsEndpoint(Resource):
+    @read_only
+    def get(self):
+        """ Number of annotations on each page of a document, as `{page: count}`. """
+        doc_id = request.args.get('doc_id', type=int)
+        if doc_id is None:
+            return {
+                'error': 'Query parameter doc_id is required.'
+            }, 400
+        counts = db.session.query(Annotation.page, func.count(Annotation.id)) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(doc_id=doc_id) \
+                .filter_by(deleted_at=None) \
+                .group_by(Annotation.page) \
+                .all()
+        return {
+            'page_counts': {page: count for page,count in counts}
+        }, 200
 
 class AnnotationEndpoint(EntityEndpoint):
     class Meta:
@@ -47,11 +114,66 @@ class AnnotationEndpoint(EntityEndpoint):
                 .filter_by(id=entity.doc_id) \
                 .first()
         if doc is None:
-            print('Error: Unable to find document associated with annotation %d' % entity.id)
+            app.logger.error('Unable to find document associated with annotation %d', entity.id)
 
         doc.last_modified_at = datetime.datetime.utcnow()
         return [entity]
 
+class AnnotationRegionEndpoint(Resource):
+    @read_only
+    def get(self):
+        """ Annotations on a page whose bounding box intersects a region.
+
+        Query parameters: `doc_id`, `page`, and the region's `left`, `top`, `right` and `bottom` in PDF coordinates.
+        Omitted region bounds are unbounded.
+        """
+        try:
+            doc_id = int(request.args['doc_id'])
+            page = int(request.args['page'])
+            bounds = {k: float(request.args[k])
+                    for k in ['left','top','right','bottom'] if k in request.args}
+        except (KeyError, ValueError):
+            return {
+                'error': 'Query parameters doc_id and page are required, and region bounds must be numbers.'
+            }, 400
+
+        query = db.session.query(Annotation) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(doc_id=doc_id) \
+                .filter_by(page=page) \
+                .filter_by(deleted_at=None)
+        if 'right' in bounds:
+            query = query.filter(Annotation.bbox_left <= bounds['right'])
+        if 'left' in bounds:
+            query = query.filter(Annotation.bbox_right >= bounds['left'])
+        if 'bottom' in bounds:
+            query = query.filter(Annotation.bbox_top <= bounds['bottom'])
+        if 'top' in bounds:
+            query = query.filter(Annotation.bbox_bottom >= bounds['top'])
+        return {
+            'entities': entities_to_dict(query.all())
+        }, 200
+
+def render_annotation_image(file_name, page, box):
+    """ JPEG of the region `box` (top, right, bottom, left) of a page of a PDF. """
+    # Extract relevant portion of image
+    scale = 3
+    from pdf2image import convert_from_path # Slow to import, and only needed here
+    with metrics.timed('render_duration_seconds', kind='annotation'), \
+            tracing.span('render_page', page=page):
+        images = convert_from_path(file_name,
+                # FIXME: Hacky solution. I got the dpi from trial and error.
+                dpi=72*scale,
+                first_page=page,
+                last_page=page
+        )
+    box = [box[3],box[0],box[1],box[2]] # left, top, right, bottom
+    box = [x*scale for x in box] # rescale
+    cropped_image = images[0].crop(box)
+    img_io = BytesIO()
+    cropped_image.save(img_io, 'JPEG', quality=70)
+    return img_io.getvalue()
+
 class AnnotationImageEndpoint(Resource):
     def get(self, entity_id):
         # Get annotation
@@ -82,23 +204,12 @@ class AnnotationImageEndpoint(Resource):
             }, output['code']
         # Render relevant page to image
         file_name = output['file_name']
-        # Extract relevant portion of image
-        scale = 3
-        images = convert_from_path(file_name,
-                # FIXME: Hacky solution. I got the dpi from trial and error.
-                dpi=72*scale,
-                first_page=int(annotation.page),
-                last_page=int(annotation.page)
-        )
-        position = json.loads(annotation.position)
-        box = position['box'] # top, right, bottom, left
-        box = [box[3],box[0],box[1],box[2]] # left, top, right, bottom
-        box = [x*scale for x in box] # rescale
-        cropped_image = images[0].crop(box)
-        # Return image
-        img_io = BytesIO()
-        cropped_image.save(img_io, 'JPEG', quality=70)
-        img_io.seek(0)
+        box = annotation.position['box'] # top, right, bottom, left
+        key = 'render:%s:%d:%s' % (get_document_hash(document, file_name), annotation.page, ','.join(map(str, box)))
+        # Shared tier only, since images are large
+        image = cache.get_or_set('render', key,
+                lambda: render_annotation_image(file_name, annotation.page, box), local=False)
+        img_io = BytesIO(image)
         response = make_response(send_file(img_io, mimetype='image/jpeg'))
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache' # If cached, user won't see changes when the annotation is changed
@@ -106,4 +217,6 @@ class AnnotationImageEndpoint(Resource):
 
 api.add_resource(AnnotationList, '/annotations')
 api.add_resource(AnnotationEndpoint, '/annotations/<int:entity_id>')
+api.add_resource(AnnotationRegionEndpoint, '/annotations/region')
+api.add_resource(AnnotationPageCountsEndpoint, '/annotations/page_counts')
 api.add_resource(AnnotationImageEndpoint, '/annotations/<int:entity_id>/img')
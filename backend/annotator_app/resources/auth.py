@@ -6,7 +6,6 @@ from flask import request
 from flask import session
 import flask_security
 from flask_security import current_user, login_required
-from flask_mail import Message
 
 import datetime
 import bcrypt
@@ -14,7 +13,8 @@ import json
 import uuid
 
 from annotator_app.database import User, EmailConfirmationCode, user_datastore
-from annotator_app.extensions import db, mail
+from annotator_app.extensions import db
+from annotator_app import outbox, tracing, user_cache
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -51,18 +51,18 @@ def login():
     """
     data = request.get_json()
     email = data['email']
-    session.permanent = True
-    if 'permanent' in data:
-        permanent = data['permanent']
-        session.permanent = permanent
+    permanent = data.get('permanent', True)
+    session.permanent = permanent
     user = db.session.query(User).filter_by(email=email).first()
     if user is None:
         return json.dumps({'error': "Incorrect email/password"}), 401
-    if bcrypt.checkpw(data['password'].encode('utf-8'), user.password):
+    with tracing.span('bcrypt.checkpw'):
+        password_ok = bcrypt.checkpw(data['password'].encode('utf-8'), user.password)
+    if password_ok:
         flask_security.utils.login_user(user, remember=permanent)
-        print("successful login")
+        app.logger.info('Successful login for user %d', user.id)
         return json.dumps({'id': user.id}), 200
-    print("failed login")
+    app.logger.info('Failed login for user %d', user.id)
     return json.dumps({'error': 'Bad login'}), 401
 
 @auth_bp.route('/current_session', methods=['GET'])
@@ -77,7 +77,6 @@ def get_current_session():
           type: object
     """
     try:
-        print(current_user)
         if not current_user.is_anonymous:
             return json.dumps({
                 'id': current_user.id,
@@ -100,6 +99,7 @@ def logout():
         schema:
           type: object
     """
+    user_cache.invalidate(current_user)
     flask_security.utils.logout_user()
     return '{}', 200
 
@@ -123,21 +123,15 @@ def send_confirmation():
                 code = str(uuid.uuid4())
         )
         db.session.add(code)
-        db.session.flush()
-        db.session.commit()
 
-    # Email code
+    # Queue email. It is written in the same transaction as the code and delivered in the background.
     body = "Confirm email at {url}"
     body = body.format(url=app.config['BASE_SERVER_URL']+'api/auth/confirm/'+code.code)
-    msg = Message("PDF Annotator Tool",
-                  sender=app.config['MAIL_USERNAME'],
-                  recipients=[user.email],
-                  body=body)
+    outbox.queue_email(user.email, "PDF Annotator Tool", body)
 
-    try:
-        mail.send(msg)
-    except:
-        return '{message: "Invalid email"}', 400
+    db.session.flush()
+    db.session.commit()
+    outbox.wake()
 
     success_message = '{message: "Confirmation email has been sent"}'
     return success_message, 200
@@ -233,5 +227,6 @@ def link_github():
     user.github_id = github_id
     db.session.flush()
     db.session.commit()
+    user_cache.invalidate(user)
 
     return redirect('/')
@@ -0,0 +1,96 @@
+from flask import Blueprint, Response, request
+from flask import current_app as app
+from flask_restful import Api, Resource
+from flask_security import current_user
+
+import json
+import queue
+import threading
+import time
+
+from annotator_app import encoding, notifications
+
+blueprint = Blueprint('changes', __name__)
+api = Api(blueprint)
+encoding.init_api(api)
+
+_lock = threading.Lock()
+_open_streams = 0 # In this process
+
+def _open_stream():
+    """ Count a new stream, unless `NOTIFICATIONS_MAX_STREAMS` are already open. """
+    global _open_streams
+    with _lock:
+        if _open_streams >= app.config.get('NOTIFICATIONS_MAX_STREAMS', 4):
+            return False
+        _open_streams += 1
+        return True
+
+def _close_stream():
+    global _open_streams
+    with _lock:
+        _open_streams -= 1
+
+def format_event(e):
+    return 'id: %d\nevent: change\ndata: %s\n\n' % (e['revision'], json.dumps(e, separators=(',',':')))
+
+class ChangesEndpoint(Resource):
+    def get(self):
+        """ Server-Sent Events stream of changes to the user's entities.
+
+        Each event's data is `{"type": <table name>, "id": <id>, "action": "created"|"updated"|"deleted", "revision": <revision>}`.
+        The stream is closed after `NOTIFICATIONS_STREAM_TIMEOUT` seconds and the browser reconnects,
+        sending the last revision it saw as `Last-Event-ID`, so that events sent in between are replayed.
+        A stream opened without `Last-Event-ID` only receives new events.
+
+        Each stream holds one of the process's threads, so at most `NOTIFICATIONS_MAX_STREAMS` are
+        open at once, leaving the other threads to the rest of the API. Beyond that, responds with 503
+        and `Retry-After`. `EventSource` does not reconnect after an error status, so clients must do it.
+        """
+        if not current_user.is_authenticated:
+            return {
+                'error': 'Not logged in'
+            }, 401
+        user_id = current_user.id
+        # Only a reconnecting browser has missed events. A new stream starts from now.
+        try:
+            last_revision = int(request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            last_revision = None
+        if not _open_stream():
+            return {
+                'error': 'Too many open change streams'
+            }, 503, {'Retry-After': str(app.config.get('NOTIFICATIONS_RETRY_AFTER', 30))}
+        timeout = app.config.get('NOTIFICATIONS_STREAM_TIMEOUT', 300)
+        heartbeat = app.config.get('NOTIFICATIONS_HEARTBEAT', 15)
+        q = notifications.subscribe(user_id)
+
+        # Not wrapped in `stream_with_context`, so that no database connection is held while the stream is open
+        def generate():
+            try:
+                yield 'retry: 3000\n\n'
+                if last_revision is not None:
+                    for e in notifications.recent_events(user_id, last_revision):
+                        yield format_event(e)
+                deadline = time.monotonic()+timeout
+                while True:
+                    remaining = deadline-time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        e = q.get(timeout=min(heartbeat, remaining))
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield format_event(e)
+            finally:
+                notifications.unsubscribe(user_id, q)
+
+        response = Response(generate(), mimetype='text/event-stream')
+        # Called when the server is done with the response, even if the stream never started
+        response.call_on_close(_close_stream)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no' # Don't let nginx hold back events
+        return response
+
+api.add_resource(ChangesEndpoint, '/changes')
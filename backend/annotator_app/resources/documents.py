@@ -1,28 +1,36 @@
 from flask import current_app as app
-from flask import Blueprint, send_file, request
+from flask import Blueprint, Response, send_file, request, redirect, stream_with_context, url_for
 from flask_restful import Api, Resource
 from flask_security import current_user
+from sqlalchemy.orm import joinedload
 
-from bs4 import BeautifulSoup
-import os
 import requests
 import uuid
 import json
 import re
 import datetime
+import concurrent.futures
 import hashlib
+from urllib.parse import urlparse
+from collections import defaultdict
 
 from annotator_app.extensions import db
-from annotator_app.database import Document
-from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint, entities_to_dict
+from annotator_app import cache, encoding, metrics, tracing, importer, annotated_pdf, storage, thumbnails
+from annotator_app.replicas import read_only
+from annotator_app.database import Document, DocumentAccessCode, Annotation, Note
+from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint, entities_to_dict, annotations_by_note
+
+DOWNLOAD_CHUNK_SIZE = 64*1024
 
 blueprint = Blueprint('documents', __name__)
 api = Api(blueprint)
+encoding.init_api(api)
 
 class DocumentList(ListEndpoint):
     class Meta:
         model = Document
         filterable_params = ['id', 'user_id', 'title']
+        query_options = [joinedload(Document.tags)]
     def after_create(self,entity,data):
         entity.created_at = datetime.datetime.utcnow()
         entity.last_modified_at = datetime.datetime.utcnow()
@@ -37,52 +45,116 @@ class DocumentEndpoint(EntityEndpoint):
         entity.last_modified_at = datetime.datetime.utcnow()
         return [entity]
 
+RECURSIVE_INCLUDES = ['documents', 'annotations', 'notes', 'tags']
+
 class DocumentRecursiveEndpoint(Resource):
+    @read_only
     def get(self, entity_id):
-        entity = db.session.query(Document) \
+        """ Fetch a document along with its annotations, notes and tags.
+
+        The optional `include` query parameter is a comma-separated subset of
+        `documents,annotations,notes,tags` to limit what is returned.
+        The number of queries does not depend on the number of annotations.
+        """
+        include = request.args.get('include')
+        if include is None:
+            include = RECURSIVE_INCLUDES
+        else:
+            include = include.split(',')
+            invalid = [i for i in include if i not in RECURSIVE_INCLUDES]
+            if len(invalid) > 0:
+                return {
+                    'error': 'Invalid include: %s' % ','.join(invalid)
+                }, 400
+
+        # Document and its tags
+        doc = db.session.query(Document) \
+                .options(joinedload(Document.tags)) \
                 .filter_by(user_id=current_user.id) \
                 .filter_by(id=entity_id) \
-                .one()
-        if entity is None:
+                .first()
+        if doc is None:
             return {
                 'error': 'ID not found'
             }, 404
 
-        doc = entity
-        # Document
-        entities = [doc]
-        # Annotations
-        annotations = doc.annotations.filter_by(deleted_at=None).all()
-        entities += annotations
-        # Notes
-        entities += [a.note for a in annotations if a.note_id is not None]
+        key = cache.user_key(doc.user_id, 'recursive', doc.id, ','.join(include))
+        return encoding.json_response(cache.get_or_set('entities', key,
+                lambda: encoding.encode({'entities': document_entities(doc, include)})))
+
+def document_entities(doc, include=RECURSIVE_INCLUDES):
+    """ A document's annotations, notes and tags, in the format of `entities_to_dict`.
+    `doc` must have its tags loaded. """
+    output = defaultdict(lambda: {})
+    tags = {t.id: t for t in doc.tags}
+    if 'documents' in include:
+        output['documents'][doc.id] = doc.to_dict()
+
+    # Annotations
+    annotations = []
+    if 'annotations' in include or 'notes' in include:
+        annotations = db.session.query(Annotation) \
+                .filter_by(user_id=doc.user_id) \
+                .filter_by(doc_id=doc.id) \
+                .filter_by(deleted_at=None) \
+                .all()
+    if 'annotations' in include:
+        for a in annotations:
+            output['annotations'][a.id] = a.to_dict()
+
+    # Notes, their tags, and the annotations they are attached to
+    if 'notes' in include:
+        note_ids = [a.note_id for a in annotations if a.note_id is not None]
         if doc.note_id is not None:
-            entities += [doc.note]
-        return {
-            'entities': entities_to_dict(entities)
-        }, 200
+            note_ids.append(doc.note_id)
+        if len(note_ids) > 0:
+            notes = db.session.query(Note) \
+                    .options(joinedload(Note.tags)) \
+                    .filter_by(user_id=doc.user_id) \
+                    .filter(Note.id.in_(note_ids)) \
+                    .all()
+            note_annotations = annotations_by_note(note_ids)
+            for note in notes:
+                output['notes'][note.id] = note.to_dict(annotations=note_annotations[note.id])
+                tags.update((t.id, t) for t in note.tags)
 
-def fetch_pdf(document, max_bytes):
-    file_name = os.path.join(app.config['UPLOAD_DIRECTORY'],'%d.pdf'%document.id)
-    if not os.path.isfile(file_name):
-        # Elsevier (TODO: doi URLs and authentication)
-        elsevier_prefix = 'https://www.sciencedirect.com/science/article/pii/'
-        if document.url.startswith(elsevier_prefix):
-            pii = document.url[len(elsevier_prefix):]
-            url='https://api.elsevier.com/content/article/pii/%s' % pii
-            headers = {
-                "X-ELS-APIKey"  : app.config['ELSEVIER_API_KEY'],
-                "Accept"        : 'application/pdf'
-            }
-            response = requests.get(url,headers=headers)
-            with open(file_name,'wb') as f:
-                f.write(response.content)
-        else: # Download PDF
-            response = requests.get(document.url)
+    if 'tags' in include:
+        for tag in tags.values():
+            output['tags'][tag.id] = tag.to_dict()
+
+    return output
+
+def http_get(url, *args, **kwargs):
+    """ `requests.get`, with the time taken recorded in the metrics and the request's trace. """
+    host = urlparse(url).netloc
+    with metrics.timed('outbound_request_duration_seconds', host=host), \
+            tracing.span('http.get', tracing.KIND_CLIENT, **{'net.peer.name': host}):
+        return requests.get(url, *args, **kwargs)
+
+def download_pdf(url, store, key, max_bytes, elsevier_api_key=None):
+    """ Download the PDF at `url` and save it in `store` under `key`.
+
+    The PDF is streamed to disk rather than held in memory.
+    Does not need an app context, so it can be run from worker threads.
+    Returns an empty dictionary if successful, or a dictionary with an error message and status code.
+    """
+    # Elsevier (TODO: doi URLs and authentication)
+    elsevier_prefix = 'https://www.sciencedirect.com/science/article/pii/'
+    if url.startswith(elsevier_prefix):
+        pii = url[len(elsevier_prefix):]
+        url='https://api.elsevier.com/content/article/pii/%s' % pii
+        headers = {
+            "X-ELS-APIKey"  : elsevier_api_key,
+            "Accept"        : 'application/pdf'
+        }
+        with http_get(url,headers=headers,stream=True) as response:
+            storage.save_stream(store, key, response.iter_content(DOWNLOAD_CHUNK_SIZE))
+    else: # Download PDF
+        with http_get(url,stream=True) as response:
             content_bytes = response.headers.get('content-length', None)
             if content_bytes is None:
                 return {
-                    'error': 'No file found at %s' % document.url,
+                    'error': 'No file found at %s' % url,
                     'code': 404
                 }
             if len(content_bytes) > max_bytes:
@@ -90,9 +162,21 @@ def fetch_pdf(document, max_bytes):
                     'error': 'File too large.',
                     'code': 413
                 }
+            storage.save_stream(store, key, response.iter_content(DOWNLOAD_CHUNK_SIZE))
+    return {}
 
-            with open(file_name,'wb') as f:
-                f.write(response.content)
+def fetch_pdf(document, max_bytes):
+    """ Name of a local file with the document's PDF, which is downloaded if it is not stored yet. """
+    store = storage.get_storage()
+    key = storage.pdf_key(document.id)
+    file_name = store.local_path(key)
+    if file_name is None:
+        with tracing.span('fetch_pdf', **{'document.id': document.id}):
+            output = download_pdf(document.url, store, key, max_bytes, app.config.get('ELSEVIER_API_KEY'))
+        if 'error' in output:
+            return output
+        file_name = store.local_path(key)
+        thumbnails.request_thumbnail(file_name, store, get_document_hash(document, file_name))
     return { 'file_name': file_name }
 
 def get_file_hash(file_name):
@@ -106,6 +190,13 @@ def get_file_hash(file_name):
             md5.update(data)
     return md5.hexdigest()
 
+def get_document_hash(document, file_name):
+    """ Hash of the document's PDF, computed the first time it is needed. """
+    if document.hash is None:
+        document.hash = get_file_hash(file_name)
+        db.session.commit()
+    return document.hash
+
 class DocumentPdfEndpoint(Resource):
     def get(self, entity_id):
         entity = db.session.query(Document) \
@@ -142,9 +233,163 @@ class DocumentPdfEndpoint(Resource):
                 attachment_filename='doc.pdf'
         )
 
+class DocumentAnnotatedPdfEndpoint(Resource):
+    def get(self, entity_id):
+        """ The document's PDF with the user's annotations and notes drawn on it.
+
+        The file is rendered in the background. If it is not ready within `ANNOTATED_PDF_WAIT` seconds,
+        responds with 202, and the request should be repeated after `Retry-After` seconds.
+        """
+        entity = db.session.query(Document) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(id=entity_id) \
+                .first()
+        if entity is None:
+            return {
+                'error': 'Document not found'
+            }, 404
+
+        max_bytes = 1024*1024*5 # 5MB
+        output = fetch_pdf(entity, max_bytes)
+        if 'error' in output:
+            return {
+                'error': output['error']
+            }, output['code']
+        file_name = output['file_name']
+
+        annotations = annotated_pdf.get_annotations(current_user.id, entity.id)
+        revision = annotated_pdf.annotation_revision(annotations)
+        store = storage.get_storage()
+        key = annotated_pdf.cache_key(get_document_hash(entity, file_name), revision)
+        job = annotated_pdf.request_render(file_name, store, key, annotations)
+        if job is not None:
+            concurrent.futures.wait([job], timeout=app.config.get('ANNOTATED_PDF_WAIT', 2))
+            if not job.done():
+                return {
+                    'status': 'pending'
+                }, 202, {'Retry-After': '2'}
+            if job.exception() is not None:
+                app.logger.error('Failed to render annotated PDF for document %d: %s', entity.id, job.exception())
+                return {
+                    'error': 'Unable to add annotations to this PDF'
+                }, 500
+
+        response = send_file(
+                store.local_path(key),
+                mimetype='application/pdf',
+                as_attachment=True,
+                attachment_filename='annotated-%d.pdf' % entity.id,
+                conditional=True
+        )
+        response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+        return response
+
+def thumbnail_status(document, store):
+    """ Status of a document's thumbnail: 'ready', 'pending', 'failed', or 'unavailable' if its PDF is not stored.
+    Starts rendering it if needed, but never downloads the PDF. The caller must commit, since the document's hash may be set. """
+    if document.hash is None:
+        file_name = store.local_path(storage.pdf_key(document.id))
+        if file_name is None:
+            return 'unavailable'
+        document.hash = get_file_hash(file_name)
+    if store.exists(thumbnails.thumbnail_key(document.hash)):
+        return 'ready'
+    file_name = store.local_path(storage.pdf_key(document.id))
+    if file_name is None:
+        return 'unavailable'
+    return thumbnails.request_thumbnail(file_name, store, document.hash)
+
+class DocumentThumbnailEndpoint(Resource):
+    def get(self, entity_id):
+        """ Redirects to the thumbnail of the document's first page, or responds with 202 while it is rendered. """
+        entity = db.session.query(Document) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(id=entity_id) \
+                .first()
+        if entity is None:
+            return {
+                'error': 'Document not found'
+            }, 404
+        status = thumbnail_status(entity, storage.get_storage())
+        db.session.commit()
+        if status == 'pending':
+            return {
+                'status': 'pending'
+            }, 202, {'Retry-After': '2'}
+        if status != 'ready':
+            return {
+                'error': 'No thumbnail available'
+            }, 404
+        return redirect(url_for('documents.thumbnailendpoint', content_hash=entity.hash))
+
+class DocumentThumbnailsEndpoint(Resource):
+    def get(self):
+        """ Thumbnails of several documents, for the library view.
+
+        `ids` is a comma-separated list of up to `THUMBNAIL_BATCH_SIZE` document IDs.
+        Returns `{"thumbnails": {id: {"status": ..., "url": ...}}}`, where the status is as in
+        `thumbnail_status`. Ready thumbnails have the URL of the image. Pending ones can be requested
+        again after `Retry-After` seconds.
+        """
+        try:
+            ids = [int(i) for i in request.args.get('ids', '').split(',') if i != '']
+        except ValueError:
+            return {
+                'error': 'ids must be a comma-separated list of document IDs'
+            }, 400
+        if len(ids) > app.config.get('THUMBNAIL_BATCH_SIZE', 100):
+            return {
+                'error': 'At most %d documents can be requested at once' % app.config.get('THUMBNAIL_BATCH_SIZE', 100)
+            }, 400
+        documents = []
+        if len(ids) > 0:
+            documents = db.session.query(Document) \
+                    .filter_by(user_id=current_user.id) \
+                    .filter(Document.id.in_(ids)) \
+                    .all()
+
+        store = storage.get_storage()
+        output = {}
+        # One check of the storage per requested document, which `THUMBNAIL_BATCH_SIZE` bounds.
+        # Thumbnails used recently on this host are found in the storage's local cache.
+        for doc in documents:
+            status = thumbnail_status(doc, store)
+            output[doc.id] = {'status': status}
+            if status == 'ready':
+                output[doc.id]['url'] = url_for('documents.thumbnailendpoint', content_hash=doc.hash, _external=True)
+        db.session.commit()
+
+        headers = {}
+        if any(t['status'] == 'pending' for t in output.values()):
+            headers['Retry-After'] = '2'
+        return {
+            'thumbnails': output
+        }, 200, headers
+
+class ThumbnailEndpoint(Resource):
+    def get(self, content_hash):
+        """ The thumbnail of the PDF with hash `content_hash`, if the user has a document with it.
+        The response never changes, so it is cached for `THUMBNAIL_MAX_AGE` seconds. """
+        owned = db.session.query(Document.id) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(hash=content_hash) \
+                .first()
+        file_name = None
+        if owned is not None:
+            file_name = storage.get_storage().local_path(thumbnails.thumbnail_key(content_hash))
+        if file_name is None:
+            return {
+                'error': 'Thumbnail not found'
+            }, 404
+        response = send_file(file_name, mimetype='image/webp', conditional=True)
+        response.headers['Cache-Control'] = 'private, max-age=%d, immutable' % app.config.get('THUMBNAIL_MAX_AGE', 31536000)
+        return response
+
 class DocumentAccessCodeEndpoint(Resource):
     def post(self, entity_id):
-        data = request.get_json() 
+        """ Create a code that gives anyone holding it access to the document, or return the existing one.
+        The document can be read through `/api/shared/<code>` if `read` is true (the default). """
+        data = request.get_json() or {}
         entity = db.session.query(Document) \
                 .filter_by(user_id=current_user.id) \
                 .filter_by(id=entity_id) \
@@ -164,20 +409,38 @@ class DocumentAccessCodeEndpoint(Resource):
             code = DocumentAccessCode(
                     user_id=current_user.id,
                     document_id=entity_id,
-                    code=str(uuid.uiud4()),
-                    allow_read=data.get('read',False),
+                    code=str(uuid.uuid4()),
+                    allow_read=data.get('read',True),
                     allow_write=data.get('write',False)
             )
             db.session.add(code)
             db.session.flush()
             db.session.commit()
 
-        return json.dumps({
-            'code': code.code
-        }), 200
+        return {
+            'code': code.code,
+            'url': url_for('shared.shareddocumentendpoint', code=code.code)
+        }, 200
+    def delete(self, entity_id):
+        """ Revoke the document's access codes. """
+        db.session.query(DocumentAccessCode) \
+                .filter_by(user_id=current_user.id) \
+                .filter_by(document_id=entity_id) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        return {
+            'message': 'Access revoked'
+        }, 200
 
-def autofill_document_details(entity):
-    url = entity.url
+def fetch_document_details(url):
+    """ Look up a document's title and authors on the site hosting it.
+
+    Does not need an app context, so it can be run from worker threads.
+    Returns a dictionary of details, and the set of details that should replace existing values.
+    """
+    from bs4 import BeautifulSoup # Slow to import, and only needed here
+    details = {}
+    overwrite = set()
     match = re.search("^https://arxiv.org/pdf/(\d+\.\d+)", url)
     if match is not None:
         arxiv_abs_url = 'https://arxiv.org/abs/%s' % match.group(1)
@@ -189,19 +452,16 @@ def autofill_document_details(entity):
             'Access-Control-Max-Age': '3600',
             'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
         }
-        response = requests.get(arxiv_abs_url, headers)
+        response = http_get(arxiv_abs_url, headers=headers)
         soup = BeautifulSoup(response.content, 'html.parser')
 
         title = soup.find_all('h1', class_='title')[0].text
         if title.startswith('Title:'):
-            title = title[len('Title:'):]
-            if entity.title is None:
-                entity.title = title
+            details['title'] = title[len('Title:'):]
         authors = soup.find_all('div', class_='authors')[0].text
         if authors.startswith('Authors:'):
-            authors = authors[len('Authors:'):]
-            #if entity.author is None:
-            entity.author = authors
+            details['author'] = authors[len('Authors:'):]
+            overwrite.add('author')
 
     match = re.search("^https://proceedings.neurips.cc/paper/2020/file/([a-zA-Z0-9]+)-Paper.pdf", url)
     if match is not None:
@@ -214,21 +474,29 @@ def autofill_document_details(entity):
             'Access-Control-Max-Age': '3600',
             'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
         }
-        response = requests.get(neurips_abs_url, headers)
+        response = http_get(neurips_abs_url, headers=headers)
         soup = BeautifulSoup(response.content, 'html.parser')
 
         # Title
-        title = soup.select('.container-fluid .col h4')[0].text
-        if entity.title is None:
-            entity.title = title
+        details['title'] = soup.select('.container-fluid .col h4')[0].text
         # Authors
         authors_header = soup.find('h4', string="Authors").parent
-        authors_container = authors_header.find_next('p')
-        if entity.author is None:
-            entity.author = authors_container.text
+        details['author'] = authors_header.find_next('p').text
 
+    return details, overwrite
+
+def apply_document_details(entity, details, overwrite):
+    for k,v in details.items():
+        if k in overwrite or getattr(entity,k) is None:
+            setattr(entity,k,v)
     return entity
 
+def autofill_document_details(entity):
+    with tracing.span('autofill_document_details'):
+        details, overwrite = cache.get_or_set('autofill', 'autofill:%s' % entity.url,
+                lambda: fetch_document_details(entity.url), ttl=app.config.get('CACHE_AUTOFILL_TTL', 86400))
+    return apply_document_details(entity, details, overwrite)
+
 class DocumentAutoFillEndpoint(Resource):
     def post(self, entity_id):
         data = request.get_json()
@@ -251,9 +519,50 @@ class DocumentAutoFillEndpoint(Resource):
             'entities': entities_to_dict([entity]),
         }), 200
 
+class DocumentImportEndpoint(Resource):
+    def post(self):
+        """ Import documents from a BibTeX or CSV file.
+
+        The file is either uploaded as `file` or sent as the request body. Its format is taken from the
+        `format` query parameter (`bibtex` or `csv`), or else from the uploaded file's extension.
+        Progress is streamed back as NDJSON while the documents are imported.
+        """
+        upload = request.files.get('file')
+        if upload is not None:
+            text = upload.read()
+            file_format = request.args.get('format') or importer.guess_format(upload.filename)
+        else:
+            text = request.get_data()
+            file_format = request.args.get('format')
+        if file_format is None:
+            return {
+                'error': 'Unknown file format. Specify `bibtex` or `csv` as the `format` parameter.'
+            }, 400
+        try:
+            documents = importer.parse_file(text.decode('utf-8-sig'), file_format)
+        except UnicodeDecodeError:
+            return {
+                'error': 'File must be UTF-8 encoded'
+            }, 400
+        except importer.ImportFileError as e:
+            return {
+                'error': str(e)
+            }, 400
+
+        user_id = current_user.id
+        def generate():
+            for progress in importer.import_documents(user_id, documents):
+                yield json.dumps(progress)+'\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 api.add_resource(DocumentList, '/documents')
+api.add_resource(DocumentImportEndpoint, '/documents/import')
 api.add_resource(DocumentEndpoint, '/documents/<int:entity_id>')
 api.add_resource(DocumentRecursiveEndpoint, '/documents/<int:entity_id>/recursive')
 api.add_resource(DocumentPdfEndpoint, '/documents/<int:entity_id>/pdf')
+api.add_resource(DocumentAnnotatedPdfEndpoint, '/documents/<int:entity_id>/annotated_pdf')
 api.add_resource(DocumentAccessCodeEndpoint, '/documents/<int:entity_id>/access_code')
 api.add_resource(DocumentAutoFillEndpoint, '/documents/<int:entity_id>/autofill')
+api.add_resource(DocumentThumbnailEndpoint, '/documents/<int:entity_id>/thumbnail')
+api.add_resource(DocumentThumbnailsEndpoint, '/documents/thumbnails')
+api.add_resource(ThumbnailEndpoint, '/thumbnails/<content_hash>')
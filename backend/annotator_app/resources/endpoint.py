@@ -1,17 +1,40 @@
 from flask import request
 from flask_restful import Resource
 from flask_security import current_user
-from flasgger import SwaggerView
 
 from collections import defaultdict
 import datetime
 
+from sqlalchemy.orm import joinedload
+
 from annotator_app.extensions import db
+from annotator_app.database import Annotation
+from annotator_app import cache, encoding, notifications
+from annotator_app.replicas import read_only
+
+def annotations_by_note(note_ids):
+    """ Annotations of the given notes, with their documents loaded, by note ID, for `Note.to_dict`. """
+    output = defaultdict(lambda: [])
+    if len(note_ids) == 0:
+        return output
+    annotations = db.session.query(Annotation) \
+            .options(joinedload(Annotation.document)) \
+            .filter(Annotation.note_id.in_(note_ids)) \
+            .order_by(Annotation.id) \
+            .all()
+    for a in annotations:
+        output[a.note_id].append(a)
+    return output
 
 def entities_to_dict(entities):
     output = defaultdict(lambda: {})
+    # Annotations of all notes at once, rather than a query per note
+    note_annotations = annotations_by_note([e.id for e in entities if e.__tablename__ == 'notes'])
     for entity in entities:
-        entity_dict = entity.to_dict()
+        if entity.__tablename__ == 'notes':
+            entity_dict = entity.to_dict(annotations=note_annotations[entity.id])
+        else:
+            entity_dict = entity.to_dict()
         output[entity.__tablename__][entity.id] = entity_dict
     return output
 
@@ -28,11 +51,13 @@ class ListEndpoint(CustomResource):
     Meta:
         model: Class representing a SQLAlchemy model
         filterable_params: List of columns by which the data can be filtered.
+        query_options: List of query options (e.g. `joinedload`) for loading the entities.
         to_object: dict -> entity
             Function that creates an entity from a dictionary.
         update_object: entity, dict -> entity
             Function that updates the entity with new data in the form of a dictionary.
     """
+    @read_only
     def get(self):
         # Get filters from query parameters
         filter_params = {}
@@ -42,15 +67,18 @@ class ListEndpoint(CustomResource):
                 if val is not None:
                     filter_params[p] = val
         # Query database
-        entities = db.session.query(self.Meta.model) \
-                .filter_by(user_id=current_user.id) \
-                .filter_by(deleted_at=None) \
-                .filter_by(**filter_params) \
-                .all()
-        print(entities)
-        return {
-            'entities': entities_to_dict(entities)
-        }, 200
+        def compute():
+            entities = db.session.query(self.Meta.model) \
+                    .options(*getattr(self.Meta,'query_options',[])) \
+                    .filter_by(user_id=current_user.id) \
+                    .filter_by(deleted_at=None) \
+                    .filter_by(**filter_params) \
+                    .all()
+            return encoding.encode({
+                'entities': entities_to_dict(entities)
+            })
+        key = cache.user_key(current_user.id, 'list', self.Meta.model.__tablename__, sorted(filter_params.items()))
+        return encoding.json_response(cache.get_or_set('entities', key, compute))
     def post(self):
         data = request.get_json() 
 
@@ -68,6 +96,8 @@ class ListEndpoint(CustomResource):
         entities = self.after_create(entity, data)
 
         db.session.flush()
+        notifications.entities_changed(db.session, current_user.id, [entity], 'created')
+        notifications.entities_changed(db.session, current_user.id, [e for e in entities if e is not entity], 'updated')
         db.session.commit()
 
         return {
@@ -77,6 +107,7 @@ class ListEndpoint(CustomResource):
         }, 200
 
 class EntityEndpoint(CustomResource):
+    @read_only
     def get(self, entity_id):
         entity = db.session.query(self.Meta.model) \
                 .filter_by(user_id=current_user.id) \
@@ -102,11 +133,18 @@ class EntityEndpoint(CustomResource):
         if entity.deleted_at is not None:
             entity.deleted_at = None # Undelete
 
-        entity.update(data)
+        try:
+            entity.update(data)
+        except ValueError as e:
+            db.session.rollback()
+            return {
+                    'error': str(e)
+            }, 400
         db.session.flush()
         entities = self.after_update(entity,data)
 
         db.session.flush()
+        notifications.entities_changed(db.session, current_user.id, entities, 'updated')
         db.session.commit()
 
         return {
@@ -128,6 +166,8 @@ class EntityEndpoint(CustomResource):
 
         entities = self.after_delete(entity)
 
+        notifications.entities_changed(db.session, current_user.id, [entity], 'deleted')
+        notifications.entities_changed(db.session, current_user.id, [e for e in entities if e is not entity], 'updated')
         db.session.commit()
 
         return {
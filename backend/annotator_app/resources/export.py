@@ -0,0 +1,156 @@
+from flask import Blueprint, Response, request, stream_with_context
+from flask import current_app as app
+from flask_restful import Api, Resource
+from flask_security import current_user
+
+import datetime
+import zipfile
+
+from annotator_app.extensions import db
+from annotator_app import encoding
+from annotator_app.database import Document, Annotation, Note, Tag, documents_tags, notes_tags
+
+blueprint = Blueprint('export', __name__)
+api = Api(blueprint)
+encoding.init_api(api)
+
+CHUNK_SIZE = 64*1024
+
+def stream_query(query):
+    """ Iterate over the results of a query using a server-side cursor. """
+    return query.execution_options(stream_results=True) \
+            .yield_per(app.config.get('EXPORT_BATCH_SIZE', 500))
+
+def export_sections(user_id, include_note_bodies=True):
+    """ (name, row iterator) for each kind of entity in a user's library.
+    Rows are only fetched as the iterators are consumed. """
+    def entities(model, transform=None):
+        query = db.session.query(model) \
+                .filter_by(user_id=user_id) \
+                .filter_by(deleted_at=None) \
+                .order_by(model.id)
+        for entity in stream_query(query):
+            row = entity.__serializer__(entity)
+            if transform is not None:
+                transform(row)
+            yield row
+    def associations(table, column, model):
+        query = db.session.query(table) \
+                .join(model, model.id == column) \
+                .filter(model.user_id == user_id) \
+                .filter(model.deleted_at.is_(None))
+        for row in stream_query(query):
+            yield dict(row._asdict())
+    def note_body_file(row):
+        del row['body']
+        row['body_file'] = 'notes/%d.md' % row['id']
+    return [
+        ('tags', entities(Tag)),
+        ('documents', entities(Document)),
+        ('document_tags', associations(documents_tags, documents_tags.c.document_id, Document)),
+        ('annotations', entities(Annotation)),
+        ('notes', entities(Note, None if include_note_bodies else note_body_file)),
+        ('note_tags', associations(notes_tags, notes_tags.c.note_id, Note)),
+    ]
+
+def _dumps(row):
+    line = encoding.dumps(row)
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    return line+b'\n'
+
+def generate_ndjson(user_id):
+    for name, rows in export_sections(user_id):
+        chunk = []
+        size = 0
+        for row in rows:
+            line = _dumps({'type': name, 'data': row})
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        if len(chunk) > 0:
+            yield b''.join(chunk)
+
+class _StreamBuffer(object):
+    """ Write-only file object that collects what is written to it until `pop` is called. """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+    def flush(self):
+        pass
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+def generate_zip(user_id):
+    """ Stream a zip archive of the user's library.
+
+    Contains an NDJSON file per kind of entity, the documents' BibTeX entries
+    in `library.bib`, and each note's body as `notes/<id>.md`.
+    """
+    buf = _StreamBuffer()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, rows in export_sections(user_id, include_note_bodies=False):
+            with zf.open('%s.ndjson' % name, 'w', force_zip64=True) as f:
+                for row in rows:
+                    f.write(_dumps(row))
+                    if buf.size >= CHUNK_SIZE:
+                        yield buf.pop()
+            yield buf.pop()
+
+        query = db.session.query(Document.bibtex) \
+                .filter_by(user_id=user_id) \
+                .filter_by(deleted_at=None) \
+                .filter(Document.bibtex.isnot(None)) \
+                .order_by(Document.id)
+        with zf.open('library.bib', 'w', force_zip64=True) as f:
+            for (bibtex,) in stream_query(query):
+                f.write(bibtex.strip().encode('utf-8')+b'\n\n')
+                if buf.size >= CHUNK_SIZE:
+                    yield buf.pop()
+        yield buf.pop()
+
+        query = db.session.query(Note.id, Note.body) \
+                .filter_by(user_id=user_id) \
+                .filter_by(deleted_at=None) \
+                .order_by(Note.id)
+        for note_id, body in stream_query(query):
+            zf.writestr('notes/%d.md' % note_id, body or '')
+            if buf.size >= CHUNK_SIZE:
+                yield buf.pop()
+    yield buf.pop()
+
+class ExportEndpoint(Resource):
+    def get(self):
+        """ Download everything in the user's library.
+
+        `format` query parameter: `zip` (default) or `ndjson`.
+        The archive is generated while it is sent, so memory use does not depend on the size of the library.
+        """
+        export_format = request.args.get('format', 'zip')
+        user_id = current_user.id
+        date = datetime.date.today().isoformat()
+        if export_format == 'zip':
+            generator = generate_zip(user_id)
+            mimetype = 'application/zip'
+        elif export_format == 'ndjson':
+            generator = generate_ndjson(user_id)
+            mimetype = 'application/x-ndjson'
+        else:
+            return {
+                'error': 'Invalid format: %s' % export_format
+            }, 400
+        response = Response(stream_with_context(generator), mimetype=mimetype)
+        response.headers['Content-Disposition'] = 'attachment; filename=annotator-export-%s.%s' % (date, export_format)
+        return response
+
+api.add_resource(ExportEndpoint, '/export')
@@ -3,22 +3,25 @@ from flask import current_app as app
 from flask import Blueprint, send_file
 from flask_restful import Api, Resource
 from flask_security import current_user
+from sqlalchemy.orm import joinedload
 
 import os
-import requests
 import datetime
 
 from annotator_app.extensions import db
+from annotator_app import encoding
 from annotator_app.database import Note, Annotation, Document
 from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint
 
 blueprint = Blueprint('notes', __name__)
 api = Api(blueprint)
+encoding.init_api(api)
 
 class NoteList(ListEndpoint):
     class Meta:
         model = Note
         filterable_params = ['id', 'user_id']
+        query_options = [joinedload(Note.tags)]
     def after_create(self,entity,data):
         entity.created_at = datetime.datetime.utcnow()
         entity.last_modified_at = datetime.datetime.utcnow()
@@ -28,7 +31,7 @@ class NoteList(ListEndpoint):
                     .filter_by(user_id=current_user.id) \
                     .first()
             if ann is not None:
-                print('new note id',entity.id)
+                app.logger.debug('Attached note %d to annotation %d', entity.id, ann.id)
                 ann.note_id = entity.id
                 return [entity,ann]
         elif 'document_id' in data:
@@ -53,7 +56,7 @@ class NoteEndpoint(EntityEndpoint):
                     .filter_by(user_id=current_user.id) \
                     .first()
             if ann is not None:
-                print('new note id',entity.id)
+                app.logger.debug('Attached note %d to annotation %d', entity.id, ann.id)
                 ann.note_id = entity.id
                 return [entity,ann]
         elif 'document_id' in data:
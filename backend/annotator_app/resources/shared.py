@@ -0,0 +1,156 @@
+""" Read-only access to a shared document for anyone holding one of its access codes.
+
+`GET /api/shared/<code>` points to the current version of the shared data:
+
+    {"document_id": 1, "version": "...", "entities_url": "...", "pdf_url": "..."}
+
+The entities URL contains a digest of the document, annotations and notes, and the PDF URL
+the hash of the PDF, so their responses only change when the code is revoked. Browsers cache
+them for `SHARED_MAX_AGE` seconds. Shared caches (the nginx cache in front of the app) keep them
+for `SHARED_POINTER_MAX_AGE` seconds, like the pointer, then revalidate them with the app. The
+code is checked on every revalidation, so a revoked code stops working for everyone but the
+browsers that already have a copy. These requests don't open the session cookie or load the
+user, and their responses have no `Set-Cookie` or `Vary: Cookie`, so proxies can cache them.
+"""
+from flask import Blueprint, request, redirect, send_file, url_for
+from flask import current_app as app
+from flask.sessions import SecureCookieSessionInterface
+from flask_restful import Api, Resource
+from sqlalchemy.orm import joinedload
+
+import hashlib
+
+from annotator_app.extensions import db
+from annotator_app import cache, encoding
+from annotator_app.database import Document, DocumentAccessCode
+from annotator_app.resources.documents import document_entities, fetch_pdf, get_document_hash
+
+URL_PREFIX = '/api/shared/'
+
+blueprint = Blueprint('shared', __name__)
+api = Api(blueprint)
+encoding.init_api(api)
+
+class SharedSessionInterface(SecureCookieSessionInterface):
+    """ Gives requests for shared documents a null session, which is never saved. """
+    def open_session(self, app, request):
+        if request.path.startswith(URL_PREFIX):
+            return self.make_null_session(app)
+        return super().open_session(app, request)
+
+class StripSharedCookies(object):
+    """ WSGI middleware that removes the cookies of requests for shared documents,
+    so that Flask-Login finds no session or remember cookie and never calls the user loader. """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(URL_PREFIX):
+            environ.pop('HTTP_COOKIE', None)
+        return self.wsgi_app(environ, start_response)
+
+def init_app(app):
+    app.session_interface = SharedSessionInterface()
+    app.wsgi_app = StripSharedCookies(app.wsgi_app)
+
+def get_shared_document(code):
+    """ The document that `code` gives read access to, or None. """
+    return db.session.query(Document) \
+            .join(DocumentAccessCode, DocumentAccessCode.document_id == Document.id) \
+            .options(joinedload(Document.tags)) \
+            .filter(DocumentAccessCode.code == code) \
+            .filter(DocumentAccessCode.allow_read.is_(True)) \
+            .filter(Document.deleted_at.is_(None)) \
+            .first()
+
+def shared_entities(doc):
+    """ The document, its annotations and its notes, without the owner's tags. """
+    entities = document_entities(doc, ['documents', 'annotations', 'notes'])
+    for entity in list(entities['documents'].values()) + list(entities['notes'].values()):
+        for key in ['tag_names', 'tag_ids']:
+            entity.pop(key, None)
+    return entities
+
+def shared_entities_body(doc):
+    """ Version and JSON body of the shared entities. """
+    def compute():
+        body = encoding.encode({'entities': shared_entities(doc)})
+        digest = hashlib.sha1(body.encode('utf-8') if isinstance(body, str) else body)
+        return digest.hexdigest()[:16], body
+    return cache.get_or_set('entities', cache.user_key(doc.user_id, 'shared', doc.id), compute)
+
+def _not_found():
+    return {
+        'error': 'This link is invalid or has been revoked'
+    }, 404, {'Cache-Control': 'public, max-age=%d' % app.config.get('SHARED_POINTER_MAX_AGE', 60)}
+
+def _versioned(response):
+    """ Cache a response whose URL has a version for long in browsers, but revalidate it often in shared caches. """
+    response.headers['Cache-Control'] = 'public, max-age=%d, s-maxage=%d' % (
+            app.config.get('SHARED_MAX_AGE', 3600), app.config.get('SHARED_POINTER_MAX_AGE', 60))
+    return response
+
+class SharedDocumentEndpoint(Resource):
+    def get(self, code):
+        doc = get_shared_document(code)
+        if doc is None:
+            return _not_found()
+        max_bytes = 1024*1024*5 # 5MB
+        output = fetch_pdf(doc, max_bytes)
+        if 'error' in output:
+            return {
+                'error': output['error']
+            }, output['code']
+        version, _ = shared_entities_body(doc)
+        content_hash = get_document_hash(doc, output['file_name'])
+
+        response = encoding.output_json({
+            'document_id': doc.id,
+            'version': version,
+            'entities_url': url_for('shared.sharedentitiesendpoint', code=code, version=version),
+            'pdf_url': url_for('shared.sharedpdfendpoint', code=code, content_hash=content_hash),
+        }, 200)
+        response.set_etag('%s-%s' % (version, content_hash))
+        response.headers['Cache-Control'] = 'public, max-age=%d' % app.config.get('SHARED_POINTER_MAX_AGE', 60)
+        return response.make_conditional(request)
+
+class SharedEntitiesEndpoint(Resource):
+    def get(self, code, version):
+        """ The shared entities, if `version` is still current. Otherwise redirects to the current version. """
+        doc = get_shared_document(code)
+        if doc is None:
+            return _not_found()
+        current_version, body = shared_entities_body(doc)
+        if version != current_version:
+            response = redirect(url_for('shared.sharedentitiesendpoint', code=code, version=current_version))
+            response.headers['Cache-Control'] = 'public, max-age=%d' % app.config.get('SHARED_POINTER_MAX_AGE', 60)
+            return response
+        response = encoding.json_response(body)
+        response.set_etag(version)
+        return _versioned(response.make_conditional(request))
+
+class SharedPdfEndpoint(Resource):
+    def get(self, code, content_hash):
+        doc = get_shared_document(code)
+        if doc is None:
+            return _not_found()
+        max_bytes = 1024*1024*5 # 5MB
+        output = fetch_pdf(doc, max_bytes)
+        if 'error' in output:
+            return {
+                'error': output['error']
+            }, output['code']
+        current_hash = get_document_hash(doc, output['file_name'])
+        if content_hash != current_hash:
+            response = redirect(url_for('shared.sharedpdfendpoint', code=code, content_hash=current_hash))
+            response.headers['Cache-Control'] = 'public, max-age=%d' % app.config.get('SHARED_POINTER_MAX_AGE', 60)
+            return response
+        return _versioned(send_file(
+                output['file_name'],
+                mimetype='application/pdf',
+                attachment_filename='doc.pdf',
+                conditional=True
+        ))
+
+api.add_resource(SharedDocumentEndpoint, '/<code>')
+api.add_resource(SharedEntitiesEndpoint, '/<code>/entities/<version>')
+api.add_resource(SharedPdfEndpoint, '/<code>/pdf/<content_hash>')
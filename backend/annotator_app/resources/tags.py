@@ -4,14 +4,15 @@ from flask_restful import Api, Resource
 from flask_security import current_user
 
 import os
-import requests
 
 from annotator_app.extensions import db
+from annotator_app import encoding
 from annotator_app.database import Tag, documents_tags
 from annotator_app.resources.endpoint import ListEndpoint, EntityEndpoint
 
 blueprint = Blueprint('tags', __name__)
 api = Api(blueprint)
+encoding.init_api(api)
 
 class TagList(ListEndpoint):
     class Meta:
@@ -4,7 +4,6 @@ from flask_restful import Api, Resource
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
 from werkzeug.utils import secure_filename
-from flasgger import SwaggerView
 import flask_security
 from flask_security import current_user
 
@@ -16,9 +15,12 @@ import bcrypt
 
 from annotator_app.database import User, user_datastore
 from annotator_app.extensions import db
+from annotator_app import encoding, tracing
+from annotator_app import user_cache
 
 blueprint = Blueprint('users', __name__)
 api = Api(blueprint)
+encoding.init_api(api)
 
 class UserList(Resource):
     def post(self):
@@ -70,7 +72,8 @@ class UserList(Resource):
             }, 400
 
         email = data['email']
-        password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt(12))
+        with tracing.span('bcrypt.hashpw'):
+            password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt(12))
 
         user = user_datastore.create_user(email=email,password=password)
 
@@ -90,15 +93,19 @@ class UserPassword(Resource):
         new_password = data.get('new_password')
 
         user = current_user
-        if not bcrypt.checkpw(current_password.encode('utf-8'), user.password):
+        with tracing.span('bcrypt.checkpw'):
+            password_ok = bcrypt.checkpw(current_password.encode('utf-8'), user.password)
+        if not password_ok:
             return {
                     'error': 'Incorrect password'
             }, 403
 
-        user.password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(12))
+        with tracing.span('bcrypt.hashpw'):
+            user.password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(12))
 
         db.session.flush()
         db.session.commit()
+        user_cache.invalidate(user)
         return {
             'message': "Password updated successfully."
         }, 200
@@ -122,7 +129,9 @@ class UserUnlinkAccount(Resource):
         # Check password
         if current_password is None:
             return { 'error': 'No password supplied.' }, 403
-        if not bcrypt.checkpw(current_password.encode('utf-8'), user.password):
+        with tracing.span('bcrypt.checkpw'):
+            password_ok = bcrypt.checkpw(current_password.encode('utf-8'), user.password)
+        if not password_ok:
             return { 'error': 'Incorrect password' }, 403
 
         # Check OAuth service name
@@ -133,6 +142,7 @@ class UserUnlinkAccount(Resource):
         user.github_id = None
         db.session.flush()
         db.session.commit()
+        user_cache.invalidate(user)
 
         return {
             'message': "Successfully unlinked from Github account"
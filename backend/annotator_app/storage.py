@@ -0,0 +1,277 @@
+""" Storage of the PDFs of documents and of the files rendered from them.
+
+Files are stored under keys such as `1.pdf` or `annotated/<hash>-<revision>.pdf`,
+in the backend chosen with `STORAGE_BACKEND`:
+
+- `local`: files in `UPLOAD_DIRECTORY`. Only usable by the app servers of one host.
+- `s3`: objects in the bucket `STORAGE_S3_BUCKET` of Amazon S3 or of a service
+  compatible with it (MinIO, Ceph...) at `STORAGE_S3_ENDPOINT_URL`, shared by every
+  app server. Requires the `boto3` package. Files are uploaded and downloaded in
+  chunks, and the files used on this host are kept in a read-through cache in
+  `STORAGE_CACHE_DIRECTORY`, whose least recently used files are removed
+  beyond `STORAGE_CACHE_MAX_BYTES`.
+
+Sending a file or rendering from it needs a file on disk, which `local_path`
+provides. New files are written to a path from `temp_file_name` and moved into
+the storage with `put_file`. Neither needs an app context, so the storage can be
+used from worker threads.
+"""
+from flask import current_app
+
+import os
+import tempfile
+import threading
+import time
+
+##################################################
+# Backends
+##################################################
+
+class LocalStorage(object):
+    name = 'local'
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def temp_file_name(self):
+        """ Name of a new file on the same file system as the stored files. """
+        fd, file_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        return file_name
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def local_path(self, key):
+        """ Name of a file with the contents stored under `key`, or None if there is none. """
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+    def put_file(self, key, file_name):
+        """ Move the file `file_name` into the storage under `key`. """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(file_name, path)
+
+    def delete(self, key):
+        """ Remove the file stored under `key`. Returns its size, or None if there was none. """
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return None
+        return size
+
+    def list(self, prefix='', recursive=True):
+        """ Keys and sizes of the stored files whose key starts with `prefix`.
+        Unless `recursive`, keys with a `/` after the prefix (e.g. `annotated/...` for the prefix '') are left out. """
+        # Only the directory that the prefix is in is searched
+        directory = prefix.rpartition('/')[0]
+        top = self._path(directory) if directory else self.directory
+        for root, subdirectories, files in os.walk(top):
+            if not recursive:
+                subdirectories.clear()
+            for name in files:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                if not key.startswith(prefix) or name.endswith('.tmp'):
+                    continue
+                try:
+                    yield key, os.path.getsize(path)
+                except OSError:
+                    continue
+
+class DiskCache(object):
+    """ Local copies of remote files, keeping the most recently used ones within `max_bytes`.
+
+    Files used in the last `MIN_AGE` seconds are never removed, even beyond `max_bytes`, since
+    the caller of `local_path` may not have opened them yet to send or render them.
+    """
+    PRUNE_EVERY = 20 # Files added between checks of the total size
+    MIN_AGE = 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._added = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path) # Recently used files are pruned last
+        except OSError:
+            return None
+        return path
+
+    def add(self, key, file_name):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(file_name, path)
+        with self._lock:
+            self._added += 1
+            prune = self._added % self.PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+        return path
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        """ Remove the least recently used files until the total size is within `max_bytes`. """
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+        files.sort()
+        in_use_since = time.time()-self.MIN_AGE
+        for mtime, size, path in files:
+            if total <= self.max_bytes or mtime > in_use_since:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class S3Storage(object):
+    name = 's3'
+    CHUNK_SIZE = 8*1024*1024
+
+    def __init__(self, bucket, prefix, cache, **client_options):
+        import boto3 # Optional dependency
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import ClientError
+        self.client = boto3.client('s3', **client_options)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache = cache
+        self._client_error = ClientError
+        # Multipart transfers of `CHUNK_SIZE` parts, so that large files are never held in memory
+        self._transfer = TransferConfig(multipart_threshold=self.CHUNK_SIZE, multipart_chunksize=self.CHUNK_SIZE)
+
+    def _not_found(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def temp_file_name(self):
+        fd, file_name = tempfile.mkstemp(dir=self.cache.directory, suffix='.tmp')
+        os.close(fd)
+        return file_name
+
+    def exists(self, key):
+        if self.cache.get(key) is not None:
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix+key)
+        except self._client_error as e:
+            if self._not_found(e):
+                return False
+            raise
+        return True
+
+    def local_path(self, key):
+        path = self.cache.get(key)
+        if path is not None:
+            return path
+        file_name = self.temp_file_name()
+        try:
+            self.client.download_file(self.bucket, self.prefix+key, file_name, Config=self._transfer)
+        except self._client_error as e:
+            os.remove(file_name)
+            if self._not_found(e):
+                return None
+            raise
+        except Exception:
+            os.remove(file_name)
+            raise
+        return self.cache.add(key, file_name)
+
+    def put_file(self, key, file_name):
+        try:
+            self.client.upload_file(file_name, self.bucket, self.prefix+key, Config=self._transfer)
+        except Exception:
+            os.remove(file_name)
+            raise
+        self.cache.add(key, file_name)
+
+    def delete(self, key):
+        self.cache.remove(key)
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.prefix+key)
+        except self._client_error as e:
+            if self._not_found(e):
+                return None
+            raise
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix+key)
+        return head['ContentLength']
+
+    def list(self, prefix='', recursive=True):
+        paginator = self.client.get_paginator('list_objects_v2')
+        options = {} if recursive else {'Delimiter': '/'}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix+prefix, **options):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['Size']
+
+##################################################
+# API
+##################################################
+
+def get_storage():
+    """ The app's storage, to be passed to code that runs without an app context. """
+    return current_app.extensions['storage']
+
+def pdf_key(document_id):
+    return '%d.pdf' % document_id
+
+def save_stream(store, key, chunks):
+    """ Store the byte strings yielded by `chunks` under `key`, without holding them all in memory. """
+    file_name = store.temp_file_name()
+    try:
+        with open(file_name, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except Exception:
+        os.remove(file_name)
+        raise
+    store.put_file(key, file_name)
+
+def init_app(app):
+    config = app.config
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        store = LocalStorage(config['UPLOAD_DIRECTORY'])
+    elif backend == 's3':
+        cache = DiskCache(config.get('STORAGE_CACHE_DIRECTORY', config['UPLOAD_DIRECTORY']),
+                config.get('STORAGE_CACHE_MAX_BYTES', 1024*1024*1024))
+        client_options = {
+            'endpoint_url': config.get('STORAGE_S3_ENDPOINT_URL'),
+            'region_name': config.get('STORAGE_S3_REGION'),
+        }
+        # Credentials can also come from the environment or the instance's role
+        if 'STORAGE_S3_ACCESS_KEY' in config:
+            client_options['aws_access_key_id'] = config['STORAGE_S3_ACCESS_KEY']
+            client_options['aws_secret_access_key'] = config['STORAGE_S3_SECRET_KEY']
+        store = S3Storage(config['STORAGE_S3_BUCKET'], config.get('STORAGE_S3_PREFIX', ''), cache, **client_options)
+    else:
+        raise ValueError('Unknown STORAGE_BACKEND: %s' % backend)
+    app.extensions['storage'] = store
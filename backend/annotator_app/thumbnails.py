@@ -0,0 +1,83 @@
+""" Thumbnails of the first page of documents, for the library view.
+
+A thumbnail is rendered once per PDF content hash, on a pool of
+`THUMBNAIL_WORKERS` background threads, as soon as a PDF is stored. It is
+`THUMBNAIL_WIDTH` pixels wide, saved as WebP with quality `THUMBNAIL_QUALITY`,
+and kept in the app's storage (see `annotator_app.storage`) under
+`thumbnails/`. Documents with the same PDF share a thumbnail. A thumbnail
+that fails to render is reported as failed, and tried again once
+`THUMBNAIL_RETRY_DELAY` seconds have passed, doubling with each failure.
+"""
+from flask import current_app as app
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+from annotator_app import metrics
+
+KEY_PREFIX = 'thumbnails/'
+
+_lock = threading.RLock()
+_executor = None
+_jobs = {} # Key -> Future
+_failed = {} # Key -> (number of failures, `time.monotonic()` of the last one)
+
+def thumbnail_key(content_hash):
+    return '%s%s.webp' % (KEY_PREFIX, content_hash)
+
+def render(pdf_file_name, store, key, width, quality):
+    """ Store a WebP of the first page of a PDF under `key`. """
+    from pdf2image import convert_from_path # Slow to import, and only needed here
+    with metrics.timed('render_duration_seconds', kind='thumbnail'):
+        images = convert_from_path(pdf_file_name, size=(width, None), first_page=1, last_page=1)
+    tmp_file_name = store.temp_file_name()
+    try:
+        images[0].save(tmp_file_name, 'WEBP', quality=quality, method=6)
+    except Exception:
+        os.remove(tmp_file_name)
+        raise
+    store.put_file(key, tmp_file_name)
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config.get('THUMBNAIL_WORKERS', 1))
+    return _executor
+
+def _done(key, future, logger):
+    with _lock:
+        _jobs.pop(key, None)
+        if future.exception() is None:
+            _failed.pop(key, None)
+        else:
+            failures = _failed.get(key, (0, None))[0]
+            _failed[key] = (failures+1, time.monotonic())
+    if future.exception() is not None:
+        logger.error('Failed to render thumbnail %s: %s', key, future.exception())
+
+def request_thumbnail(pdf_file_name, store, content_hash):
+    """ Start rendering the thumbnail of a PDF in the background unless it is stored, in progress or recently failed.
+
+    Returns 'ready', 'pending' or 'failed'.
+    """
+    key = thumbnail_key(content_hash)
+    retry_delay = app.config.get('THUMBNAIL_RETRY_DELAY', 300)
+    with _lock:
+        if key in _jobs:
+            return 'pending'
+        if key in _failed:
+            failures, failed_at = _failed[key]
+            if time.monotonic() < failed_at + retry_delay*2**(failures-1):
+                return 'failed'
+    if store.exists(key):
+        return 'ready'
+    with _lock:
+        if key not in _jobs:
+            future = _get_executor().submit(render, pdf_file_name, store, key,
+                    app.config.get('THUMBNAIL_WIDTH', 200), app.config.get('THUMBNAIL_QUALITY', 60))
+            _jobs[key] = future
+            logger = app.logger
+            future.add_done_callback(lambda f: _done(key, f, logger))
+    return 'pending'
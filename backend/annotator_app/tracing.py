@@ -0,0 +1,230 @@
+""" Per-request tracing.
+
+Each request is a trace made of nested spans: the request itself, every
+database query, and whatever code wraps itself in `span(name)` (remote
+fetches, PDF rendering, password hashing, JSON encoding). At the end of the
+request, the trace is written to the `annotator_app.trace` logger as one line
+of OTLP/JSON (the OpenTelemetry export format) if the request was sampled
+(`TRACE_SAMPLE_RATE`) or took longer than `TRACE_SLOW_THRESHOLD` seconds.
+
+Every request gets an ID, taken from the `X-Request-ID` header if the proxy set
+one, which is returned in the response's `X-Request-ID` header and added to the
+app's log records. With `LOG_FORMAT = 'json'` the app's log records are also
+written as JSON.
+"""
+from flask import g, request, has_request_context
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from contextlib import contextmanager
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import time
+
+logger = logging.getLogger('annotator_app.trace')
+
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+_request_id_format = re.compile(r'^[0-9a-f]{32}$')
+
+class _Trace(object):
+    def __init__(self, trace_id, max_spans):
+        self.trace_id = trace_id
+        self.max_spans = max_spans
+        self.spans = []
+        self.stack = []
+        self.dropped = 0
+
+    def start(self, name, kind, attributes):
+        parent = self.stack[-1] if len(self.stack) > 0 else None
+        span = {
+            'traceId': self.trace_id,
+            'spanId': os.urandom(8).hex(),
+            'parentSpanId': parent['spanId'] if parent is not None else '',
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': time.time_ns(),
+            'attributes': attributes,
+        }
+        self.stack.append(span)
+        return span
+
+    def end(self, span, error=None):
+        span['endTimeUnixNano'] = time.time_ns()
+        if error is not None:
+            span['status'] = {'code': 2, 'message': str(error)[:500]}
+        for i in range(len(self.stack)-1, -1, -1):
+            if self.stack[i] is span:
+                del self.stack[i]
+                break
+        if len(self.spans) < self.max_spans:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+def _current_trace():
+    if has_request_context():
+        return g.get('trace')
+    return None
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """ Record the block as a span of the current request's trace. Does nothing outside of requests. """
+    trace = _current_trace()
+    if trace is None:
+        yield
+        return
+    s = trace.start(name, kind, attributes)
+    try:
+        yield s
+    except Exception as e:
+        trace.end(s, e)
+        raise
+    trace.end(s)
+
+def request_id():
+    """ ID of the current request, or None outside of requests. """
+    trace = _current_trace()
+    return trace.trace_id if trace is not None else None
+
+##################################################
+# OTLP/JSON
+##################################################
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otlp_span(span):
+    output = dict(span)
+    output['startTimeUnixNano'] = str(span['startTimeUnixNano'])
+    output['endTimeUnixNano'] = str(span['endTimeUnixNano'])
+    output['attributes'] = [{'key': k, 'value': _attribute_value(v)}
+            for k,v in span['attributes'].items() if v is not None]
+    return output
+
+def to_otlp(trace, service_name):
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': service_name}},
+            {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+        ]},
+        'scopeSpans': [{
+            'scope': {'name': 'annotator_app.tracing'},
+            'spans': [_otlp_span(s) for s in trace.spans],
+        }],
+    }]}
+
+##################################################
+# Request hooks
+##################################################
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace()
+    if trace is not None:
+        conn.info.setdefault('trace_spans', []).append(
+                trace.start('db.query', KIND_CLIENT, {'db.statement': statement[:500]}))
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace()
+    spans = conn.info.get('trace_spans')
+    if trace is not None and spans:
+        trace.end(spans.pop())
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    trace = _current_trace()
+    spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+    if trace is not None and spans:
+        trace.end(spans.pop(), context.original_exception)
+
+def _before_request(app):
+    header = request.headers.get('X-Request-ID', '').replace('-', '').lower()
+    trace_id = header if _request_id_format.match(header) else os.urandom(16).hex()
+    g.trace = _Trace(trace_id, app.config.get('TRACE_MAX_SPANS', 1000))
+    g.trace_sampled = random.random() < app.config.get('TRACE_SAMPLE_RATE', 0.01)
+    g.trace_root = g.trace.start('%s %s' % (request.method, request.path), KIND_SERVER, {
+        'http.method': request.method,
+        'http.target': request.full_path.rstrip('?'),
+    })
+
+def _after_request(response):
+    if 'trace' in g:
+        response.headers['X-Request-ID'] = g.trace.trace_id
+        g.trace_root['name'] = '%s %s' % (request.method,
+                request.url_rule.rule if request.url_rule is not None else request.path)
+        g.trace_root['attributes']['http.route'] = request.url_rule.rule if request.url_rule is not None else None
+        g.trace_root['attributes']['http.status_code'] = response.status_code
+    return response
+
+def _teardown_request(app, error):
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    root = g.trace_root
+    trace.end(root, error)
+    for s in list(reversed(trace.stack)): # Spans left open by an exception
+        trace.end(s)
+    duration = (root['endTimeUnixNano']-root['startTimeUnixNano'])/1e9
+    slow = duration >= app.config.get('TRACE_SLOW_THRESHOLD', 1.0)
+    failed = error is not None or root['attributes'].get('http.status_code', 500) >= 500
+    if not (g.trace_sampled or slow or failed):
+        return
+    if trace.dropped > 0:
+        root['attributes']['trace.dropped_spans'] = trace.dropped
+    logger.info(json.dumps(to_otlp(trace, app.config.get('TRACE_SERVICE_NAME', 'annotator')),
+            separators=(',',':')))
+
+##################################################
+# Logging
+##################################################
+
+class RequestIdFilter(logging.Filter):
+    """ Adds the ID of the current request to log records. """
+    def filter(self, record):
+        record.request_id = request_id()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        output = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat()+'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        if record.exc_info:
+            output['exception'] = self.formatException(record.exc_info)
+        return json.dumps(output)
+
+def init_app(app):
+    if app.config.get('TRACE_ENABLED', True):
+        app.before_request(lambda: _before_request(app))
+        app.after_request(_after_request)
+        app.teardown_request(lambda error: _teardown_request(app, error))
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    app.logger.addFilter(RequestIdFilter())
+    if app.config.get('LOG_FORMAT') == 'json':
+        default_handler.setFormatter(JsonFormatter())
+        app.logger.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
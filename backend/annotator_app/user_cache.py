@@ -0,0 +1,86 @@
+""" Cache of logged in users, saving a query per request.
+
+Each process keeps the users it loaded for `USER_CACHE_TTL` seconds, evicting
+the least recently used beyond `MAX_CACHED_USERS`. `invalidate` removes a user
+from this process, and changes the user's version in the shared tier of
+`annotator_app.cache`, so that the other processes load the user again on
+their next request. Without a shared tier (`CACHE_ENABLED = False` or
+`CACHE_BACKEND = 'local'`), the other processes keep using the old user, e.g.
+the old password hash, for up to `USER_CACHE_TTL` seconds.
+"""
+from flask import current_app
+from flask_security.utils import set_request_attr
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from collections import OrderedDict
+import threading
+import time
+
+from annotator_app import cache
+from annotator_app.extensions import db
+from annotator_app.database import User, Role, user_datastore
+
+# fs_uniquifier -> (expiry time, version, detached copy of the user), least recently used first
+_cache = OrderedDict()
+_lock = threading.Lock()
+MAX_CACHED_USERS = 10000
+
+def _detached_copy(entity, model):
+    copy = model()
+    for column in model.__table__.columns:
+        set_committed_value(copy, column.key, getattr(entity, column.key))
+    make_transient_to_detached(copy)
+    return copy
+
+def _snapshot(user):
+    """ Copy the user and their roles into objects that are not attached to any session. """
+    copy = _detached_copy(user, User)
+    set_committed_value(copy, 'roles', [_detached_copy(r, Role) for r in user.roles])
+    return copy
+
+def load_user(user_id):
+    """ Replacement for Flask-Security's user loader.
+
+    Users are looked up by `fs_uniquifier` and cached for `USER_CACHE_TTL`
+    seconds, or until their version changes. Cached users are merged into the
+    current session without querying the database.
+    """
+    user_id = str(user_id)
+    ttl = current_app.config.get('USER_CACHE_TTL', 10)
+    if ttl <= 0:
+        user = user_datastore.find_user(fs_uniquifier=user_id)
+    else:
+        now = time.monotonic()
+        version = cache.get_version('login:%s' % user_id)
+        with _lock:
+            entry = _cache.get(user_id)
+            hit = entry is not None and entry[0] > now and entry[1] == version
+            if hit:
+                _cache.move_to_end(user_id)
+        if hit:
+            user = db.session.merge(entry[2], load=False)
+        else:
+            user = user_datastore.find_user(fs_uniquifier=user_id)
+            if user is not None:
+                with _lock:
+                    _cache[user_id] = (now+ttl, version, _snapshot(user))
+                    _cache.move_to_end(user_id)
+                    while len(_cache) > MAX_CACHED_USERS:
+                        _cache.popitem(last=False)
+    if user is None:
+        return None
+
+    if not user.active:
+        return None
+    set_request_attr('fs_authn_via', 'session')
+    return user
+
+def invalidate(user):
+    """ Remove a user from the cache of every process. Must be called whenever the user's row is modified. """
+    with _lock:
+        _cache.pop(str(user.fs_uniquifier), None)
+    cache.new_version('login:%s' % user.fs_uniquifier)
+
+def init_app(app):
+    app.login_manager.user_loader(load_user)
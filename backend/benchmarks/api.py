@@ -0,0 +1,190 @@
+""" Benchmark the REST API's hot endpoints against a database of synthetic data.
+
+The real Flask app is driven with its test client. For each scenario the
+report records latency percentiles, the number of database queries per
+request, and the peak memory allocated while handling a request. The response
+cache is disabled, so that the work of each request is measured, unless
+`--cache` is given to measure warm runs.
+
+Usage:
+    python -m benchmarks.api [--database sqlite:////tmp/annotator-bench.db] [--cache] [--output report.json]
+    python -m benchmarks.api --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from benchmarks import seed
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values)-1)*p/100
+    lower = int(k)
+    upper = min(lower+1, len(values)-1)
+    return values[lower]+(values[upper]-values[lower])*(k-lower)
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+    def __call__(self, *args):
+        self.count += 1
+
+def scenarios(doc_ids, rng):
+    """ (name, function that makes one request and returns the response) pairs. """
+    def login(client):
+        return client.post('/api/auth/login', json={'email': seed.user_email(0), 'password': seed.PASSWORD, 'permanent': True})
+    def list_entities(name):
+        return lambda client: client.get('/api/data/%s' % name)
+    def recursive(client):
+        return client.get('/api/data/documents/%d/recursive' % rng.choice(doc_ids))
+    created = []
+    def create_annotation(client):
+        response = client.post('/api/data/annotations', json={
+            'doc_id': rng.choice(doc_ids), 'page': rng.randint(1, 30), 'type': 'point',
+            'position': {'coords': [rng.uniform(0, 600), rng.uniform(0, 800)]},
+        })
+        created.extend(int(i) for i in response.get_json()['new_entities']['annotations'])
+        return response
+    def update_annotation(client):
+        return client.put('/api/data/annotations/%d' % rng.choice(created), json={
+            'position': {'coords': [rng.uniform(0, 600), rng.uniform(0, 800)]},
+        })
+    return [
+        ('login', login),
+        ('list_documents', list_entities('documents')),
+        ('list_notes', list_entities('notes')),
+        ('list_tags', list_entities('tags')),
+        ('recursive_document', recursive),
+        ('create_annotation', create_annotation),
+        ('update_annotation', update_annotation),
+    ]
+
+def run(args):
+    from annotator_app import create_app, db
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database,
+        'QUERY_TRACKER_ENABLED': False,
+        'CACHE_ENABLED': args.cache,
+    })
+    rng = random.Random(args.seed)
+
+    # No app context is kept for the requests, so that each has its own session and identity map, as when served
+    with app.app_context():
+        start = time.perf_counter()
+        doc_ids = seed.seed(args.users, args.documents, args.tags, args.annotations, args.notes, args.seed)[1]
+        seed_time = time.perf_counter()-start
+        engine = db.engine
+
+    counter = QueryCounter(engine)
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': seed.user_email(0), 'password': seed.PASSWORD})
+    assert response.status_code == 200, response.data
+
+    results = {}
+    for name, request in scenarios(doc_ids, rng):
+        iterations = args.login_iterations if name == 'login' else args.iterations
+        latencies = []
+        queries = []
+        for _ in range(args.warmup):
+            request(client)
+        for _ in range(iterations):
+            counter.count = 0
+            start = time.perf_counter()
+            response = request(client)
+            latencies.append(time.perf_counter()-start)
+            queries.append(counter.count)
+            assert response.status_code == 200, (name, response.status_code, response.data)
+        # Memory is measured separately since tracing allocations slows everything down
+        peaks = []
+        for _ in range(min(iterations, 5)):
+            tracemalloc.start()
+            request(client)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        results[name] = {
+            'iterations': iterations,
+            'p50_ms': percentile(latencies, 50)*1000,
+            'p95_ms': percentile(latencies, 95)*1000,
+            'mean_ms': statistics.mean(latencies)*1000,
+            'queries_per_request': statistics.mean(queries),
+            'peak_alloc_kib': max(peaks)/1024,
+            'response_bytes': len(response.data),
+        }
+        print('%-20s p50 %8.2f ms  p95 %8.2f ms  queries %6.1f  peak %9.1f KiB' % (
+            name, results[name]['p50_ms'], results[name]['p95_ms'],
+            results[name]['queries_per_request'], results[name]['peak_alloc_kib']))
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': engine.dialect.name,
+        'parameters': {k: getattr(args, k) for k in ['users', 'documents', 'tags', 'annotations', 'notes', 'seed', 'iterations', 'cache']},
+        'seed_seconds': seed_time,
+        'max_rss_kib': max_rss_kib(),
+        'results': results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def max_rss_kib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024 if sys.platform == 'darwin' else rss
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print('%s -> %s' % ((before.get('commit') or '?')[:8], (after.get('commit') or '?')[:8]))
+    if before['parameters'].get('cache', False) != after['parameters'].get('cache', False):
+        print('Warning: only one of the reports was made with the cache enabled')
+    for name, b in before['results'].items():
+        a = after['results'].get(name)
+        if a is None:
+            continue
+        print('%-20s p50 %8.2f -> %8.2f ms (%+6.1f%%)  p95 %8.2f -> %8.2f ms  queries %6.1f -> %6.1f' % (
+            name, b['p50_ms'], a['p50_ms'], (a['p50_ms']/b['p50_ms']-1)*100,
+            b['p95_ms'], a['p95_ms'], b['queries_per_request'], a['queries_per_request']))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='sqlite:////tmp/annotator-bench.db',
+            help='SQLAlchemy database URI. All tables in it are dropped.')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--login-iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--cache', action='store_true', help='Enable the response cache, to measure warm runs')
+    parser.add_argument('--output', help='File to write the JSON report to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two reports')
+    seed.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+""" Compare the bytes on the wire and the CPU time of response compression settings.
+
+Libraries of a few sizes are seeded, and the uncompressed bodies of the
+list endpoints and the NDJSON export are compressed with each gzip level and
+brotli quality (if the `brotli` package is installed). The export is
+compressed in 64 KiB chunks with a flush after each one, as it is when
+streamed.
+
+Usage: python -m benchmarks.compression [--sizes 50,500,2000] [--repeat 5] [--output report.json]
+"""
+import argparse
+import json
+import statistics
+import time
+
+from annotator_app import compression
+from annotator_app.resources.export import CHUNK_SIZE
+from benchmarks import seed
+
+ENDPOINTS = ['/api/data/documents', '/api/data/notes', '/api/data/annotations', '/api/data/export?format=ndjson']
+
+def settings():
+    output = [('gzip', level) for level in (1, 6, 9)]
+    if 'br' in compression.available_encodings():
+        output += [('br', quality) for quality in (1, 4, 6, 9)]
+    return output
+
+def fetch_bodies(app, documents, seed_value):
+    with app.app_context():
+        seed.seed(documents=documents, annotations=10, seed=seed_value)
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': seed.user_email(0), 'password': seed.PASSWORD})
+    assert response.status_code == 200, response.data
+    bodies = {}
+    for endpoint in ENDPOINTS:
+        response = client.get(endpoint, headers={'Accept-Encoding': 'identity'})
+        assert response.status_code == 200, (endpoint, response.data)
+        bodies[endpoint] = response.get_data()
+    return bodies
+
+def measure(body, encoding, level, streamed, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if streamed:
+            chunks = (body[i:i+CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+            compressed = b''.join(compression.compress_stream(chunks, encoding, level))
+        else:
+            compressed = compression.compress(body, encoding, level)
+        times.append(time.perf_counter()-start)
+    seconds = statistics.median(times)
+    return {
+        'bytes': len(compressed),
+        'ratio': len(body)/len(compressed),
+        'cpu_ms': seconds*1000,
+        'mb_per_s': len(body)/seconds/1e6,
+    }
+
+def run(args):
+    from annotator_app import create_app
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database,
+        'QUERY_TRACKER_ENABLED': False,
+        'TRACE_ENABLED': False,
+    })
+    results = []
+    for documents in [int(s) for s in args.sizes.split(',')]:
+        bodies = fetch_bodies(app, documents, args.seed)
+        for endpoint, body in bodies.items():
+            streamed = 'export' in endpoint
+            row = {'documents': documents, 'endpoint': endpoint, 'identity_bytes': len(body), 'settings': {}}
+            print('%5d documents  %-32s %10d bytes' % (documents, endpoint, len(body)))
+            for encoding, level in settings():
+                result = measure(body, encoding, level, streamed, args.repeat)
+                row['settings']['%s-%d' % (encoding, level)] = result
+                print('    %-5s %2d  %10d bytes  x%5.1f  %8.2f ms  %7.1f MB/s' % (
+                    encoding, level, result['bytes'], result['ratio'], result['cpu_ms'], result['mb_per_s']))
+            results.append(row)
+    return {'results': results}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='sqlite:////tmp/annotator-bench.db',
+            help='SQLAlchemy database URI. All tables in it are dropped.')
+    parser.add_argument('--sizes', default='50,500,2000', help='Comma-separated numbers of documents in the library')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to write the JSON report to')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+""" Load test a running server with concurrent simulated annotating users.
+
+Each simulated user repeatedly runs an annotate session: log in, list
+documents, open a document (`/recursive` and `/pdf`), create and move
+annotations, write and edit a note, and fetch snippet images. Documents
+point to a local stub server that stands in for remote PDF hosts.
+
+The concurrency is raised step by step, and throughput and latency
+percentiles are reported for each step.
+
+Usage:
+    # Seed the database used by the server, then start the server, e.g.
+    python -m benchmarks.loadtest seed --database postgresql://... --users 32
+    uwsgi --ini app.ini --http :5000
+    # Run the load test
+    python -m benchmarks.loadtest run --url http://localhost:5000 --users 32 --concurrency 1,2,4,8,16,32
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from benchmarks import seed
+from benchmarks.api import percentile
+
+STUB_PORT = 8765
+
+##################################################
+# Stub PDF host
+##################################################
+
+def make_pdf(pages=10):
+    """ A small valid PDF with some text on each page. """
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            b' '.join(b'%d 0 R' % (4+2*i) for i in range(pages)), pages),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i in range(pages):
+        text = b'BT /F1 24 Tf 72 720 Td (Synthetic page %d) Tj ET' % (i+1)
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (5+2*i))
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(text), text))
+    output = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n%s\nendobj\n' % (i+1, obj)
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects)+1)
+    output += b''.join(b'%010d 00000 n \n' % o for o in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects)+1, xref)
+    return output
+
+class StubPdfHandler(BaseHTTPRequestHandler):
+    pdf = make_pdf()
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(self.pdf)))
+        self.end_headers()
+        self.wfile.write(self.pdf)
+    def log_message(self, *args):
+        pass
+
+def start_stub_server(port=STUB_PORT):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubPdfHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+##################################################
+# Simulated session
+##################################################
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sessions = 0
+    def request(self, http, name, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = http.request(method, url, timeout=60, **kwargs)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            response, ok = None, False
+        duration = time.perf_counter()-start
+        with self.lock:
+            self.latencies[name].append(duration)
+            if not ok:
+                self.errors[name] += 1
+        return response if ok else None
+
+def annotate_session(base_url, user_index, recorder, rng, think_time):
+    api = base_url.rstrip('/')+'/api'
+    def think():
+        if think_time > 0:
+            time.sleep(rng.uniform(0, 2*think_time))
+    with requests.Session() as http:
+        r = recorder.request(http, 'login', 'POST', api+'/auth/login',
+                json={'email': seed.user_email(user_index), 'password': seed.PASSWORD})
+        if r is None:
+            return
+        r = recorder.request(http, 'list_documents', 'GET', api+'/data/documents')
+        if r is None or len(r.json()['entities']) == 0:
+            return
+        doc_id = int(rng.choice(list(r.json()['entities']['documents'])))
+        recorder.request(http, 'recursive_document', 'GET', api+'/data/documents/%d/recursive' % doc_id)
+        recorder.request(http, 'pdf', 'GET', api+'/data/documents/%d/pdf' % doc_id)
+        think()
+
+        ann_ids = []
+        for _ in range(3):
+            left, top = rng.uniform(50, 400), rng.uniform(50, 600)
+            r = recorder.request(http, 'create_annotation', 'POST', api+'/data/annotations', json={
+                'doc_id': doc_id, 'page': rng.randint(1, 10), 'type': 'rect',
+                'position': {'box': [top, left+100, top+50, left]},
+            })
+            if r is not None:
+                ann_ids.extend(int(i) for i in r.json()['new_entities']['annotations'])
+            think()
+        for ann_id in ann_ids:
+            left, top = rng.uniform(50, 400), rng.uniform(50, 600)
+            recorder.request(http, 'move_annotation', 'PUT', api+'/data/annotations/%d' % ann_id, json={
+                'position': {'box': [top, left+100, top+50, left]},
+            })
+        if len(ann_ids) > 0:
+            r = recorder.request(http, 'create_note', 'POST', api+'/data/notes', json={
+                'body': 'First thoughts', 'parser': 'markdown', 'annotation_id': ann_ids[0],
+            })
+            if r is not None:
+                note_id = int(list(r.json()['new_entities']['notes'])[0])
+                for i in range(3):
+                    think()
+                    recorder.request(http, 'edit_note', 'PUT', api+'/data/notes/%d' % note_id, json={
+                        'body': 'First thoughts' + ' and more'*(i+1),
+                    })
+            for ann_id in ann_ids:
+                recorder.request(http, 'annotation_image', 'GET', api+'/data/annotations/%d/img' % ann_id)
+    with recorder.lock:
+        recorder.sessions += 1
+
+def run_step(base_url, concurrency, duration, users, think_time, seed_value):
+    recorder = Recorder()
+    deadline = time.monotonic()+duration
+    def worker(i):
+        rng = random.Random(seed_value*1000+i)
+        while time.monotonic() < deadline:
+            annotate_session(base_url, i % users, recorder, rng, think_time)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic()-start
+
+    all_latencies = [l for ls in recorder.latencies.values() for l in ls]
+    summary = lambda ls: {
+        'count': len(ls),
+        'p50_ms': percentile(ls, 50)*1000,
+        'p95_ms': percentile(ls, 95)*1000,
+        'p99_ms': percentile(ls, 99)*1000,
+        'mean_ms': statistics.mean(ls)*1000,
+    }
+    return {
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'sessions': recorder.sessions,
+        'requests': len(all_latencies),
+        'requests_per_second': len(all_latencies)/elapsed,
+        'errors': sum(recorder.errors.values()),
+        'overall': summary(all_latencies) if all_latencies else None,
+        'by_request': {name: dict(summary(ls), errors=recorder.errors[name])
+            for name, ls in sorted(recorder.latencies.items())},
+    }
+
+##################################################
+# Commands
+##################################################
+
+def seed_command(args):
+    from annotator_app import create_app
+    with create_app({'SQLALCHEMY_DATABASE_URI': args.database}).app_context():
+        seed.seed(args.users, args.documents, args.tags, args.annotations, args.notes, args.seed,
+                pdf_url='http://127.0.0.1:%d/papers/%%d.pdf' % args.stub_port)
+    print('Seeded %s. Documents point to the stub PDF host on port %d.' % (args.database, args.stub_port))
+
+def run_command(args):
+    server = start_stub_server(args.stub_port)
+    results = []
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            result = run_step(args.url, concurrency, args.duration, args.users, args.think_time, args.seed)
+            results.append(result)
+            overall = result['overall'] or {}
+            print('concurrency %3d  %7.1f req/s  %5d sessions  p50 %8.1f ms  p95 %8.1f ms  p99 %8.1f ms  errors %d' % (
+                concurrency, result['requests_per_second'], result['sessions'],
+                overall.get('p50_ms', 0), overall.get('p95_ms', 0), overall.get('p99_ms', 0), result['errors']))
+    finally:
+        server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': args.url, 'think_time': args.think_time, 'steps': results}, f, indent=2)
+        print('Report written to %s' % args.output)
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help='Seed the database used by the server under test')
+    seed_parser.add_argument('--database', required=True, help='SQLAlchemy database URI. All tables in it are dropped.')
+    seed_parser.add_argument('--stub-port', type=int, default=STUB_PORT)
+    seed.add_arguments(seed_parser)
+
+    run_parser = subparsers.add_parser('run', help='Run the load test')
+    run_parser.add_argument('--url', default='http://localhost:5000')
+    run_parser.add_argument('--users', type=int, default=1, help='Number of seeded users to log in as')
+    run_parser.add_argument('--concurrency', default='1,2,4,8,16', help='Comma-separated numbers of simultaneous users')
+    run_parser.add_argument('--duration', type=float, default=30, help='Seconds per concurrency step')
+    run_parser.add_argument('--think-time', type=float, default=0, help='Mean seconds between user actions')
+    run_parser.add_argument('--stub-port', type=int, default=STUB_PORT)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='File to write the JSON report to')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed_command(args)
+    else:
+        run_command(args)
+
+if __name__ == '__main__':
+    main()
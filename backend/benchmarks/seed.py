@@ -0,0 +1,124 @@
+""" Fill a database with synthetic users, documents, tags, annotations and notes.
+
+Usage: python -m benchmarks.seed --database sqlite:////tmp/annotator-bench.db [--documents 200 ...]
+"""
+import argparse
+import datetime
+import random
+
+import bcrypt
+
+from annotator_app.extensions import db
+from annotator_app import cache
+from annotator_app.database import User, Document, Annotation, Note, Tag, documents_tags, notes_tags, position_to_bbox
+
+PASSWORD = 'password'
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--documents', type=int, default=200, help='Documents per user')
+    parser.add_argument('--tags', type=int, default=20, help='Tags per user')
+    parser.add_argument('--annotations', type=int, default=20, help='Annotations per document')
+    parser.add_argument('--notes', type=float, default=0.5, help='Fraction of annotations with a note')
+    parser.add_argument('--seed', type=int, default=0)
+
+def user_email(i):
+    return 'user%d@example.com' % i
+
+def seed(users=1, documents=200, tags=20, annotations=20, notes=0.5, seed=0, pdf_url=None):
+    """ Drop and recreate all tables, then insert synthetic data.
+
+    `pdf_url`, if given, is a format string with the document ID, used as each document's URL.
+    Returns the IDs of the created documents, by user ID.
+    """
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    cache.clear()
+
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(12))
+    now = datetime.datetime.utcnow()
+    next_ids = {'documents': 1, 'tags': 1, 'annotations': 1, 'notes': 1}
+    def new_id(table):
+        i = next_ids[table]
+        next_ids[table] += 1
+        return i
+
+    doc_ids = {}
+    for u in range(users):
+        user_id = u+1
+        db.session.bulk_insert_mappings(User, [{
+            'id': user_id, 'email': user_email(u), 'password': password, 'active': True,
+            'fs_uniquifier': 'bench-user-%d' % u,
+        }])
+        tag_rows = [{'id': new_id('tags'), 'user_id': user_id, 'name': 'tag%d' % t, 'description': 'Tag %d' % t}
+                for t in range(tags)]
+        doc_rows, doc_tag_rows = [], []
+        ann_rows, note_rows, note_tag_rows = [], [], []
+        for d in range(documents):
+            doc_id = new_id('documents')
+            doc_rows.append({
+                'id': doc_id, 'user_id': user_id,
+                'url': pdf_url % doc_id if pdf_url else 'https://example.com/papers/%d.pdf' % doc_id,
+                'title': 'Synthetic paper %d' % doc_id, 'author': 'Author %d, Author %d' % (d, d+1),
+                'bibtex': '@article{paper%d,\n  title={Synthetic paper %d},\n  author={Author %d and Author %d},\n  year={%d}\n}' % (
+                    doc_id, doc_id, d, d+1, 2000+d%20),
+                'read': rng.random() < 0.5, 'created_at': now, 'last_modified_at': now,
+            })
+            for tag in rng.sample(tag_rows, min(2, len(tag_rows))):
+                doc_tag_rows.append({'document_id': doc_id, 'tag_id': tag['id']})
+            for a in range(annotations):
+                if rng.random() < 0.5:
+                    left, top = rng.uniform(0, 500), rng.uniform(0, 700)
+                    position = {'box': [top, left+rng.uniform(10,100), top+rng.uniform(10,50), left]}
+                    ann_type = 'rect'
+                else:
+                    position = {'coords': [rng.uniform(0, 600), rng.uniform(0, 800)]}
+                    ann_type = 'point'
+                bbox = position_to_bbox(position)
+                ann = {
+                    'id': new_id('annotations'), 'user_id': user_id, 'doc_id': doc_id,
+                    'page': rng.randint(1, 30), 'type': ann_type, 'position': position,
+                    'bbox_left': bbox[0], 'bbox_top': bbox[1], 'bbox_right': bbox[2], 'bbox_bottom': bbox[3],
+                }
+                if rng.random() < notes:
+                    note_id = new_id('notes')
+                    note_rows.append({
+                        'id': note_id, 'user_id': user_id, 'parser': 'markdown',
+                        'body': '# Note %d\n\n' % note_id + ' '.join('word%d' % rng.randint(0,1000) for _ in range(rng.randint(10,200))),
+                        'created_at': now, 'last_modified_at': now,
+                    })
+                    ann['note_id'] = note_id
+                    if rng.random() < 0.3:
+                        note_tag_rows.append({'note_id': note_id, 'tag_id': rng.choice(tag_rows)['id']})
+                ann_rows.append(ann)
+            doc_ids.setdefault(user_id, []).append(doc_id)
+        db.session.bulk_insert_mappings(Tag, tag_rows)
+        db.session.bulk_insert_mappings(Note, note_rows)
+        db.session.bulk_insert_mappings(Document, doc_rows)
+        db.session.bulk_insert_mappings(Annotation, ann_rows)
+        if len(doc_tag_rows) > 0:
+            db.session.execute(documents_tags.insert(), doc_tag_rows)
+        if len(note_tag_rows) > 0:
+            db.session.execute(notes_tags.insert(), note_tag_rows)
+        db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        # IDs were set explicitly, so the sequences have to be moved past them
+        for table in ['users', 'documents', 'tags', 'annotations', 'notes']:
+            db.session.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), COALESCE(MAX(id), 1)) FROM %s" % (table, table))
+        db.session.commit()
+    return doc_ids
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', required=True, help='SQLAlchemy database URI. All tables in it are dropped.')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    from annotator_app import create_app
+    with create_app({'SQLALCHEMY_DATABASE_URI': args.database}).app_context():
+        seed(args.users, args.documents, args.tags, args.annotations, args.notes, args.seed)
+    print('Seeded %s' % args.database)
+
+if __name__ == '__main__':
+    main()
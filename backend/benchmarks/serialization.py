@@ -0,0 +1,106 @@
+""" Compare response encoding time for documents and annotations.
+
+"before" reproduces the hand-written `to_dict` methods and flask_restful's
+default `json.dumps`. "after" uses the compiled serializers and the configured
+response encoder.
+
+Usage: python -m benchmarks.serialization [--count 10000] [--repeat 5]
+"""
+import argparse
+import datetime
+import json
+import random
+import time
+
+from annotator_app import encoding
+from annotator_app.database import Document, Annotation, Tag
+
+def legacy_document_to_dict(self):
+    return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'url': self.url,
+            'title': self.title,
+            'author': self.author,
+            'bibtex': self.bibtex,
+            'read': self.read,
+            'note_id': self.note_id,
+            'deleted_at': self.deleted_at.strftime('%Y-%m-%d') if self.deleted_at is not None else None,
+            'last_modified_at': self.last_modified_at.replace(tzinfo=datetime.timezone.utc).isoformat(),
+            'last_accessed_at': self.last_accessed_at.replace(tzinfo=datetime.timezone.utc).isoformat(),
+            'tag_names': list(self.tag_names),
+            'tag_ids': list(self.tag_ids),
+    }
+
+def legacy_annotation_to_dict(self):
+    return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'note_id': self.note_id,
+            'doc_id': self.doc_id,
+            'page': self.page,
+            'type': self.type,
+            'position': json.loads(self.legacy_position),
+            'deleted_at': self.deleted_at.strftime('%Y-%m-%d') if self.deleted_at is not None else None
+    }
+
+def make_documents(count):
+    tags = [Tag(id=i, user_id=1, name='tag%d' % i) for i in range(10)]
+    now = datetime.datetime.utcnow()
+    docs = []
+    for i in range(count):
+        doc = Document(id=i, user_id=1, url='https://arxiv.org/pdf/2101.%05d.pdf' % i,
+                title='Title %d' % i, author='Author %d' % i,
+                bibtex='@article{key%d, title={Title %d}, author={Author %d}, year={2021}}' % (i,i,i),
+                read=bool(i%2), last_modified_at=now, last_accessed_at=now)
+        doc.tags = random.sample(tags, 2)
+        docs.append(doc)
+    return docs
+
+def make_annotations(count):
+    anns = []
+    for i in range(count):
+        if i % 2 == 0:
+            position = {'box': [random.random()*800 for _ in range(4)]}
+            ann_type = 'rect'
+        else:
+            position = {'coords': [random.random()*600, random.random()*800]}
+            ann_type = 'point'
+        ann = Annotation(id=i, user_id=1, doc_id=i%100, page=i%20, type=ann_type, position=position)
+        ann.legacy_position = json.dumps(position) # Positions used to be stored as JSON strings
+        anns.append(ann)
+    return anns
+
+def entities_to_dict(entities, to_dict):
+    output = {}
+    for e in entities:
+        output.setdefault(e.__tablename__, {})[e.id] = to_dict(e)
+    return output
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ('documents', make_documents(args.count), legacy_document_to_dict),
+        ('annotations', make_annotations(args.count), legacy_annotation_to_dict),
+    ]
+    print('Encoder: %s' % encoding.dumps.__name__)
+    for name, entities, legacy in cases:
+        before = timeit(lambda: json.dumps({'entities': entities_to_dict(entities, legacy)}), args.repeat)
+        after = timeit(lambda: encoding.dumps({'entities': entities_to_dict(entities, lambda e: e.to_dict())}), args.repeat)
+        print('%-12s n=%d  before: %7.1f ms  after: %7.1f ms  speedup: %.2fx' % (
+            name, len(entities), before*1000, after*1000, before/after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+""" Benchmark how long it takes to start the app.
+
+Each run is a fresh interpreter that imports `annotator_app`, calls
+`create_app()` and handles a first request (a failed login, which queries the
+database). The report has the median time of each step, the time from
+spawning the process to the first response, and which of the slow optional
+modules were imported by then. With `--fork`, the app also makes a query and
+forks before the first request, as uWSGI does without `lazy-apps`, to check that
+the worker does not reuse the parent's database connection.
+
+Usage:
+    python -m benchmarks.startup [--runs 10] [--importtime] [--output report.json]
+    python -m benchmarks.startup --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.api import git_commit
+
+LAZY_MODULES = ['bs4', 'pdf2image', 'PIL.Image', 'PyPDF2', 'flasgger']
+
+CHILD = '''
+import json, os, sys, time
+start = time.perf_counter()
+import annotator_app
+imported = time.perf_counter()
+app = annotator_app.create_app({'SQLALCHEMY_DATABASE_URI': %(database)r})
+created = time.perf_counter()
+if %(setup)r:
+    with app.app_context():
+        annotator_app.db.create_all()
+    sys.exit(0)
+if %(fork)r:
+    with app.app_context():
+        annotator_app.db.session.execute('SELECT 1')
+        annotator_app.db.session.commit()
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        sys.exit(0)
+lazy_before = [m for m in %(lazy)r if m in sys.modules]
+response = app.test_client().post('/api/auth/login', json={'email': 'nobody@example.com', 'password': 'x'})
+responded = time.perf_counter()
+print(json.dumps({
+    'import_s': imported-start,
+    'create_app_s': created-imported,
+    'first_request_s': responded-created,
+    'status': response.status_code,
+    'lazy_modules_at_startup': lazy_before,
+}))
+'''
+
+def run_child(database, setup=False, fork=False, importtime=False):
+    code = CHILD % {'database': database, 'setup': setup, 'fork': fork, 'lazy': LAZY_MODULES}
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    total = time.perf_counter()-start
+    if setup:
+        return None
+    result = json.loads(process.stdout.decode().strip().splitlines()[-1])
+    result['process_s'] = total
+    if importtime:
+        result['importtime'] = parse_importtime(process.stderr.decode())
+    return result
+
+def parse_importtime(output, top=15):
+    """ Modules with the largest cumulative import time, in microseconds. """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only modules imported directly by annotator_app or the top level
+        if len(name) - len(name.lstrip()) <= 3:
+            modules.append((int(cumulative), name.strip()))
+    return [[name, us] for us, name in sorted(modules, reverse=True)[:top]]
+
+def run(args):
+    run_child(args.database, setup=True)
+    runs = [run_child(args.database, fork=args.fork) for _ in range(args.runs)]
+    median = lambda key: statistics.median(r[key] for r in runs)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'fork': args.fork,
+        'import_ms': median('import_s')*1000,
+        'create_app_ms': median('create_app_s')*1000,
+        'first_request_ms': median('first_request_s')*1000,
+        'cold_start_ms': median('process_s')*1000,
+        'first_request_status': runs[0]['status'],
+        'lazy_modules_at_startup': runs[0]['lazy_modules_at_startup'],
+    }
+    print('import %8.1f ms  create_app %7.1f ms  first request %7.1f ms  process to first response %8.1f ms' % (
+        report['import_ms'], report['create_app_ms'], report['first_request_ms'], report['cold_start_ms']))
+    print('Slow modules imported at startup: %s' % (', '.join(report['lazy_modules_at_startup']) or 'none'))
+    if args.importtime:
+        report['importtime'] = run_child(args.database, importtime=True)['importtime']
+        for name, us in report['importtime']:
+            print('  %-50s %8.1f ms' % (name, us/1000))
+    return report
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print('%s -> %s' % ((before.get('commit') or '?')[:8], (after.get('commit') or '?')[:8]))
+    for key in ['import_ms', 'create_app_ms', 'first_request_ms', 'cold_start_ms']:
+        print('%-18s %8.1f -> %8.1f ms (%+6.1f%%)' % (key, before[key], after[key], (after[key]/before[key]-1)*100))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', default='sqlite:////tmp/annotator-startup.db',
+            help='SQLAlchemy database URI. Tables are created if they do not exist.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--fork', action='store_true', help='Fork after creating the app, as a preloading server does')
+    parser.add_argument('--importtime', action='store_true', help='Also list the slowest imports')
+    parser.add_argument('--output', help='File to write the JSON report to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two reports')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
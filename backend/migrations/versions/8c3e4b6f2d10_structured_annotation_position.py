@@ -0,0 +1,85 @@
+"""Structured annotation position
+
+Revision ID: 8c3e4b6f2d10
+Revises: 5d1f0c7a9b21
+Create Date: 2026-10-19 10:03:27.551806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3e4b6f2d10'
+down_revision = '5d1f0c7a9b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('annotations', 'page',
+            existing_type=sa.String(),
+            type_=sa.Integer(),
+            postgresql_using='page::integer')
+    op.alter_column('annotations', 'position',
+            existing_type=sa.String(),
+            type_=postgresql.JSONB(),
+            postgresql_using='position::jsonb')
+    op.add_column('annotations', sa.Column('bbox_left', sa.Float(), nullable=True))
+    op.add_column('annotations', sa.Column('bbox_top', sa.Float(), nullable=True))
+    op.add_column('annotations', sa.Column('bbox_right', sa.Float(), nullable=True))
+    op.add_column('annotations', sa.Column('bbox_bottom', sa.Float(), nullable=True))
+    # Rect positions are {"box": [top, right, bottom, left]}, points are {"coords": [x, y]}
+    op.execute("""
+        UPDATE annotations SET
+            bbox_left = (position->'box'->>3)::float,
+            bbox_top = (position->'box'->>0)::float,
+            bbox_right = (position->'box'->>1)::float,
+            bbox_bottom = (position->'box'->>2)::float
+        WHERE position ? 'box'
+    """)
+    op.execute("""
+        UPDATE annotations SET
+            bbox_left = (position->'coords'->>0)::float,
+            bbox_top = (position->'coords'->>1)::float,
+            bbox_right = (position->'coords'->>0)::float,
+            bbox_bottom = (position->'coords'->>1)::float
+        WHERE position ? 'coords'
+    """)
+    # Highlights are {"points": [[x, y], ...]}
+    op.execute("""
+        UPDATE annotations SET
+            bbox_left = bbox.left_,
+            bbox_top = bbox.top_,
+            bbox_right = bbox.right_,
+            bbox_bottom = bbox.bottom_
+        FROM (
+            SELECT a.id,
+                min((p->>0)::float) AS left_,
+                min((p->>1)::float) AS top_,
+                max((p->>0)::float) AS right_,
+                max((p->>1)::float) AS bottom_
+            FROM annotations a, jsonb_array_elements(a.position->'points') p
+            WHERE a.position ? 'points'
+            GROUP BY a.id
+        ) bbox
+        WHERE annotations.id = bbox.id
+    """)
+    op.create_index('ix_annotations_doc_id_page', 'annotations', ['doc_id', 'page'])
+
+
+def downgrade():
+    op.drop_index('ix_annotations_doc_id_page', table_name='annotations')
+    op.drop_column('annotations', 'bbox_bottom')
+    op.drop_column('annotations', 'bbox_right')
+    op.drop_column('annotations', 'bbox_top')
+    op.drop_column('annotations', 'bbox_left')
+    op.alter_column('annotations', 'position',
+            existing_type=postgresql.JSONB(),
+            type_=sa.String(),
+            postgresql_using='position::text')
+    op.alter_column('annotations', 'page',
+            existing_type=sa.Integer(),
+            type_=sa.String(),
+            postgresql_using='page::text')
@@ -5,11 +5,38 @@ import sys
 if len(sys.argv) == 2:
     if sys.argv[1] == 'create_db':
         print('Creating all tables')
-        import annotator_app
-        from annotator_app import db
-        db.create_all()
+        from annotator_app import create_app, db, cache
+        with create_app().app_context():
+            db.create_all()
+            cache.clear()
     elif sys.argv[1] == 'drop_db':
         print('Dropping all tables')
-        import annotator_app
-        from annotator_app import db
-        db.drop_all()
+        from annotator_app import create_app, db, cache
+        with create_app().app_context():
+            db.drop_all()
+            cache.clear()
+    elif sys.argv[1] == 'send_mail':
+        print('Delivering queued emails')
+        from annotator_app import create_app
+        from annotator_app.outbox import run_sender
+        run_sender(create_app())
+    elif sys.argv[1] == 'purge':
+        print('Purging deleted entities')
+        from annotator_app import create_app
+        from annotator_app.purge import run_purge
+        run_purge(create_app())
+elif len(sys.argv) in (4,5) and sys.argv[1] == 'import_documents':
+    # run.py import_documents <email> <file> [bibtex|csv]
+    from annotator_app import create_app, importer
+    from annotator_app.database import User
+    with create_app().app_context():
+        user = User.query.filter_by(email=sys.argv[2]).first()
+        if user is None:
+            sys.exit('No user with email %s' % sys.argv[2])
+        file_format = sys.argv[4] if len(sys.argv) == 5 else importer.guess_format(sys.argv[3])
+        with open(sys.argv[3], encoding='utf-8-sig') as f:
+            documents = importer.parse_file(f.read(), file_format)
+        for progress in importer.import_documents(user.id, documents):
+            print('%(imported)d/%(total)d imported, %(skipped)d skipped, %(enriched)d enriched' % progress)
+        for error in progress['errors']:
+            print(error)
@@ -0,0 +1,73 @@
+""" Fixtures for the backend's tests.
+
+Like the benchmarks, the tests need the instance's `config.py`. They replace its
+database, storage and cache with temporary ones. Run them from `backend` with
+`python -m pytest`.
+"""
+from sqlalchemy import event
+
+import bcrypt
+import contextlib
+import pytest
+
+from annotator_app import create_app
+from annotator_app.extensions import db
+from annotator_app.database import user_datastore
+
+EMAIL = 'test@example.com'
+PASSWORD = 'password'
+
+def app_config(tmp_path, **overrides):
+    """ Settings that isolate an app from the instance's database, files and caches. """
+    config = {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///%s' % (tmp_path / 'primary.db'),
+        'UPLOAD_DIRECTORY': str(tmp_path / 'uploads'),
+        'STORAGE_BACKEND': 'local',
+        'CACHE_ENABLED': False,
+        'USER_CACHE_TTL': 0,
+        # A query repeated per row fails the request
+        'QUERY_TRACKER_ENABLED': True,
+        'QUERY_TRACKER_RAISE': True,
+        'QUERY_TRACKER_THRESHOLD': 5,
+    }
+    config.update(overrides)
+    return config
+
+def create_test_app(tmp_path, **overrides):
+    """ An app with the test user. No app context is kept, so that each request has its own database session, as when served. """
+    app = create_app(app_config(tmp_path, **overrides))
+    with app.app_context():
+        db.create_all()
+        user_datastore.create_user(email=EMAIL, password=bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4)))
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def app(tmp_path):
+    return create_test_app(tmp_path)
+
+@pytest.fixture
+def client(app):
+    """ A client logged in as the test user. """
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    assert response.status_code == 200, response.data
+    return client
+
+@contextlib.contextmanager
+def count_queries(engine):
+    """ Count the statements executed on `engine` within the block, in the list's only element. """
+    count = [0]
+    def before_cursor_execute(*args):
+        count[0] += 1
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield count
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def created_id(response, table):
+    """ ID of the entity of `table` created by a POST. """
+    assert response.status_code == 200, response.data
+    return int(next(iter(response.get_json()['new_entities'][table])))
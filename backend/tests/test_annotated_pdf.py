@@ -0,0 +1,39 @@
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, NameObject
+
+from annotator_app import annotated_pdf
+from annotator_app.storage import LocalStorage
+
+ORIGINAL_CONTENT = b'0 0 1 rg 0 0 10 10 re f'
+
+def write_pdf(file_name):
+    """ A one page PDF whose `/Contents` is an indirect reference to an array of streams. """
+    writer = PdfFileWriter()
+    page = writer.addBlankPage(200, 200)
+    stream = DecodedStreamObject()
+    stream.setData(ORIGINAL_CONTENT)
+    page[NameObject('/Contents')] = writer._addObject(ArrayObject([writer._addObject(stream)]))
+    with open(file_name, 'wb') as f:
+        writer.write(f)
+
+def test_render(tmp_path):
+    pdf_file_name = str(tmp_path / 'original.pdf')
+    write_pdf(pdf_file_name)
+    store = LocalStorage(str(tmp_path / 'store'))
+    annotations = [
+        {'id': 1, 'page': 1, 'type': 'rect', 'position': {'box': [10, 50, 30, 20]}, 'note': 'Rect note'},
+        {'id': 2, 'page': 1, 'type': 'highlight', 'position': {'points': [[20, 100], [80, 102]]}, 'note': 'Highlight note'},
+        {'id': 3, 'page': 1, 'type': 'point', 'position': {'coords': [5, 5]}, 'note': None},
+    ]
+    annotated_pdf.render(pdf_file_name, store, 'annotated.pdf', annotations)
+
+    with open(store.local_path('annotated.pdf'), 'rb') as f:
+        page = PdfFileReader(f).getPage(0)
+        content = b'\n'.join(c.getObject().getData() for c in page['/Contents'])
+        notes = [a.getObject()['/Contents'] for a in page['/Annots']]
+        state = page['/Resources']['/ExtGState'][annotated_pdf.HIGHLIGHT_STATE]
+        assert ORIGINAL_CONTENT in content
+        assert b'%s gs' % annotated_pdf.HIGHLIGHT_STATE.encode('ascii') in content
+        assert b'20.000000 100.000000 m 80.000000 98.000000 l S' in content
+        assert notes == ['Rect note', 'Highlight note']
+        assert state['/BM'] == '/Multiply'
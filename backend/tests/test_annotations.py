@@ -0,0 +1,75 @@
+from conftest import created_id
+
+import pytest
+
+from annotator_app.resources.annotations import parse_page_range
+
+def test_update_with_invalid_value(client):
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    annotation_id = created_id(client.post('/api/data/annotations', json={
+        'doc_id': doc_id, 'page': 1, 'type': 'point', 'position': {'coords': [5, 5]},
+    }), 'annotations')
+
+    response = client.put('/api/data/annotations/%d' % annotation_id, json={'page': 'abc'})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    response = client.get('/api/data/annotations/%d' % annotation_id)
+    assert response.get_json()['entities']['annotations'][str(annotation_id)]['page'] == 1
+
+@pytest.mark.parametrize('position', ['box', [1, 2], {'box': [1, 2]}, {'coords': 'ab'}, {'points': [[1]]}])
+def test_invalid_position(client, position):
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    response = client.post('/api/data/annotations', json={
+        'doc_id': doc_id, 'page': 1, 'type': 'rect', 'position': position,
+    })
+    assert response.status_code == 400
+    annotation_id = created_id(client.post('/api/data/annotations', json={
+        'doc_id': doc_id, 'page': 1, 'type': 'point', 'position': {'coords': [5, 5]},
+    }), 'annotations')
+    response = client.put('/api/data/annotations/%d' % annotation_id, json={'position': position})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('pages, expected', [('3', (3, 3)), ('10-14', (10, 14)), ('2-2', (2, 2))])
+def test_parse_page_range(pages, expected):
+    assert parse_page_range(pages) == expected
+
+@pytest.mark.parametrize('pages', ['', 'a', '5-3', '1-b', '-2', '1-2-3'])
+def test_parse_invalid_page_range(pages):
+    with pytest.raises(ValueError):
+        parse_page_range(pages)
+
+def test_annotations_on_pages(client):
+    doc_ids = [created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/%s.pdf' % name, 'title': name,
+    }), 'documents') for name in ['A', 'B']]
+    annotation_ids = {}
+    for doc_id in doc_ids:
+        for page in range(1, 6):
+            annotation_ids[doc_id, page] = created_id(client.post('/api/data/annotations', json={
+                'doc_id': doc_id, 'page': page, 'type': 'point', 'position': {'coords': [5, 5]},
+            }), 'annotations')
+    note_id = created_id(client.post('/api/data/notes', json={
+        'body': 'On page 3', 'annotation_id': annotation_ids[doc_ids[0], 3],
+    }), 'notes')
+    created_id(client.post('/api/data/notes', json={
+        'body': 'On page 5', 'annotation_id': annotation_ids[doc_ids[0], 5],
+    }), 'notes')
+
+    response = client.get('/api/data/annotations?doc_id=%d&pages=2-4' % doc_ids[0])
+    assert response.status_code == 200, response.data
+    entities = response.get_json()['entities']
+    assert sorted(int(i) for i in entities['annotations']) == [annotation_ids[doc_ids[0], p] for p in [2, 3, 4]]
+    assert list(entities['notes']) == [str(note_id)]
+
+    response = client.get('/api/data/annotations?doc_id=%d&pages=4' % doc_ids[1])
+    assert list(response.get_json()['entities']['annotations']) == [str(annotation_ids[doc_ids[1], 4])]
+
+@pytest.mark.parametrize('query', ['pages=1-2', 'doc_id=1&pages=3-1', 'doc_id=1&pages=a', 'doc_id=x&pages=1'])
+def test_annotations_on_invalid_pages(client, query):
+    response = client.get('/api/data/annotations?%s' % query)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
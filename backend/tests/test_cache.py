@@ -0,0 +1,52 @@
+from conftest import count_queries, create_test_app, created_id
+
+import pytest
+
+from annotator_app.extensions import db
+from annotator_app.database import Note
+
+@pytest.fixture(params=['local', 'file'])
+def app(request, tmp_path):
+    return create_test_app(tmp_path,
+            CACHE_ENABLED=True,
+            CACHE_BACKEND=request.param,
+            CACHE_DIRECTORY=str(tmp_path / 'cache'))
+
+def note_bodies(client):
+    response = client.get('/api/data/notes')
+    assert response.status_code == 200, response.data
+    return [n['body'] for n in response.get_json()['entities']['notes'].values()]
+
+def test_list_is_cached_until_the_user_writes(app, client):
+    note_id = created_id(client.post('/api/data/notes', json={'body': 'before'}), 'notes')
+    engine = db.get_engine(app)
+    with count_queries(engine) as miss:
+        assert note_bodies(client) == ['before']
+    with count_queries(engine) as hit:
+        assert note_bodies(client) == ['before']
+    assert hit[0] < miss[0]
+
+    response = client.put('/api/data/notes/%d' % note_id, json={'body': 'after'})
+    assert response.status_code == 200, response.data
+    assert note_bodies(client) == ['after']
+
+def test_write_outside_a_request_invalidates(app, client):
+    created_id(client.post('/api/data/notes', json={'body': 'before'}), 'notes')
+    assert note_bodies(client) == ['before']
+    with app.app_context():
+        db.session.query(Note).one().body = 'after'
+        db.session.commit()
+    assert note_bodies(client) == ['after']
+
+def test_rolled_back_write_keeps_entries(app, client):
+    created_id(client.post('/api/data/notes', json={'body': 'before'}), 'notes')
+    assert note_bodies(client) == ['before']
+    with app.app_context():
+        db.session.query(Note).one().body = 'after'
+        db.session.flush()
+        db.session.rollback()
+    engine = db.get_engine(app)
+    with count_queries(engine) as count:
+        assert note_bodies(client) == ['before']
+    # Only the logged in user is loaded
+    assert count[0] == 1
@@ -0,0 +1,72 @@
+from conftest import created_id
+
+from collections import deque
+import json
+import pytest
+
+from annotator_app import notifications
+
+@pytest.fixture(autouse=True)
+def recent(monkeypatch):
+    """ Events of other tests' users, who have the same IDs, are not replayed. """
+    monkeypatch.setattr(notifications, '_recent', deque(maxlen=1000))
+
+def read_events(chunks, count):
+    """ The data of the next `count` change events of a stream, skipping other messages. """
+    events = []
+    while len(events) < count:
+        chunk = next(chunks)
+        chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        if 'event: change' in chunk:
+            events.append(json.loads(chunk.split('data: ')[1]))
+    return events
+
+def open_stream(client, **headers):
+    response = client.get('/api/data/changes', headers=headers, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    return response, iter(response.response)
+
+def test_changes_are_delivered(client):
+    response, chunks = open_stream(client)
+    try:
+        tag_id = created_id(client.post('/api/data/tags', json={'name': 'tag'}), 'tags')
+        [event] = read_events(chunks, 1)
+        assert event['type'] == 'tags'
+        assert event['id'] == tag_id
+        assert event['action'] == 'created'
+    finally:
+        response.close()
+
+def test_replay_after_last_event_id(client):
+    first = created_id(client.post('/api/data/tags', json={'name': 'first'}), 'tags')
+    second = created_id(client.post('/api/data/tags', json={'name': 'second'}), 'tags')
+    [first_event, second_event] = list(notifications._recent)[-2:]
+    assert first_event[1]['id'] == first
+
+    # A reconnecting client gets what it missed
+    response, chunks = open_stream(client, **{'Last-Event-ID': str(first_event[1]['revision'])})
+    try:
+        assert [e['id'] for e in read_events(chunks, 1)] == [second]
+    finally:
+        response.close()
+
+    # A new stream only gets new events
+    response, chunks = open_stream(client)
+    try:
+        third = created_id(client.post('/api/data/tags', json={'name': 'third'}), 'tags')
+        assert [e['id'] for e in read_events(chunks, 1)] == [third]
+    finally:
+        response.close()
+
+def test_stream_limit(app, client):
+    app.config['NOTIFICATIONS_MAX_STREAMS'] = 1
+    response, _ = open_stream(client)
+    try:
+        rejected = client.get('/api/data/changes')
+        assert rejected.status_code == 503
+        assert rejected.headers['Retry-After'] == '30'
+    finally:
+        response.close()
+    response, _ = open_stream(client)
+    response.close()
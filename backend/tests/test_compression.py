@@ -0,0 +1,82 @@
+from conftest import EMAIL, PASSWORD, create_test_app, created_id
+
+import gzip
+import json
+import pytest
+
+from annotator_app import compression
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('BR', 'br'),
+    ('*', 'br'),
+    ('*;q=0.1, gzip;q=0.5', 'gzip'),
+    ('gzip;q=0, br;q=0', None),
+    ('br;q=abc, gzip', 'gzip'),
+    ('identity', None),
+    ('', None),
+])
+def test_negotiate(accept_encoding, expected):
+    assert compression.negotiate(accept_encoding, ['br', 'gzip']) == expected
+
+@pytest.fixture
+def app(tmp_path):
+    return create_test_app(tmp_path, COMPRESSION_MIN_SIZE=2000)
+
+def add_notes(client, count):
+    for i in range(count):
+        created_id(client.post('/api/data/notes', json={'body': 'Note %d' % i}), 'notes')
+
+def get_notes(client, accept_encoding):
+    response = client.get('/api/data/notes', headers={'Accept-Encoding': accept_encoding})
+    assert response.status_code == 200
+    assert 'Accept-Encoding' in response.headers['Vary']
+    return response
+
+def test_gzip(client):
+    add_notes(client, 20)
+    response = get_notes(client, 'gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    notes = json.loads(gzip.decompress(response.data))['entities']['notes']
+    assert len(notes) == 20
+
+def test_brotli(client):
+    brotli = pytest.importorskip('brotli')
+    add_notes(client, 20)
+    response = get_notes(client, 'gzip, br')
+    assert response.headers['Content-Encoding'] == 'br'
+    notes = json.loads(brotli.decompress(response.data))['entities']['notes']
+    assert len(notes) == 20
+
+def test_small_responses_are_not_compressed(client):
+    add_notes(client, 2)
+    response = get_notes(client, 'gzip')
+    assert len(response.data) < 2000
+    assert 'Content-Encoding' not in response.headers
+    assert len(response.get_json()['entities']['notes']) == 2
+
+def test_not_accepted(client):
+    add_notes(client, 20)
+    response = get_notes(client, 'identity')
+    assert 'Content-Encoding' not in response.headers
+    assert len(response.get_json()['entities']['notes']) == 20
+
+def test_stream(client):
+    add_notes(client, 2)
+    response = client.get('/api/data/export?format=ndjson', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    # Streamed responses are compressed whatever their size
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+    assert [json.loads(l)['data']['body'] for l in lines] == ['Note 0', 'Note 1']
+
+def test_disabled(tmp_path):
+    client = create_test_app(tmp_path, COMPRESSION_ENABLED=False, COMPRESSION_MIN_SIZE=0).test_client()
+    response = client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    assert response.status_code == 200
+    add_notes(client, 20)
+    response = client.get('/api/data/notes', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
@@ -0,0 +1,73 @@
+from conftest import created_id
+
+import datetime
+import pytest
+
+from annotator_app.database import Annotation, Document, Note
+
+def test_update_converts_values():
+    document = Document()
+    document.update({
+        'title': 'A',
+        'read': True,
+        'deleted_at': '2021-02-03',
+        'last_modified_at': '2021-02-03T04:05:06',
+        'last_accessed_at': None,
+    })
+    assert document.title == 'A'
+    assert document.read is True
+    assert document.deleted_at == datetime.date(2021, 2, 3)
+    assert document.last_modified_at == datetime.datetime(2021, 2, 3, 4, 5, 6)
+    assert document.last_accessed_at is None
+
+    annotation = Annotation()
+    annotation.update({'page': '3', 'doc_id': 1, 'position': {'box': [1, 2, 3, 4]}})
+    assert annotation.page == 3
+    assert (annotation.bbox_left, annotation.bbox_top, annotation.bbox_right, annotation.bbox_bottom) == (4, 1, 2, 3)
+
+def test_update_skips_excluded_fields():
+    annotation = Annotation()
+    annotation.update({'id': 5, 'user_id': 6, 'bbox_left': 7, 'page': 1})
+    assert annotation.id is None
+    assert annotation.user_id is None
+    assert annotation.bbox_left is None
+    assert annotation.page == 1
+
+    note = Note()
+    note.update({'body': 'A', 'document_id': 1, 'annotation_id': 2, 'orphaned': False})
+    assert note.body == 'A'
+
+@pytest.mark.parametrize('model, data', [
+    (Document, {'title': 'A', 'unknown': 1}),
+    (Document, {'orphaned': False}),
+    (Annotation, {'page': 'abc'}),
+    (Annotation, {'deleted_at': 'yesterday'}),
+    (Note, {'tag_ids': [1]}),
+])
+def test_update_rejects_invalid_data(model, data):
+    with pytest.raises(ValueError):
+        model().update(data)
+
+def test_put_unknown_field(client):
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    response = client.put('/api/data/documents/%d' % doc_id, json={'title': 'B', 'titel': 'C'})
+    assert response.status_code == 400
+    assert 'titel' in response.get_json()['error']
+    response = client.get('/api/data/documents/%d' % doc_id)
+    assert response.get_json()['entities']['documents'][str(doc_id)]['title'] == 'A'
+
+    response = client.post('/api/data/notes', json={'body': 'A', 'bdy': 'B'})
+    assert response.status_code == 400
+
+def test_put_what_was_read(client):
+    """ Clients send back the entities as they received them, with the fields computed by `to_dict`. """
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    note_id = created_id(client.post('/api/data/notes', json={'body': 'A', 'document_id': doc_id}), 'notes')
+    for table, entity_id in [('documents', doc_id), ('notes', note_id)]:
+        entity = client.get('/api/data/%s/%d' % (table, entity_id)).get_json()['entities'][table][str(entity_id)]
+        response = client.put('/api/data/%s/%d' % (table, entity_id), json=entity)
+        assert response.status_code == 200, response.data
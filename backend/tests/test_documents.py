@@ -0,0 +1,34 @@
+from conftest import count_queries, created_id
+
+from annotator_app.extensions import db
+
+def add_annotations(client, doc_id, count):
+    """ Annotations on the document, each with a tagged note. """
+    for i in range(count):
+        annotation_id = created_id(client.post('/api/data/annotations', json={
+            'doc_id': doc_id, 'page': i+1, 'type': 'rect', 'position': {'box': [10, 10, 50, 20]},
+        }), 'annotations')
+        created_id(client.post('/api/data/notes', json={
+            'body': 'Note %d' % i, 'annotation_id': annotation_id, 'tag_names': ['tag'],
+        }), 'notes')
+
+def test_recursive_query_count_does_not_depend_on_annotations(app, client):
+    tag_id = created_id(client.post('/api/data/tags', json={'name': 'tag'}), 'tags')
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A', 'tag_ids': [tag_id],
+    }), 'documents')
+
+    counts = []
+    total = 0
+    for added in [2, 10]:
+        add_annotations(client, doc_id, added)
+        total += added
+        with count_queries(db.get_engine(app)) as count:
+            response = client.get('/api/data/documents/%d/recursive' % doc_id)
+        assert response.status_code == 200, response.data
+        entities = response.get_json()['entities']
+        assert len(entities['annotations']) == total
+        assert len(entities['notes']) == total
+        assert all(n['annotation_id'] is not None and n['tag_names'] == ['tag'] for n in entities['notes'].values())
+        counts.append(count[0])
+    assert counts[0] == counts[1]
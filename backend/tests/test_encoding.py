@@ -0,0 +1,41 @@
+from conftest import EMAIL, PASSWORD, create_test_app, created_id
+
+import json
+import pytest
+
+from annotator_app import encoding
+
+@pytest.fixture(autouse=True)
+def restore_encoder(monkeypatch):
+    monkeypatch.setattr(encoding, 'dumps', encoding.dumps)
+    monkeypatch.setattr(encoding, 'loads', encoding.loads)
+
+def test_default_encoder():
+    # orjson if it is installed
+    name = 'orjson' if encoding.orjson is not None else 'json'
+    assert encoding.dumps is encoding.ENCODERS[name][0]
+
+@pytest.mark.parametrize('name', sorted(encoding.ENCODERS))
+def test_encoders_agree(name):
+    data = {'entities': {'notes': {1: {'id': 1, 'body': 'é\n"', 'tag_ids': [2, 3], 'deleted_at': None}}}}
+    dumps, loads = encoding.ENCODERS[name]
+    body = dumps(data)
+    assert json.loads(body) == {'entities': {'notes': {'1': {'id': 1, 'body': 'é\n"', 'tag_ids': [2, 3], 'deleted_at': None}}}}
+    assert loads(body) == json.loads(body)
+
+@pytest.mark.parametrize('name', sorted(encoding.ENCODERS))
+def test_response_encoder(tmp_path, name):
+    app = create_test_app(tmp_path, RESPONSE_ENCODER=name)
+    assert encoding.dumps is encoding.ENCODERS[name][0]
+    assert encoding.loads is encoding.ENCODERS[name][1]
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    assert response.status_code == 200
+    note_id = created_id(client.post('/api/data/notes', json={'body': 'é'}), 'notes')
+    response = client.get('/api/data/notes/%d' % note_id)
+    assert response.mimetype == 'application/json'
+    assert response.get_json()['entities']['notes'][str(note_id)]['body'] == 'é'
+
+def test_unknown_encoder(tmp_path):
+    with pytest.raises(KeyError):
+        create_test_app(tmp_path, RESPONSE_ENCODER='simplejson')
@@ -0,0 +1,66 @@
+from conftest import created_id
+
+import io
+import json
+import pytest
+import zipfile
+
+from annotator_app.resources import export
+
+BIBTEX = '@article{a, title={A}}'
+
+@pytest.fixture
+def library(client):
+    """ A tagged document with a BibTeX entry, an annotation, a tagged note, and a deleted note. """
+    tag_id = created_id(client.post('/api/data/tags', json={'name': 'tag'}), 'tags')
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A', 'tag_ids': [tag_id], 'bibtex': BIBTEX,
+    }), 'documents')
+    annotation_id = created_id(client.post('/api/data/annotations', json={
+        'doc_id': doc_id, 'page': 1, 'type': 'point', 'position': {'coords': [5, 5]},
+    }), 'annotations')
+    note_id = created_id(client.post('/api/data/notes', json={
+        'body': '# About A', 'annotation_id': annotation_id, 'tag_names': ['tag'],
+    }), 'notes')
+    deleted_note_id = created_id(client.post('/api/data/notes', json={'body': 'Deleted'}), 'notes')
+    assert client.delete('/api/data/notes/%d' % deleted_note_id).status_code == 200
+    return {'tag': tag_id, 'document': doc_id, 'annotation': annotation_id, 'note': note_id}
+
+def test_ndjson(client, library):
+    response = client.get('/api/data/export?format=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+    assert [l['type'] for l in lines] == ['tags', 'documents', 'document_tags', 'annotations', 'notes', 'note_tags']
+    data = {l['type']: l['data'] for l in lines}
+    assert data['documents']['id'] == library['document']
+    assert data['documents']['bibtex'] == BIBTEX
+    assert data['document_tags'] == {'document_id': library['document'], 'tag_id': library['tag']}
+    assert data['notes']['id'] == library['note']
+    assert data['notes']['body'] == '# About A'
+    assert data['note_tags'] == {'note_id': library['note'], 'tag_id': library['tag']}
+
+@pytest.mark.parametrize('chunk_size', [export.CHUNK_SIZE, 1])
+def test_zip(client, library, monkeypatch, chunk_size):
+    monkeypatch.setattr(export, 'CHUNK_SIZE', chunk_size)
+    response = client.get('/api/data/export')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert 'attachment; filename=annotator-export-' in response.headers['Content-Disposition']
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert sorted(zf.namelist()) == sorted(['tags.ndjson', 'documents.ndjson', 'document_tags.ndjson',
+                'annotations.ndjson', 'notes.ndjson', 'note_tags.ndjson', 'library.bib',
+                'notes/%d.md' % library['note']])
+        notes = [json.loads(line) for line in zf.read('notes.ndjson').splitlines()]
+        assert len(notes) == 1
+        assert 'body' not in notes[0]
+        assert notes[0]['body_file'] == 'notes/%d.md' % library['note']
+        assert zf.read('notes/%d.md' % library['note']) == b'# About A'
+        assert zf.read('library.bib').decode('utf-8').strip() == BIBTEX
+        annotations = [json.loads(line) for line in zf.read('annotations.ndjson').splitlines()]
+        assert [a['id'] for a in annotations] == [library['annotation']]
+
+def test_invalid_format(client):
+    response = client.get('/api/data/export?format=tar')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
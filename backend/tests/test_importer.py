@@ -0,0 +1,97 @@
+import pytest
+
+from annotator_app import importer
+
+BIBTEX = r"""
+@comment{Exported from somewhere}
+@Comment(Exported (again) from somewhere else)
+@preamble{"\newcommand{\noop}[1]{}"}
+@string{conf = "Conference on {Things}"}
+@String(year = {2021})
+
+@article{smith2020,
+  title = {A {Study} of
+           Things},
+  author = "Smith, J. and {Doe}, A.",
+  url = {https://example.invalid/smith.pdf},
+  keywords = {one, two; three},
+}
+
+@inproceedings(doe2021,
+  Title = "Proceedings of the " # conf,
+  booktitle = conf,
+  year = year # "b",
+  month = jan,
+  archivePrefix = {arXiv},
+  eprint = {2101.00001}
+)
+
+@book{nourl,
+  title = {No URL},
+  doi = {10.1000/xyz},
+}
+
+@misc{nothing,
+  title = {Nothing}
+}
+"""
+
+def test_parse_bibtex():
+    entries = importer.parse_bibtex(BIBTEX)
+    assert [(e['type'], e['key']) for e in entries] == [
+            ('article', 'smith2020'), ('inproceedings', 'doe2021'), ('book', 'nourl'), ('misc', 'nothing')]
+    assert entries[0]['title'] == 'A Study of Things'
+    assert entries[0]['author'] == 'Smith, J. and Doe, A.'
+    assert entries[0]['bibtex'].startswith('@article{smith2020,')
+    assert entries[0]['bibtex'].endswith('}')
+    assert entries[1]['title'] == 'Proceedings of the Conference on Things'
+    assert entries[1]['booktitle'] == 'Conference on Things'
+    assert entries[1]['year'] == '2021b'
+    assert entries[1]['month'] == 'jan'
+    assert entries[1]['bibtex'].endswith(')')
+
+def test_bibtex_documents():
+    documents = importer.parse_file(BIBTEX, 'bibtex')
+    assert [d and d['url'] for d in documents] == [
+            'https://example.invalid/smith.pdf', 'https://arxiv.org/pdf/2101.00001', 'https://doi.org/10.1000/xyz', None]
+    assert documents[0]['tag_names'] == ['one', 'two', 'three']
+    assert documents[1]['tag_names'] == []
+
+@pytest.mark.parametrize('text', [
+    '@article{a, title = {Unbalanced}',
+    '@article{a, title = "Unterminated}',
+    '@article{a title = {No key}}',
+    '@comment(Unbalanced',
+    '@article{a, title = {A} # }',
+])
+def test_invalid_bibtex(text):
+    with pytest.raises(importer.ImportFileError):
+        importer.parse_bibtex(text)
+
+def test_parse_csv():
+    text = 'URL,Title,author,tags\n' \
+            'https://example.invalid/a.pdf,A,"Smith, J.",one; two\n' \
+            ',No URL,,\n' \
+            'https://example.invalid/b.pdf,,,,extra\n'
+    documents = importer.parse_file(text, 'csv')
+    assert documents[0] == {
+        'url': 'https://example.invalid/a.pdf',
+        'title': 'A',
+        'author': 'Smith, J.',
+        'bibtex': None,
+        'tag_names': ['one', 'two'],
+    }
+    assert documents[1] is None
+    assert documents[2]['url'] == 'https://example.invalid/b.pdf'
+    assert documents[2]['title'] is None
+
+def test_csv_without_url():
+    with pytest.raises(importer.ImportFileError):
+        importer.parse_csv('title,author\nA,B\n')
+
+def test_guess_format():
+    assert importer.guess_format('library.BIB') == 'bibtex'
+    assert importer.guess_format('library.csv') == 'csv'
+    assert importer.guess_format('library.txt') is None
+    with pytest.raises(importer.ImportFileError):
+        importer.parse_file('', 'txt')
@@ -0,0 +1,36 @@
+from conftest import create_test_app
+
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+@pytest.fixture
+def app(tmp_path):
+    return create_test_app(tmp_path, METRICS_DIRECTORY=str(tmp_path / 'metrics'))
+
+def write_snapshot(directory, pid, count):
+    with open(os.path.join(directory, 'metrics-%d.json' % pid), 'w') as f:
+        json.dump({'http_requests_total': [[[['method', 'GET'], ['route', '/other'], ['status', '200']], count]]}, f)
+
+def other_requests(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    line = next(l for l in response.data.decode('utf-8').splitlines() if 'route="/other"' in l)
+    return int(line.rpartition(' ')[2])
+
+def test_snapshots_of_exited_workers_are_removed(app, tmp_path):
+    directory = str(tmp_path / 'metrics')
+    client = app.test_client()
+    client.get('/metrics') # Creates the directory
+    running = subprocess.Popen([sys.executable, '-c', 'import sys; sys.stdin.read()'], stdin=subprocess.PIPE)
+    exited = subprocess.Popen([sys.executable, '-c', ''])
+    exited.wait()
+    try:
+        write_snapshot(directory, running.pid, 2)
+        write_snapshot(directory, exited.pid, 3)
+        assert other_requests(client) == 2
+        assert sorted(os.listdir(directory)) == sorted(['metrics-%d.json' % pid for pid in [os.getpid(), running.pid]])
+    finally:
+        running.communicate(b'')
@@ -0,0 +1,161 @@
+from conftest import app_config
+
+from email import message_from_bytes
+import datetime
+import socket
+import threading
+import time
+import pytest
+
+from annotator_app import create_app, outbox
+from annotator_app.extensions import db
+from annotator_app.database import EmailOutbox
+
+aiosmtpd = pytest.importorskip('aiosmtpd.controller')
+
+RETRY_DELAY = 60
+
+class Sink(object):
+    """ SMTP server handler that keeps the emails it receives, and refuses the recipients in `refused`. """
+    def __init__(self):
+        self.messages = []
+        self.refused = set()
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(message_from_bytes(envelope.content))
+        return '250 Message accepted'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def sink():
+    sink = Sink()
+    controller = aiosmtpd.Controller(sink, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    sink.port = controller.port
+    yield sink
+    controller.stop()
+
+def make_app(tmp_path, port):
+    app = create_app(app_config(tmp_path,
+            MAIL_SERVER='127.0.0.1',
+            MAIL_PORT=port,
+            MAIL_USE_TLS=False,
+            MAIL_USE_SSL=False,
+            MAIL_PASSWORD=None,
+            MAIL_SUPPRESS_SEND=False, # Suppressed by default when testing
+            OUTBOX_RETRY_DELAY=RETRY_DELAY,
+            OUTBOX_MAX_ATTEMPTS=3,
+            OUTBOX_POLL_INTERVAL=0.1))
+    with app.app_context():
+        db.create_all()
+    return app
+
+@pytest.fixture
+def app(tmp_path, sink):
+    return make_app(tmp_path, sink.port)
+
+def queue(app, recipient):
+    """ Queue an email, returning its ID. """
+    with app.app_context():
+        entry = outbox.queue_email(recipient, 'Subject', 'Body', sender='noreply@example.com')
+        db.session.commit()
+        return entry.id
+
+def get_entry(app, entry_id):
+    with app.app_context():
+        entry = db.session.query(EmailOutbox).get(entry_id)
+        db.session.expunge(entry)
+        return entry
+
+def deliver(app):
+    with app.app_context():
+        return outbox.deliver_pending()
+
+def make_due(app, entry_id):
+    """ Skip the wait before an email's next attempt. """
+    with app.app_context():
+        db.session.query(EmailOutbox).filter_by(id=entry_id) \
+                .update({'next_attempt_at': datetime.datetime.utcnow()})
+        db.session.commit()
+
+def assert_retry_delay(entry, delay):
+    expected = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    assert abs((entry.next_attempt_at-expected).total_seconds()) < 5
+
+def test_sender_delivers_queued_emails(app, sink):
+    stop = threading.Event()
+    sender = threading.Thread(target=outbox.run_sender, args=(app, stop))
+    sender.start()
+    try:
+        entry_id = queue(app, 'user@example.com')
+        deadline = time.time()+5
+        while len(sink.messages) == 0 and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        sender.join()
+
+    assert len(sink.messages) == 1
+    message = sink.messages[0]
+    assert message['To'] == 'user@example.com'
+    assert message['From'] == 'noreply@example.com'
+    assert message['Subject'] == 'Subject'
+    entry = get_entry(app, entry_id)
+    assert entry.sent_at is not None
+    assert entry.attempts == 0
+
+def test_refused_email_is_retried_with_backoff(app, sink):
+    sink.refused.add('bounce@example.com')
+    refused_id = queue(app, 'bounce@example.com')
+    sent_id = queue(app, 'user@example.com')
+
+    # The other emails of the batch are still sent
+    assert deliver(app) == 1
+    assert get_entry(app, sent_id).sent_at is not None
+    entry = get_entry(app, refused_id)
+    assert entry.sent_at is None
+    assert entry.attempts == 1
+    assert '550' in entry.last_error
+    assert_retry_delay(entry, RETRY_DELAY)
+
+    # Not retried before its next attempt is due
+    assert deliver(app) == 0
+    assert get_entry(app, refused_id).attempts == 1
+
+    # The delay doubles with each failure
+    make_due(app, refused_id)
+    assert deliver(app) == 0
+    entry = get_entry(app, refused_id)
+    assert entry.attempts == 2
+    assert_retry_delay(entry, 2*RETRY_DELAY)
+
+    sink.refused.clear()
+    make_due(app, refused_id)
+    assert deliver(app) == 1
+    entry = get_entry(app, refused_id)
+    assert entry.sent_at is not None
+    assert [m['To'] for m in sink.messages] == ['user@example.com', 'bounce@example.com']
+
+def test_unreachable_server(tmp_path):
+    app = make_app(tmp_path, free_port())
+    entry_id = queue(app, 'user@example.com')
+    for attempt in range(1, 4):
+        make_due(app, entry_id)
+        assert deliver(app) == 0
+        entry = get_entry(app, entry_id)
+        assert entry.attempts == attempt
+        assert entry.sent_at is None
+        assert entry.last_error
+
+    # Abandoned after `OUTBOX_MAX_ATTEMPTS`
+    make_due(app, entry_id)
+    assert deliver(app) == 0
+    assert get_entry(app, entry_id).attempts == 3
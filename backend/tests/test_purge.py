@@ -0,0 +1,47 @@
+from conftest import created_id
+
+import datetime
+
+from annotator_app import purge
+from annotator_app.extensions import db
+from annotator_app.database import Annotation, Document, Note
+
+def test_purged_document_takes_its_note(app, client):
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    created_id(client.post('/api/data/notes', json={'body': 'About A', 'document_id': doc_id}), 'notes')
+    other_note_id = created_id(client.post('/api/data/notes', json={'body': 'Unrelated'}), 'notes')
+    assert client.delete('/api/data/documents/%d' % doc_id).status_code == 200
+
+    with app.app_context():
+        db.session.query(Document).update({'deleted_at': datetime.date.today()-datetime.timedelta(days=31)})
+        db.session.commit()
+        report = purge.purge_deleted(retention_days=30)
+        assert report['documents'] == 1
+        assert report['notes'] == 1
+        assert [n.id for n in db.session.query(Note)] == [other_note_id]
+
+def test_purged_document_takes_the_notes_of_its_annotations(app, client):
+    doc_ids = [created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/%s.pdf' % name, 'title': name,
+    }), 'documents') for name in ['A', 'B']]
+    annotation_ids = [created_id(client.post('/api/data/annotations', json={
+        'doc_id': doc_id, 'page': 1, 'type': 'point', 'position': {'coords': [5, 5]},
+    }), 'annotations') for doc_id in [doc_ids[0], doc_ids[0], doc_ids[1]]]
+    created_id(client.post('/api/data/notes', json={'body': 'On A', 'annotation_id': annotation_ids[0]}), 'notes')
+    shared_note_id = created_id(client.post('/api/data/notes', json={'body': 'On A and B', 'annotation_id': annotation_ids[1]}), 'notes')
+    response = client.put('/api/data/annotations/%d' % annotation_ids[2], json={'note_id': shared_note_id})
+    assert response.status_code == 200, response.data
+    assert client.delete('/api/data/documents/%d' % doc_ids[0]).status_code == 200
+
+    with app.app_context():
+        db.session.query(Document).filter(Document.id == doc_ids[0]) \
+                .update({'deleted_at': datetime.date.today()-datetime.timedelta(days=31)})
+        db.session.commit()
+        report = purge.purge_deleted(retention_days=30)
+        assert report['documents'] == 1
+        assert report['annotations'] == 2
+        assert report['notes'] == 1
+        assert [n.id for n in db.session.query(Note)] == [shared_note_id]
+        assert [a.note_id for a in db.session.query(Annotation)] == [shared_note_id]
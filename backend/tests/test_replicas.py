@@ -0,0 +1,73 @@
+from conftest import EMAIL, PASSWORD, app_config, created_id
+
+import bcrypt
+import shutil
+import time
+import pytest
+
+from annotator_app import create_app
+from annotator_app.extensions import db
+from annotator_app.database import user_datastore, Document
+
+@pytest.fixture
+def app(tmp_path):
+    """ An app with a replica whose copy of the document titled 'Replica' was renamed 'Primary' on the primary. """
+    app = create_app(app_config(tmp_path,
+            SQLALCHEMY_REPLICA_URIS=['sqlite:///%s' % (tmp_path / 'replica.db')],
+            REPLICA_CHECK_INTERVAL=60))
+    with app.app_context():
+        db.create_all()
+        user = user_datastore.create_user(email=EMAIL, password=bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4)))
+        db.session.flush()
+        db.session.add(Document(user_id=user.id, url='http://example.invalid/a.pdf', title='Replica'))
+        db.session.commit()
+        db.engine.dispose()
+        shutil.copy(str(tmp_path / 'primary.db'), str(tmp_path / 'replica.db'))
+        db.session.query(Document).update({'title': 'Primary'})
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def client(app):
+    """ A logged in client, whose session does not stick to the primary after logging in. """
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    assert response.status_code == 200, response.data
+    with client.session_transaction() as session:
+        session.pop('_primary_until', None)
+    return client
+
+def get_title(client):
+    response = client.get('/api/data/documents/1')
+    assert response.status_code == 200, response.data
+    return response.get_json()['entities']['documents']['1']['title']
+
+def test_read_only_endpoints_use_a_replica(client):
+    assert get_title(client) == 'Replica'
+    response = client.get('/api/data/documents')
+    assert response.status_code == 200, response.data
+    assert response.get_json()['entities']['documents']['1']['title'] == 'Replica'
+
+def test_writes_use_the_primary_and_stick_to_it(client):
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/b.pdf', 'title': 'New',
+    }), 'documents')
+    with client.session_transaction() as session:
+        assert session['_primary_until'] > time.time()
+    # The replica does not have the new document yet, so only the primary can return it
+    response = client.get('/api/data/documents/%d' % doc_id)
+    assert response.status_code == 200, response.data
+    assert get_title(client) == 'Primary'
+
+    with client.session_transaction() as session:
+        session['_primary_until'] = time.time()-1
+    assert get_title(client) == 'Replica'
+
+def test_failed_replica_is_marked_down(app, client):
+    pool = app.extensions['replicas']
+    with pool.replicas[0].engine.begin() as conn:
+        conn.execute('DROP TABLE documents')
+    assert get_title(client) == 'Primary'
+    assert not pool.replicas[0].healthy
+    # Not used again until it is checked
+    assert get_title(client) == 'Primary'
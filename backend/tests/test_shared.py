@@ -0,0 +1,76 @@
+from conftest import created_id
+
+import pytest
+
+from annotator_app import storage
+
+PDF = b'%PDF-1.4\n%%EOF\n'
+
+@pytest.fixture
+def shared(app, client, tmp_path):
+    """ ID and access code of a tagged document with a stored PDF and a note. """
+    tag_id = created_id(client.post('/api/data/tags', json={'name': 'private'}), 'tags')
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A', 'tag_ids': [tag_id],
+    }), 'documents')
+    created_id(client.post('/api/data/notes', json={'body': 'About A', 'document_id': doc_id}), 'notes')
+    pdf_file_name = tmp_path / 'a.pdf'
+    pdf_file_name.write_bytes(PDF)
+    with app.app_context():
+        storage.get_storage().put_file(storage.pdf_key(doc_id), str(pdf_file_name))
+    response = client.post('/api/data/documents/%d/access_code' % doc_id, json={})
+    assert response.status_code == 200, response.data
+    return doc_id, response.get_json()['code']
+
+def get_shared(client, url, status_code=200):
+    response = client.get(url)
+    assert response.status_code == status_code, response.data
+    # Cacheable by proxies, although the client sent its session cookie
+    assert 'Set-Cookie' not in response.headers
+    assert 'Cookie' not in response.headers.get('Vary', '')
+    return response
+
+def test_shared_document(client, shared):
+    doc_id, code = shared
+    pointer = get_shared(client, '/api/shared/%s' % code)
+    assert pointer.headers['Cache-Control'].startswith('public')
+    data = pointer.get_json()
+    assert data['document_id'] == doc_id
+
+    entities = get_shared(client, data['entities_url'])
+    assert entities.headers['Cache-Control'].startswith('public')
+    entities = entities.get_json()['entities']
+    assert list(entities['documents']) == [str(doc_id)]
+    assert [n['body'] for n in entities['notes'].values()] == ['About A']
+    # The owner's tags are not shared
+    assert 'tag_names' not in entities['documents'][str(doc_id)]
+    assert 'tag_ids' not in entities['documents'][str(doc_id)]
+
+    assert get_shared(client, data['pdf_url']).data == PDF
+
+    response = client.get(data['entities_url'], headers={'If-None-Match': '"%s"' % data['version']})
+    assert response.status_code == 304
+
+def test_outdated_version_redirects(client, shared):
+    doc_id, code = shared
+    data = get_shared(client, '/api/shared/%s' % code).get_json()
+    response = client.put('/api/data/documents/%d' % doc_id, json={'title': 'B'})
+    assert response.status_code == 200, response.data
+
+    response = get_shared(client, data['entities_url'], 302)
+    new_data = get_shared(client, '/api/shared/%s' % code).get_json()
+    assert new_data['version'] != data['version']
+    assert response.headers['Location'].endswith(new_data['entities_url'])
+
+def test_revoked_code(client, shared):
+    doc_id, code = shared
+    data = get_shared(client, '/api/shared/%s' % code).get_json()
+    response = client.delete('/api/data/documents/%d/access_code' % doc_id)
+    assert response.status_code == 200, response.data
+
+    for url in ['/api/shared/%s' % code, data['entities_url'], data['pdf_url']]:
+        response = get_shared(client, url, 404)
+        assert 'error' in response.get_json()
+
+def test_unknown_code(client):
+    get_shared(client, '/api/shared/unknown', 404)
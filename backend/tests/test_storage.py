@@ -0,0 +1,99 @@
+from conftest import app_config, created_id
+
+import os
+import time
+import pytest
+
+from annotator_app import create_app, storage
+
+moto = pytest.importorskip('moto')
+import boto3
+
+BUCKET = 'annotator'
+PDF = b'%PDF-1.4\n' + b'0'*1000
+
+@pytest.fixture
+def s3(monkeypatch):
+    """ An in-process stand-in for S3, with an empty bucket. """
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield
+
+def s3_config(tmp_path, cache_directory):
+    return app_config(tmp_path,
+            STORAGE_BACKEND='s3',
+            STORAGE_S3_BUCKET=BUCKET,
+            STORAGE_S3_REGION='us-east-1',
+            STORAGE_S3_PREFIX='files/',
+            STORAGE_CACHE_DIRECTORY=str(tmp_path / cache_directory))
+
+@pytest.fixture
+def app(tmp_path, s3, app):
+    """ The test app, using S3 for storage. """
+    app.config.update(s3_config(tmp_path, 'cache'))
+    storage.init_app(app)
+    return app
+
+def test_s3_storage(app):
+    store = app.extensions['storage']
+    storage.save_stream(store, '1.pdf', [PDF[:100], PDF[100:]])
+    assert store.exists('1.pdf')
+    assert list(store.list()) == [('1.pdf', len(PDF))]
+    assert boto3.client('s3', region_name='us-east-1').head_object(Bucket=BUCKET, Key='files/1.pdf')['ContentLength'] == len(PDF)
+
+    # Downloaded again once it is no longer cached
+    store.cache.remove('1.pdf')
+    with open(store.local_path('1.pdf'), 'rb') as f:
+        assert f.read() == PDF
+
+    assert store.delete('1.pdf') == len(PDF)
+    assert not store.exists('1.pdf')
+    assert store.local_path('1.pdf') is None
+    assert store.delete('1.pdf') is None
+
+def check_list(store):
+    for key in ['1.pdf', 'annotated/abc-1.pdf', 'thumbnails/abc.webp']:
+        storage.save_stream(store, key, [PDF])
+    assert sorted(k for k,_ in store.list()) == ['1.pdf', 'annotated/abc-1.pdf', 'thumbnails/abc.webp']
+    assert list(store.list('thumbnails/')) == [('thumbnails/abc.webp', len(PDF))]
+    assert list(store.list('', recursive=False)) == [('1.pdf', len(PDF))]
+    assert list(store.list('missing/')) == []
+
+def test_s3_list(app):
+    check_list(app.extensions['storage'])
+
+def test_local_list(tmp_path):
+    check_list(storage.LocalStorage(str(tmp_path)))
+
+def test_pdf_stored_by_another_host(tmp_path, app, client):
+    """ A PDF stored by one app server is served by another with its own cache. """
+    doc_id = created_id(client.post('/api/data/documents', json={
+        'url': 'http://example.invalid/a.pdf', 'title': 'A',
+    }), 'documents')
+    other = create_app(s3_config(tmp_path, 'other-cache'))
+    storage.save_stream(other.extensions['storage'], storage.pdf_key(doc_id), [PDF])
+
+    response = client.get('/api/data/documents/%d/pdf' % doc_id)
+    assert response.status_code == 200
+    assert response.data == PDF
+    response.close()
+
+def test_prune_keeps_recently_used_files(tmp_path):
+    cache = storage.DiskCache(str(tmp_path), max_bytes=len(PDF))
+    for key in ['old.pdf', 'used.pdf', 'new.pdf']:
+        file_name = str(tmp_path / 'file.tmp')
+        with open(file_name, 'wb') as f:
+            f.write(PDF)
+        cache.add(key, file_name)
+    long_ago = time.time()-2*cache.MIN_AGE
+    for key in ['old.pdf', 'used.pdf']:
+        os.utime(cache.path(key), (long_ago, long_ago))
+    cache.get('used.pdf')
+
+    cache.prune()
+    assert cache.get('old.pdf') is None
+    # Over the limit, but possibly about to be opened by whoever called `local_path`
+    assert cache.get('used.pdf') is not None
+    assert cache.get('new.pdf') is not None
@@ -0,0 +1,58 @@
+from PIL import Image
+import pdf2image
+import time
+import pytest
+
+from annotator_app import thumbnails
+from annotator_app.storage import LocalStorage
+
+@pytest.fixture
+def render(monkeypatch):
+    """ Stand-in for rendering a PDF's first page, which fails while `failing` is set. """
+    calls = []
+    def convert_from_path(file_name, size=None, **kwargs):
+        calls.append(file_name)
+        if render.failing:
+            raise RuntimeError('Unable to get page count. Is poppler installed and in PATH?')
+        return [Image.new('RGB', (size[0], 100), 'white')]
+    monkeypatch.setattr(pdf2image, 'convert_from_path', convert_from_path)
+    monkeypatch.setattr(thumbnails, '_jobs', {})
+    monkeypatch.setattr(thumbnails, '_failed', {})
+    render.calls = calls
+    render.failing = False
+    return render
+
+def request(store, pdf_file_name):
+    """ Request the thumbnail and wait for it to be rendered. """
+    status = thumbnails.request_thumbnail(pdf_file_name, store, 'abc')
+    deadline = time.monotonic()+5
+    while len(thumbnails._jobs) > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return status
+
+def test_failed_thumbnail_is_retried(app, render, tmp_path):
+    app.config['THUMBNAIL_RETRY_DELAY'] = 60
+    store = LocalStorage(str(tmp_path / 'store'))
+    pdf_file_name = str(tmp_path / 'a.pdf')
+    with app.app_context():
+        render.failing = True
+        assert request(store, pdf_file_name) == 'pending'
+        assert request(store, pdf_file_name) == 'failed'
+        assert len(render.calls) == 1
+
+        # Tried again after the delay
+        failures, failed_at = thumbnails._failed['thumbnails/abc.webp']
+        thumbnails._failed['thumbnails/abc.webp'] = (failures, failed_at-60)
+        assert request(store, pdf_file_name) == 'pending'
+        assert len(render.calls) == 2
+        # Twice as long after the second failure
+        failures, failed_at = thumbnails._failed['thumbnails/abc.webp']
+        assert failures == 2
+        thumbnails._failed['thumbnails/abc.webp'] = (failures, failed_at-60)
+        assert request(store, pdf_file_name) == 'failed'
+
+        render.failing = False
+        thumbnails._failed['thumbnails/abc.webp'] = (failures, failed_at-120)
+        assert request(store, pdf_file_name) == 'pending'
+        assert request(store, pdf_file_name) == 'ready'
+        assert 'thumbnails/abc.webp' not in thumbnails._failed
@@ -0,0 +1,70 @@
+from conftest import EMAIL, count_queries, create_test_app
+
+from collections import OrderedDict
+import pytest
+
+from annotator_app import cache, user_cache
+from annotator_app.extensions import db
+from annotator_app.database import user_datastore
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(user_cache, '_cache', OrderedDict())
+
+@pytest.fixture(params=['local', 'file'])
+def app(request, tmp_path):
+    return create_test_app(tmp_path,
+            CACHE_ENABLED=True,
+            CACHE_BACKEND=request.param,
+            CACHE_DIRECTORY=str(tmp_path / 'cache'),
+            USER_CACHE_TTL=60)
+
+def session_queries(app, client):
+    """ Number of queries of a request that only loads the logged in user. """
+    with count_queries(db.get_engine(app)) as count:
+        response = client.get('/api/auth/current_session')
+    assert response.status_code == 200, response.data
+    return count[0]
+
+def uniquifier(app, email=EMAIL):
+    with app.app_context():
+        return user_datastore.find_user(email=email).fs_uniquifier
+
+def test_logged_in_user_is_cached(app, client):
+    session_queries(app, client)
+    assert session_queries(app, client) == 0
+    assert uniquifier(app) in user_cache._cache
+
+def test_invalidation_reaches_other_processes(app, client):
+    session_queries(app, client)
+    # Another process changes the user. Only the version in the shared tier tells this one.
+    with app.app_context():
+        cache.new_version('login:%s' % uniquifier(app))
+    assert session_queries(app, client) == 1
+    assert session_queries(app, client) == 0
+
+def test_password_change_invalidates(app, client):
+    session_queries(app, client)
+    response = client.post('/api/data/users/change_password', json={'password': 'password', 'new_password': 'new password'})
+    assert response.status_code == 200, response.data
+    assert uniquifier(app) not in user_cache._cache
+
+def test_logout_invalidates(app, client):
+    session_queries(app, client)
+    response = client.post('/api/auth/logout')
+    assert response.status_code == 200, response.data
+    assert uniquifier(app) not in user_cache._cache
+
+def test_least_recently_used_is_evicted(app, monkeypatch):
+    monkeypatch.setattr(user_cache, 'MAX_CACHED_USERS', 2)
+    with app.app_context():
+        for email in ['a@example.com', 'b@example.com']:
+            user_datastore.create_user(email=email)
+        db.session.commit()
+    first, a, b = [uniquifier(app, email) for email in [EMAIL, 'a@example.com', 'b@example.com']]
+    with app.test_request_context():
+        user_cache.load_user(first)
+        user_cache.load_user(a)
+        user_cache.load_user(first)
+        user_cache.load_user(b)
+    assert list(user_cache._cache) == [first, b]
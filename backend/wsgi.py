@@ -1,4 +1,6 @@
-from annotator_app import app
+from annotator_app import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run()
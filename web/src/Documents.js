@@ -3,6 +3,7 @@ import {useEffect, useState, useRef} from 'react';
 import {useDispatch,useSelector} from 'react-redux';
 import { Link, useHistory } from "react-router-dom";
 import { createSelector } from 'reselect';
+import axios from 'axios';
 
 import { LabelledInput, Input } from 'atoms/Input.js';
 import { Button, ButtonIcon } from 'atoms/Button.js';
@@ -266,6 +267,58 @@ function NewDocumentPopup(props) {
   );
 }
 
+const THUMBNAIL_BATCH_SIZE = 100;
+const THUMBNAIL_MAX_RETRIES = 5;
+
+/*
+ * URLs of the thumbnails of the first pages of documents, by document ID.
+ * They are fetched in batches, and those still being rendered are requested again after a delay.
+ */
+function useThumbnails(docIds) {
+  const [thumbnails, setThumbnails] = useState({});
+  // Latest thumbnails, for the effect to read without depending on them
+  const thumbnailsRef = useRef(thumbnails);
+  thumbnailsRef.current = thumbnails;
+  const key = docIds.slice().sort().join(',');
+  useEffect(() => {
+    let cancelled = false;
+    let timeouts = [];
+    function fetchThumbnails(ids, attempt) {
+      axios.get(
+        process.env.REACT_APP_SERVER_ADDRESS+'/data/documents/thumbnails',
+        {params: {ids: ids.join(',')}, withCredentials: true}
+      ).then(function(response){
+        if (cancelled) {
+          return;
+        }
+        let ready = {};
+        let pending = [];
+        for (let [id,thumbnail] of Object.entries(response.data.thumbnails)) {
+          if (thumbnail.status === 'ready') {
+            ready[id] = thumbnail.url;
+          } else if (thumbnail.status === 'pending') {
+            pending.push(id);
+          }
+        }
+        setThumbnails(prev => ({...prev, ...ready}));
+        if (pending.length > 0 && attempt < THUMBNAIL_MAX_RETRIES) {
+          let delay = parseInt(response.headers['retry-after'] || '2')*1000;
+          timeouts.push(setTimeout(() => fetchThumbnails(pending, attempt+1), delay));
+        }
+      });
+    }
+    let ids = key ? key.split(',').filter(id => !(id in thumbnailsRef.current)) : [];
+    for (let i = 0; i < ids.length; i += THUMBNAIL_BATCH_SIZE) {
+      fetchThumbnails(ids.slice(i,i+THUMBNAIL_BATCH_SIZE), 0);
+    }
+    return () => {
+      cancelled = true;
+      timeouts.forEach(clearTimeout);
+    };
+  }, [key]);
+  return thumbnails;
+}
+
 export function DocumentTable(props) {
   const {
     entities={},
@@ -276,9 +329,17 @@ export function DocumentTable(props) {
   const history = useHistory();
   const [selected, setSelected] = useState(new Set());
   const selectedDocs = Array.from(selected).map(key => entities[key]);
+  const thumbnails = useThumbnails(Object.keys(entities));
 
   const cols = [
     {
+      heading: '',
+      classNameHeading: styles['doc-table__thumbnail-heading'],
+      classNameContent: styles['doc-table__thumbnail-content'],
+      render: x => thumbnails[x.id] ?
+        <Link to={'/annotate/'+x.id}><img src={thumbnails[x.id]} alt='' /></Link> :
+        <div className={styles['doc-table__thumbnail-placeholder']} />,
+    },{
       heading: 'Title',
       classNameHeading: styles['doc-table__title-heading'],
       classNameContent: styles['doc-table__title-content'],